@@ -10,7 +10,6 @@ satellite image (handles cases where the geocoder pin lands off-roof
 or the auto-picker grabs the wrong building).
 """
 
-import io
 import os
 import sys
 
@@ -27,16 +26,10 @@ except Exception:
 from dotenv import load_dotenv
 load_dotenv()
 
-# Windows DLL workaround + early torch load (must precede pvlib/scipy)
+# Windows DLL workaround. torch, the SAM weights, pvlib and matplotlib are
+# no longer imported here: utils.warmup loads them on a background thread
+# (torch first, so it still precedes pvlib/scipy) while the page renders.
 os.environ.setdefault("KMP_DUPLICATE_LIB_OK", "TRUE")
-try:
-    import torch  # noqa: F401
-    # Streamlit's module-reloader walks `torch.classes.__path__._path`,
-    # which torch's custom __getattr__ doesn't support — it spams a noisy
-    # RuntimeError on every rerun. Override with an empty list to silence.
-    torch.classes.__path__ = []
-except Exception:
-    pass
 
 import numpy as np
 import pandas as pd
@@ -45,9 +38,11 @@ from PIL import Image, ImageDraw
 from streamlit_image_coordinates import streamlit_image_coordinates
 
 from utils.config import config, validate_environment
-from components.pipeline import run_full_analysis
+from utils.image_context import ImageContext
+from utils.warmup import start_warmup, warmup_status
 from components.panel_layout import draw_panel_layout
-from components import charts
+
+start_warmup()  # once per server process; no-op on reruns
 
 
 # ---- page setup ------------------------------------------------------------
@@ -142,49 +137,56 @@ st.markdown("""
 
 
 # ---- helpers ---------------------------------------------------------------
-def _crop_to_roof(arr: np.ndarray, mask: np.ndarray, pad_frac: float = 0.15) -> np.ndarray:
-    """Crop a panel to the bounding box of `mask` plus padding."""
+def _roof_crop_box(mask: np.ndarray, pad_frac: float = 0.15) -> tuple[int, int, int, int]:
+    """(y0, y1, x0, x1) of the bounding box of `mask` plus padding."""
+    H, W = mask.shape
     ys, xs = np.where(mask)
     if ys.size == 0:
-        return arr
-    H, W = mask.shape
+        return 0, H, 0, W
     pad_h = int((ys.max() - ys.min()) * pad_frac)
     pad_w = int((xs.max() - xs.min()) * pad_frac)
     y0 = max(0, ys.min() - pad_h); y1 = min(H, ys.max() + pad_h)
     x0 = max(0, xs.min() - pad_w); x1 = min(W, xs.max() + pad_w)
-    return arr[y0:y1, x0:x1]
+    return int(y0), int(y1), int(x0), int(x1)
 
 
-def _build_overlays(image_bytes: bytes, result: dict) -> dict:
-    """Build the four overlay images from a pipeline result."""
-    image = np.array(Image.open(io.BytesIO(image_bytes)).convert("RGB"))
+def _build_overlays(image: ImageContext, result: dict) -> dict:
+    """Build the four overlay images from a pipeline result.
+
+    Everything is cropped to the roof bbox first, so blending only ever
+    touches the roof window, never the full 1280x1280 frame."""
+    image = image.rgb
     seg = result["seg"]
     shading = result["shading"]
     layout = result["layout"]
 
+    y0, y1, x0, x1 = _roof_crop_box(seg["mask"])
+    crop = image[y0:y1, x0:x1]
+    roof = seg["mask"][y0:y1, x0:x1]
+    obstacles = shading["obstacle_mask"][y0:y1, x0:x1]
+    usable = shading["usable_mask"][y0:y1, x0:x1]
+
     # Overlay 1: roof (green) + obstacles (red)
-    roof_overlay = image.copy()
-    roof_overlay[seg["mask"]] = (
-        0.5 * roof_overlay[seg["mask"]] + 0.5 * np.array([0, 255, 0])
+    roof_overlay = crop.copy()
+    roof_overlay[roof] = (
+        0.5 * roof_overlay[roof] + 0.5 * np.array([0, 255, 0])
     ).astype(np.uint8)
-    roof_overlay[shading["obstacle_mask"]] = (
-        0.4 * roof_overlay[shading["obstacle_mask"]] + 0.6 * np.array([255, 0, 0])
+    roof_overlay[obstacles] = (
+        0.4 * roof_overlay[obstacles] + 0.6 * np.array([255, 0, 0])
     ).astype(np.uint8)
 
     # Overlay 2: usable area (cyan)
-    usable_overlay = image.copy()
-    usable = shading["usable_mask"]
+    usable_overlay = crop.copy()
     usable_overlay[usable] = (
         0.4 * usable_overlay[usable] + 0.6 * np.array([0, 200, 255])
     ).astype(np.uint8)
 
-    # Overlay 3: panel layout
-    layout_overlay = draw_panel_layout(image, layout["panels"])
-
-    # Crop all to roof bbox + padding for tight framing
-    roof_overlay = _crop_to_roof(roof_overlay, seg["mask"])
-    usable_overlay = _crop_to_roof(usable_overlay, seg["mask"])
-    layout_overlay = _crop_to_roof(layout_overlay, seg["mask"])
+    # Overlay 3: panel layout, drawn straight into the crop.
+    layout_overlay = draw_panel_layout(
+        crop, layout["panels"],
+        panel_polygons=layout.get("panel_polygons") if layout.get("rotation_deg") else None,
+        origin=(x0, y0),
+    )
 
     return {
         "roof_overlay": roof_overlay,
@@ -193,9 +195,9 @@ def _build_overlays(image_bytes: bytes, result: dict) -> dict:
     }
 
 
-def _annotated_satellite(image_bytes: bytes, prompt_point: tuple[int, int]) -> Image.Image:
+def _annotated_satellite(image: ImageContext, prompt_point: tuple[int, int]) -> Image.Image:
     """Satellite image with a red crosshair at the current prompt point."""
-    img = Image.open(io.BytesIO(image_bytes)).convert("RGB").copy()
+    img = image.pil()
     draw = ImageDraw.Draw(img)
     px, py = prompt_point
     draw.line([(px - 18, py), (px + 18, py)], fill=(255, 0, 0), width=3)
@@ -205,6 +207,13 @@ def _annotated_satellite(image_bytes: bytes, prompt_point: tuple[int, int]) -> I
 
 
 # ---- caching ---------------------------------------------------------------
+@st.cache_resource(show_spinner=False, max_entries=8)
+def _image_context(image_bytes: bytes) -> ImageContext:
+    """Decode the satellite image once; overlays and the click picker share
+    it (and its memoized planes) across reruns."""
+    return ImageContext(image_bytes)
+
+
 @st.cache_data(show_spinner=False, ttl=3600)
 def _cached_fetch_image(address, lat, lng, zoom, scale):
     """Fetch the satellite image only — no segmentation. Cheap; cached."""
@@ -219,6 +228,8 @@ def _cached_run(address, lat, lng, zoom, scale, prompt_point):
     """Run the FULL pipeline (segment+shade+layout+PVWatts) at a given
     user-picked prompt. Cached by inputs so clicking elsewhere is the
     only thing that re-runs the heavy work."""
+    from components.pipeline import run_full_analysis  # lazy: pvlib + SAM
+
     return run_full_analysis(
         address=address, lat=lat, lng=lng,
         zoom=zoom, scale=scale,
@@ -240,6 +251,15 @@ def main():
         st.error(f"⚠️ Configuration issue: {val['message']}")
         st.stop()
 
+    warm = warmup_status()
+    if warm["state"] == "running":
+        st.caption(f"⏳ Loading the segmentation model in the background "
+                   f"({warm['current']}, {warm['elapsed_s']:.0f} s) — you can start "
+                   "entering an address.")
+    elif warm["state"] == "failed":
+        st.caption(f"⚠️ Background warm-up hit an error ({warm['error']}); "
+                   "models will load on first use.")
+
     # ---- input form --------------------------------------------------------
     with st.container():
         col_left, col_right = st.columns([2, 1])
@@ -337,6 +357,7 @@ def main():
         return
 
     image_bytes = sat["image_data"]
+    image_ctx = _image_context(image_bytes)
     formatted_addr = sat.get("formatted_address") or addr_str or (
         f"{parsed_lat:.4f}, {parsed_lng:.4f}" if use_coords else "unknown"
     )
@@ -349,7 +370,7 @@ def main():
             "*The pipeline (segmentation → shading → layout → simulation) "
             "runs only after you mark a point on the building.*"
         )
-        sat_pil = Image.open(io.BytesIO(image_bytes)).convert("RGB")
+        sat_pil = image_ctx.pil()
         click = streamlit_image_coordinates(
             sat_pil,
             key=f"first_click_{formatted_addr}_{zoom_used}",
@@ -393,7 +414,7 @@ def main():
 
     with col_img:
         st.markdown("**Satellite view** — *click anywhere on the rooftop to redo segmentation at that point*")
-        sat_img = _annotated_satellite(image_bytes, result["prompt_point"])
+        sat_img = _annotated_satellite(image_ctx, result["prompt_point"])
         click = streamlit_image_coordinates(
             sat_img,
             key=f"prompt_picker_{formatted_addr}_{st.session_state.get('zoom', 21)}",
@@ -536,7 +557,7 @@ def main():
     if pv is not None:
         st.markdown("---")
         st.markdown("### Pipeline visualizations")
-        overlays = _build_overlays(image_bytes, result)
+        overlays = _build_overlays(image_ctx, result)
         v1, v2, v3 = st.columns(3)
         with v1:
             st.image(
@@ -569,6 +590,8 @@ def main():
         )
 
         # ---- deep-dive tabs ------------------------------------------------
+        from components import charts  # lazy: matplotlib (pre-imported by warm-up)
+
         st.markdown("---")
         st.markdown("### 📊 Deep-dive analytics")
         tab_gen, tab_geom, tab_loss, tab_finance, tab_meta = st.tabs([
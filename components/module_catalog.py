@@ -0,0 +1,125 @@
+"""
+Module catalog evaluation — rank the module SKUs we quote for one roof.
+
+Layout and energy otherwise assume one 1.65 x 1.0 m, 330 W module. Larger
+modules pack differently on a given roof (edge waste, obstacle gaps), run
+at different temperature coefficients and cost differently per watt, so
+the best SKU is roof-specific. For every catalog entry this runs:
+
+    - the fast packer (panel_layout.optimize_panel_layout); the roof's
+      distance transform and integral images are computed once and shared
+      through panel_layout's mask feature cache
+    - PVWatts for all SKUs at once (pvwatts_engine.batch_specific_yield,
+      one row per SKU with its own gamma_pdc), sharing one set of solar
+      positions
+
+and returns a table ranked by lifetime cost per kWh.
+
+Public API:
+    compare_modules(usable_mask, m_per_pixel, weather, lat, lng, ...) -> pd.DataFrame
+
+Columns: rank, sku, name, wattage, panel_count, system_kwp, orientation,
+specific_yield, annual_kwh, capex_inr, lifetime_kwh, cost_per_kwh.
+"""
+
+import numpy as np
+import pandas as pd
+
+from components.panel_layout import optimize_panel_layout
+from components.pvwatts_engine import (
+    _default_tilt_for_latitude,
+    batch_specific_yield,
+    solar_positions,
+)
+from utils.config import config
+
+
+def compare_modules(
+    usable_mask: np.ndarray,
+    m_per_pixel: float,
+    weather: pd.DataFrame,
+    lat: float,
+    lng: float,
+    catalog: list[dict] | None = None,
+    obstacle_mask: np.ndarray | None = None,
+    setback_m: float = 0.5,
+    aisle_m: float = 0.10,
+    tilt: float | None = None,
+    azimuth: float = 180.0,
+    lifetime_years: int | None = None,
+    annual_degradation: float | None = None,
+    debug: bool = False,
+    **layout_kwargs,
+) -> pd.DataFrame:
+    """
+    Pack, simulate and price every module in `catalog` for this roof.
+
+    Parameters
+    ----------
+    catalog : list of {"sku", "name", "height_m", "width_m", "wattage",
+        "gamma_pdc", "cost_per_watt"}; defaults to config.PANEL_CATALOG.
+    tilt : array tilt for the energy model; None = latitude rule.
+    lifetime_years, annual_degradation : for lifetime kWh; default to
+        config.SYSTEM_LIFETIME / config.ANNUAL_DEGRADATION.
+    layout_kwargs : passed through to optimize_panel_layout (e.g.
+        rotation="auto", layout_mode="mixed_rows").
+
+    Returns
+    -------
+    DataFrame, one row per SKU, sorted by cost_per_kwh (₹ of installed
+    cost per lifetime kWh; lower is better).
+    """
+    if catalog is None:
+        catalog = config.PANEL_CATALOG
+    if lifetime_years is None:
+        lifetime_years = config.SYSTEM_LIFETIME
+    if annual_degradation is None:
+        annual_degradation = config.ANNUAL_DEGRADATION
+    if tilt is None:
+        tilt = _default_tilt_for_latitude(lat)
+
+    rows = []
+    for module in catalog:
+        layout = optimize_panel_layout(
+            usable_mask, m_per_pixel, obstacle_mask=obstacle_mask,
+            panel_height_m=module["height_m"], panel_width_m=module["width_m"],
+            panel_wattage=module["wattage"], setback_m=setback_m, aisle_m=aisle_m,
+            **layout_kwargs,
+        )
+        rows.append({
+            "sku": module["sku"],
+            "name": module["name"],
+            "wattage": module["wattage"],
+            "panel_count": layout["panel_count"],
+            "system_kwp": layout["system_size_kw"],
+            "orientation": layout["orientation"],
+        })
+
+    # One batched PVWatts run: a row per SKU, differing only in gamma_pdc.
+    yields = batch_specific_yield(
+        weather, lat, lng, np.full(len(catalog), tilt), azimuth=azimuth,
+        gamma_pdc=np.array([m["gamma_pdc"] for m in catalog]),
+        solpos=solar_positions(weather, lat, lng),
+    )
+    # Sum of (1 - d)^t over the system life.
+    life_factor = float(((1 - annual_degradation) ** np.arange(lifetime_years)).sum())
+
+    for row, module, y in zip(rows, catalog, yields):
+        row["specific_yield"] = round(float(y), 1)
+        row["annual_kwh"] = round(row["system_kwp"] * float(y), 1)
+        row["capex_inr"] = round(row["system_kwp"] * 1000 * module["cost_per_watt"], 0)
+        row["lifetime_kwh"] = round(row["annual_kwh"] * life_factor, 0)
+        row["cost_per_kwh"] = (round(row["capex_inr"] / row["lifetime_kwh"], 3)
+                               if row["lifetime_kwh"] > 0 else float("inf"))
+
+    table = pd.DataFrame(rows).sort_values(
+        ["cost_per_kwh", "annual_kwh"], ascending=[True, False]
+    ).reset_index(drop=True)
+    table.insert(0, "rank", np.arange(1, len(table) + 1))
+
+    if debug:
+        best = table.iloc[0]
+        print(f"[module_catalog] {len(table)} SKUs; best {best['sku']}: "
+              f"{best['system_kwp']:.2f} kWp, {best['annual_kwh']:,.0f} kWh/yr, "
+              f"₹{best['cost_per_kwh']:.2f}/kWh")
+    return table
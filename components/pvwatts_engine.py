@@ -11,10 +11,17 @@ Follows NREL's PVWatts v5 methodology via pvlib. For each of 8760 hours:
 
 Inputs: the weather DataFrame from components.nasa_power (columns
 ghi/dni/dhi/temp_air/wind_speed, UTC-indexed).
+
+batch_specific_yield() runs the same chain for many (tilt, shading)
+configurations at once as (configs x hours) NumPy arrays, for sweeps such
+as components.row_pitch.
 """
 
+import numpy as np
 import pandas as pd
-from pvlib import solarposition, irradiance, temperature, pvsystem, inverter
+
+# pvlib is imported inside the functions that use it: it pulls in scipy and
+# adds ~0.5 s to import time, which would otherwise land on app startup.
 
 
 # PVWatts v5 default loss stack, in percent.
@@ -50,6 +57,19 @@ def _default_tilt_for_latitude(lat: float) -> float:
     return float(max(10, min(35, abs(lat))))
 
 
+def solar_positions(weather: pd.DataFrame, latitude: float, longitude: float) -> pd.DataFrame:
+    """Sun position for every weather hour (pvlib solarposition frame).
+    Compute once and pass to batch_specific_yield for repeated sweeps."""
+    from pvlib import solarposition
+
+    return solarposition.get_solarposition(
+        time=weather.index,
+        latitude=latitude,
+        longitude=longitude,
+        temperature=weather["temp_air"],
+    )
+
+
 def simulate_annual_generation(
     weather: pd.DataFrame,
     latitude: float,
@@ -60,6 +80,8 @@ def simulate_annual_generation(
     losses_pct: dict | None = None,
     gamma_pdc: float = DEFAULT_GAMMA_PDC,
     inverter_efficiency: float = 0.96,
+    diffuse_derate: float = 1.0,
+    horizon_deg=None,
 ) -> dict:
     """
     Run an 8760-hour PVWatts simulation and return annual/monthly totals.
@@ -76,6 +98,12 @@ def simulate_annual_generation(
     losses_pct : dict of named losses; defaults to PVWatts v5 stack.
     gamma_pdc : temperature coefficient of power (per deg C).
     inverter_efficiency : nominal inverter efficiency (0-1).
+    diffuse_derate : fraction of sky-diffuse irradiance that reaches the
+              array (the sky-view factor from shading_analyzer; parapets
+              and obstacles hide part of the sky dome). 1.0 = open sky.
+    horizon_deg : far-field horizon profile (elevation per azimuth bin) from
+              shading_analyzer; hours with the sun below it lose their beam
+              component. None = unobstructed horizon.
 
     Returns
     -------
@@ -89,6 +117,8 @@ def simulate_annual_generation(
         loss_breakdown       dict of percent losses + total combined percent
         system_specs         dict (size_kw, tilt, azimuth)
     """
+    from pvlib import inverter, irradiance, pvsystem, temperature
+
     if tilt is None:
         tilt = _default_tilt_for_latitude(latitude)
 
@@ -97,12 +127,7 @@ def simulate_annual_generation(
 
     # 1. Sun position at every hour.
     #    pvlib expects tz-aware times. weather.index is tz-aware UTC (from NASA POWER).
-    solpos = solarposition.get_solarposition(
-        time=weather.index,
-        latitude=latitude,
-        longitude=longitude,
-        temperature=weather["temp_air"],
-    )
+    solpos = solar_positions(weather, latitude, longitude)
 
     # 2. Transpose GHI/DNI/DHI to plane-of-array (tilted panel).
     poa = irradiance.get_total_irradiance(
@@ -114,7 +139,20 @@ def simulate_annual_generation(
         ghi=weather["ghi"],
         dhi=weather["dhi"],
     )
-    poa_global = poa["poa_global"].clip(lower=0).fillna(0)
+    poa_direct = poa["poa_direct"]
+    if horizon_deg is not None:
+        from components.shading_analyzer import far_field_beam_mask
+        blocked = far_field_beam_mask(
+            horizon_deg, solpos["azimuth"].to_numpy(),
+            solpos["apparent_elevation"].to_numpy(),
+        )
+        poa_direct = poa_direct.where(~blocked, 0.0)
+
+    poa_global = (
+        poa_direct
+        + poa["poa_sky_diffuse"] * diffuse_derate
+        + poa["poa_ground_diffuse"]
+    ).clip(lower=0).fillna(0)
 #at sunset, transposition can briefly produce slightly negative numbers (due to model edge cases). Clip to zero.
 
     # 3. Cell temperature using Sandia Array Performance Model.
@@ -186,10 +224,126 @@ def simulate_annual_generation(
             "azimuth": azimuth,
             "gamma_pdc": gamma_pdc,
             "inverter_efficiency": inverter_efficiency,
+            "diffuse_derate": diffuse_derate,
         },
     }
 
 
+def poa_components(
+    weather: pd.DataFrame,
+    latitude: float,
+    longitude: float,
+    tilt: float | None = None,
+    azimuth: float = 180.0,
+    solpos: pd.DataFrame | None = None,
+) -> pd.DataFrame:
+    """
+    Hourly plane-of-array beam and diffuse irradiance plus SAPM cell
+    temperature, for models that shade the beam per module / substring
+    (components.stringing). Columns: poa_direct, poa_diffuse, temp_cell.
+    """
+    from pvlib import irradiance, temperature
+
+    if tilt is None:
+        tilt = _default_tilt_for_latitude(latitude)
+    if solpos is None:
+        solpos = solar_positions(weather, latitude, longitude)
+    poa = irradiance.get_total_irradiance(
+        surface_tilt=tilt,
+        surface_azimuth=azimuth,
+        solar_zenith=solpos["apparent_zenith"],
+        solar_azimuth=solpos["azimuth"],
+        dni=weather["dni"],
+        ghi=weather["ghi"],
+        dhi=weather["dhi"],
+    )
+    direct = poa["poa_direct"].clip(lower=0).fillna(0)
+    diffuse = (poa["poa_sky_diffuse"] + poa["poa_ground_diffuse"]).clip(lower=0).fillna(0)
+    temp_cell = temperature.sapm_cell(
+        poa_global=direct + diffuse,
+        temp_air=weather["temp_air"],
+        wind_speed=weather["wind_speed"],
+        **SAPM_COEFFS,
+    )
+    return pd.DataFrame({"poa_direct": direct, "poa_diffuse": diffuse,
+                         "temp_cell": temp_cell})
+
+
+def batch_specific_yield(
+    weather: pd.DataFrame,
+    latitude: float,
+    longitude: float,
+    tilts,
+    azimuth: float = 180.0,
+    beam_factor: np.ndarray | None = None,
+    diffuse_factor: np.ndarray | None = None,
+    losses_pct: dict | None = None,
+    gamma_pdc=DEFAULT_GAMMA_PDC,
+    inverter_efficiency: float = 0.96,
+    solpos: pd.DataFrame | None = None,
+) -> np.ndarray:
+    """
+    Annual AC yield (kWh per kWp) for many configurations in one pass.
+
+    Same chain as simulate_annual_generation (isotropic transposition,
+    SAPM cell temperature, PVWatts DC, loss stack, PVWatts inverter), but
+    every step is a (n_configs, n_hours) array op, so dozens of configs
+    cost about as much as a few single runs.
+
+    Parameters
+    ----------
+    tilts : (n,) panel tilt per configuration, degrees.
+    beam_factor : (n, hours) or (n, 1) fraction of beam irradiance that
+              reaches the array (e.g. 1 - inter-row shaded fraction).
+    diffuse_factor : (n, 1) or (n, hours) multiplier on sky diffuse.
+    gamma_pdc : scalar or (n,) temperature coefficient per configuration
+              (e.g. one per module SKU).
+    solpos : output of solar_positions(); computed here if None.
+
+    Returns
+    -------
+    (n,) float array of kWh/kWp/year.
+    """
+    from pvlib import inverter, irradiance, pvsystem, temperature
+
+    if losses_pct is None:
+        losses_pct = DEFAULT_LOSSES_PCT.copy()
+    if solpos is None:
+        solpos = solar_positions(weather, latitude, longitude)
+
+    tilt = np.atleast_1d(np.asarray(tilts, dtype=np.float64))[:, None]
+    zenith = solpos["apparent_zenith"].to_numpy()[None, :]
+    sun_az = solpos["azimuth"].to_numpy()[None, :]
+    dni = weather["dni"].to_numpy()[None, :]
+    ghi = weather["ghi"].to_numpy()[None, :]
+    dhi = weather["dhi"].to_numpy()[None, :]
+
+    poa_direct = irradiance.beam_component(tilt, azimuth, zenith, sun_az, dni)
+    poa_sky = irradiance.isotropic(tilt, dhi)
+    poa_ground = irradiance.get_ground_diffuse(tilt, ghi)
+    if beam_factor is not None:
+        poa_direct = poa_direct * beam_factor
+    if diffuse_factor is not None:
+        poa_sky = poa_sky * diffuse_factor
+    poa_global = np.nan_to_num(np.clip(poa_direct + poa_sky + poa_ground, 0, None))
+
+    cell_temp = temperature.sapm_cell(
+        poa_global=poa_global,
+        temp_air=weather["temp_air"].to_numpy()[None, :],
+        wind_speed=weather["wind_speed"].to_numpy()[None, :],
+        **SAPM_COEFFS,
+    )
+    gamma = np.asarray(gamma_pdc, dtype=np.float64)
+    if gamma.ndim:
+        gamma = gamma[:, None]
+    # 1 kWp nameplate, so the annual sum is the specific yield directly.
+    dc_w = pvsystem.pvwatts_dc(poa_global, cell_temp, pdc0=1000.0, gamma_pdc=gamma)
+    dc_w = dc_w * (1 - pvsystem.pvwatts_losses(**losses_pct) / 100.0)
+    ac_w = np.clip(inverter.pvwatts(pdc=dc_w, pdc0=1000.0,
+                                    eta_inv_nom=inverter_efficiency), 0, None)
+    return np.nan_to_num(ac_w).sum(axis=1) / 1000.0
+
+
 if __name__ == "__main__":
     # Smoke test: 5 kW rooftop system in Mumbai
     # Allow running directly (`python components/pvwatts_engine.py`) by
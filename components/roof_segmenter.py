@@ -7,8 +7,35 @@ Converts pixel count to ground-area square feet
 using Google Web Mercator's known meters-per-pixel formula 
 at the request's zoom level (with cosine correction for latitude).
 
+Image embeddings (the TinyViT encoder pass — the expensive part of every
+call) are cached by image content, so re-prompting an already-encoded image
+only runs the mask decoder. The cache has an in-memory LRU tier and an
+optional on-disk .npy tier under .cache/sam_embeddings/.
+
+All model access goes through SamService, which owns the predictor on one
+worker thread, so concurrent app sessions can't race on its set_image /
+predict state, and concurrent encoder work is batched into one forward
+pass. segment_roofs_batch streams a whole portfolio through batched encoder
+passes with decoding/resizing on a thread pool.
+
+Backend: config.SAM_BACKEND = "torch" (PyTorch checkpoint, eager) or
+"onnx" (components.sam_onnx — ONNX Runtime, optionally int8, for CPU-only
+servers).
+
+Every public stage accepts either raw image bytes or a shared
+utils.image_context.ImageContext (decoded once, HSV etc. memoized).
+
 Public API:
     segment_roof(image_bytes, lat, zoom=21, prompt_point=None) -> dict
+    clear_embedding_cache() -> None
+    get_sam_service() -> SamService
+    SamService.submit(image, predict_kwargs=None, disk_cache=False) -> Future
+    segment_roofs_batch(items, zoom=21, ...) -> Iterator[dict]
+    refine_roof(image_bytes, lat, positive_points, negative_points=(),
+                prev_logits=None, ...) -> dict
+    segment_roof_candidates(image_bytes, lat, prompt_points=None, ...) -> list[dict]
+    auto_pick_prompt_candidates(image_bytes, ...) -> list[dict]
+    segment_all_roofs(image_bytes, lat, iou_threshold=0.5, ...) -> dict
 
 Returns dict with:
     mask          (H,W) bool numpy array
@@ -17,18 +44,41 @@ Returns dict with:
     pixel_count   int
     m_per_pixel   float
     score         float (SAM confidence, 0..1)
+    embedding_cache_hit  bool (encoder pass skipped)
+    low_res_logits       (1,256,256) float32 — chosen mask's decoder logits,
+                         the prev_logits for refine_roof
 """
 
+import hashlib
 import io # reads image bytes as a stream
+import itertools
 import math
 import os
+import queue
 import sys
+import threading
+import time
 import urllib.request
+from collections import OrderedDict, deque
+from collections.abc import Iterable, Iterator
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import TYPE_CHECKING
 
 import cv2
 import numpy as np
 from PIL import Image # decodes png bytes into an array
 
+if TYPE_CHECKING:
+    from utils.image_context import ImageContext
+
+
+def _image_context(image):
+    """ImageContext.of(image); imported lazily so this file stays runnable
+    directly (python components/roof_segmenter.py)."""
+    from utils.image_context import ImageContext
+
+    return ImageContext.of(image)
+
 
 # ---- weights handling ------------------------------------------------------
 WEIGHTS_URL = (
@@ -54,16 +104,11 @@ def _ensure_weights() -> str:
 
 # ---- model singleton -------------------------------------------------------
 _PREDICTOR = None
+_PREDICTOR_LOCK = threading.Lock()
 
 
-def _get_predictor():
-    """Lazy-load MobileSAM and cache the predictor at module level."""
-    '''Loading SAM is slow, about 2 seconds on a cold start. We don't want to pay that cost on every segment_roof() call. So we load once and keep the loaded predictor in module-level memory.'''
-
-    global _PREDICTOR
-    if _PREDICTOR is not None: # stays loaded after one time 
-        return _PREDICTOR
-
+def _load_torch_predictor():
+    """Build a MobileSAM SamPredictor from the PyTorch checkpoint."""
     import torch
     from mobile_sam import sam_model_registry, SamPredictor
 
@@ -74,11 +119,383 @@ def _get_predictor():
     # Tiny ViT-thats MobileSAM's encoder
     model.to(device=device)
     model.eval()
+    return SamPredictor(model)
 
-    _PREDICTOR = SamPredictor(model)
+
+def _get_predictor():
+    """Lazy-load MobileSAM and cache the predictor at module level."""
+    '''Loading SAM is slow, about 2 seconds on a cold start. We don't want to pay that cost on every segment_roof() call. So we load once and keep the loaded predictor in module-level memory.'''
+
+    global _PREDICTOR
+    if _PREDICTOR is not None: # stays loaded after one time 
+        return _PREDICTOR
+
+    with _PREDICTOR_LOCK:  # two threads racing the first call load it once
+        if _PREDICTOR is not None:
+            return _PREDICTOR
+
+        from utils.config import config  # lazy: keeps direct runs importable
+
+        if config.SAM_BACKEND == "onnx":
+            from components.sam_onnx import OnnxSamPredictor
+
+            _PREDICTOR = OnnxSamPredictor(
+                quantized=config.SAM_ONNX_QUANTIZE, n_threads=config.SAM_ONNX_THREADS
+            )
+        else:
+            _PREDICTOR = _load_torch_predictor()
     return _PREDICTOR
 
 
+# ---- image-embedding cache -------------------------------------------------
+# Clicking a different point on the same satellite image re-runs SAM with
+# the same encoder input, so the (1, 256, 64, 64) embedding is memoized by a
+# content hash of the decoded pixels. The memory tier holds the tensor on
+# the predictor's device (a numpy array for the ONNX backend, ~4 MB each);
+# the disk tier holds float32 .npy files. original_size / input_size are recomputed from the image shape, so
+# the embedding is the only thing that needs storing.
+EMBEDDING_CACHE_MAX_ENTRIES = 8
+EMBEDDING_CACHE_DIR = os.path.join(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__))), ".cache", "sam_embeddings"
+)
+_EMBEDDING_CACHE: "OrderedDict[str, object]" = OrderedDict()
+
+
+def _embedding_key(image: np.ndarray, content_hash: str | None = None) -> str:
+    """Content hash of the encoder input (shape + RGB pixels + model).
+    Pass an ImageContext.content_hash to skip re-hashing the pixels."""
+    from utils.config import config
+
+    h = hashlib.sha1()
+    if content_hash is None:
+        h.update(np.asarray(image.shape, dtype=np.int32).tobytes())
+        h.update(np.ascontiguousarray(image).tobytes())
+    else:
+        h.update(content_hash.encode())
+    h.update(f"{os.path.basename(WEIGHTS_PATH)}|{config.SAM_BACKEND}|"
+             f"{config.SAM_ONNX_QUANTIZE}".encode())
+    return h.hexdigest()
+
+
+def _embedding_cache_get(key: str, predictor, disk_cache: bool):
+    """Look up an embedding: memory first, then (optionally) disk."""
+    features = _EMBEDDING_CACHE.get(key)
+    if features is not None:
+        _EMBEDDING_CACHE.move_to_end(key)
+        return features
+
+    path = os.path.join(EMBEDDING_CACHE_DIR, f"{key}.npy")
+    if not disk_cache or not os.path.exists(path):
+        return None
+    features = np.load(path)
+    if not hasattr(predictor, "encode_batch"):  # torch backend: back to a tensor
+        import torch
+
+        features = torch.from_numpy(features).to(predictor.device)
+    _embedding_cache_put(key, features, disk_cache=False)  # promote to memory tier
+    return features
+
+
+def _embedding_cached(key: str, disk_cache: bool) -> bool:
+    """Whether `key` would be served without an encoder pass."""
+    return key in _EMBEDDING_CACHE or (
+        disk_cache and os.path.exists(os.path.join(EMBEDDING_CACHE_DIR, f"{key}.npy"))
+    )
+
+
+def _embedding_cache_put(key: str, features, disk_cache: bool) -> None:
+    """Insert into the LRU memory tier (and optionally write to disk)."""
+    _EMBEDDING_CACHE[key] = features
+    _EMBEDDING_CACHE.move_to_end(key)
+    while len(_EMBEDDING_CACHE) > EMBEDDING_CACHE_MAX_ENTRIES:
+        _EMBEDDING_CACHE.popitem(last=False)
+
+    if disk_cache:
+        os.makedirs(EMBEDDING_CACHE_DIR, exist_ok=True)
+        if not isinstance(features, np.ndarray):
+            features = features.detach().cpu().numpy()
+        np.save(os.path.join(EMBEDDING_CACHE_DIR, f"{key}.npy"), features.astype(np.float32))
+
+
+def _restore_embedding(predictor, features, image_shape: tuple[int, int]) -> None:
+    """Put a cached embedding into the predictor as if set_image had run."""
+    h, w = image_shape
+    predictor.reset_image()
+    predictor.features = features
+    predictor.original_size = (h, w)
+    predictor.input_size = predictor.transform.get_preprocess_shape(
+        h, w, predictor.transform.target_length
+    )
+    predictor.is_image_set = True
+
+
+def _encode_batch(predictor, resized_images: list[np.ndarray]) -> list:
+    """
+    One TinyViT forward pass for several RGB images already resized with
+    predictor.transform.apply_image. Same preprocessing as
+    SamPredictor.set_image otherwise (normalize, pad to 1024); returns a
+    (1, 256, 64, 64) embedding per image.
+    """
+    if hasattr(predictor, "encode_batch"):  # ONNX backend
+        return predictor.encode_batch(resized_images)
+    import torch
+
+    model = predictor.model
+    batch = []
+    for resized in resized_images:
+        t = torch.as_tensor(resized, device=predictor.device).permute(2, 0, 1).contiguous()
+        batch.append(model.preprocess(t[None, :, :, :]))
+    with torch.no_grad():
+        features = model.image_encoder(torch.cat(batch, dim=0))
+    return [features[i:i + 1] for i in range(len(resized_images))]
+
+
+def _predict_batch(predictor, prompts: list[dict]) -> list[tuple]:
+    """
+    Decode several prompts against the predictor's current embedding in one
+    mask-decoder call. Each prompt is a SamPredictor.predict kwargs dict;
+    returns one (masks, scores, low_res_logits) tuple per prompt.
+
+    Point sets of different lengths are padded with label -1 (SAM's
+    "not a point" token). Prompts that disagree on box / mask_input /
+    multimask_output presence can't share a batch and are decoded one by one.
+    """
+    if hasattr(predictor, "predict_batch"):  # ONNX backend
+        return predictor.predict_batch(prompts)
+    if not prompts:
+        return []
+    signature = {(p.get("box") is not None, p.get("mask_input") is not None,
+                  p.get("multimask_output", True)) for p in prompts}
+    if len(signature) > 1:
+        return [predictor.predict(**p) for p in prompts]
+    import torch
+
+    has_box, has_mask, multimask = signature.pop()
+    n_pts = max(len(p.get("point_coords") if p.get("point_coords") is not None else ())
+                for p in prompts)
+    coords_t = labels_t = boxes_t = mask_t = None
+    if n_pts:
+        coords = np.zeros((len(prompts), n_pts, 2), dtype=np.float32)
+        labels = np.full((len(prompts), n_pts), -1, dtype=np.int32)
+        for i, p in enumerate(prompts):
+            if p.get("point_coords") is not None:
+                k = len(p["point_coords"])
+                coords[i, :k] = p["point_coords"]
+                labels[i, :k] = p["point_labels"]
+        coords = predictor.transform.apply_coords(coords, predictor.original_size)
+        coords_t = torch.as_tensor(coords, dtype=torch.float, device=predictor.device)
+        labels_t = torch.as_tensor(labels, dtype=torch.int, device=predictor.device)
+    if has_box:
+        boxes = np.concatenate([np.asarray(p["box"], dtype=np.float32).reshape(1, 4)
+                                for p in prompts])
+        boxes = predictor.transform.apply_boxes(boxes, predictor.original_size)
+        boxes_t = torch.as_tensor(boxes, dtype=torch.float, device=predictor.device)
+    if has_mask:
+        masks_in = np.stack([np.asarray(p["mask_input"], dtype=np.float32).reshape(1, 256, 256)
+                             for p in prompts])
+        mask_t = torch.as_tensor(masks_in, dtype=torch.float, device=predictor.device)
+
+    with torch.no_grad():
+        masks, scores, logits = predictor.predict_torch(
+            coords_t, labels_t, boxes=boxes_t, mask_input=mask_t,
+            multimask_output=multimask,
+        )
+    masks = masks.cpu().numpy()
+    scores = scores.float().cpu().numpy()
+    logits = logits.float().cpu().numpy()
+    return [(masks[i], scores[i], logits[i]) for i in range(len(prompts))]
+
+
+def clear_embedding_cache() -> None:
+    """Drop every in-memory image embedding (the disk tier is left alone)."""
+    _EMBEDDING_CACHE.clear()
+
+
+# ---- inference service -----------------------------------------------------
+# SamPredictor is stateful (set_image, then predict), so two Streamlit
+# sessions sharing it can race and get masks for each other's image. The
+# service owns the predictor and the embedding cache on one worker thread;
+# callers submit requests through a queue and wait on a Future. Whatever is
+# already queued is served together: cache misses go through the encoder
+# as one batch, then each request is decoded against its own embedding.
+# Only a batch that needs the encoder waits up to SAM_BATCH_WINDOW_S for
+# companions; decode-only requests (cache hits) are served at once.
+SAM_MAX_BATCH = 4
+SAM_BATCH_WINDOW_S = 0.02
+
+
+class SamService:
+    """Single owner of the MobileSAM predictor; thread-safe via a request
+    queue served by one worker thread."""
+
+    def __init__(self, max_batch: int = SAM_MAX_BATCH,
+                 batch_window_s: float = SAM_BATCH_WINDOW_S):
+        self.max_batch = max_batch
+        self.batch_window_s = batch_window_s
+        self.stats = {"requests": 0, "encoder_passes": 0, "images_encoded": 0}
+        self._queue: "queue.Queue[dict | None]" = queue.Queue()
+        self._thread = threading.Thread(target=self._run, name="sam-service", daemon=True)
+        self._thread.start()
+
+    def submit(
+        self,
+        image: np.ndarray,
+        predict_kwargs: dict | list[dict] | None = None,
+        disk_cache: bool = False,
+        content_hash: str | None = None,
+    ) -> Future:
+        """
+        Queue one image. With `predict_kwargs` (passed to
+        SamPredictor.predict) the Future resolves to a dict with masks,
+        scores, low_res_logits and embedding_cache_hit; without, the image
+        is only encoded into the cache and the Future resolves to the
+        embedding_cache_hit bool. With a list of kwargs dicts they are
+        decoded as one batch and the dict holds "candidates" (one masks /
+        scores / low_res_logits dict per prompt) and embedding_cache_hit.
+        `content_hash` (from an ImageContext)
+        saves hashing the pixels again for the cache key.
+        """
+        future: Future = Future()
+        self._queue.put({
+            "image": image,
+            "key": _embedding_key(image, content_hash),
+            "predict": predict_kwargs,
+            "disk_cache": disk_cache,
+            "future": future,
+        })
+        return future
+
+    def run(self, fn) -> Future:
+        """
+        Run fn(predictor) on the worker thread with exclusive use of the
+        predictor (for batch jobs that drive the encoder themselves); the
+        Future resolves to fn's return value.
+        """
+        future: Future = Future()
+        self._queue.put({"call": fn, "future": future})
+        return future
+
+    def close(self) -> None:
+        """Finish the queued requests, then stop the worker thread."""
+        self._queue.put(None)
+        self._thread.join()
+
+    def _run(self) -> None:
+        pending = None
+        while True:
+            request = pending if pending is not None else self._queue.get()
+            pending = None
+            if request is None:
+                return
+            if "call" in request:
+                self._call(request)
+                continue
+            batch = [request]
+            deadline = time.monotonic() + self.batch_window_s
+            while len(batch) < self.max_batch:
+                try:
+                    # Drain what is already queued without waiting; only
+                    # hold the window open when an encoder pass is due,
+                    # since that is the only work batching shares.
+                    request = self._queue.get_nowait()
+                except queue.Empty:
+                    timeout = deadline - time.monotonic()
+                    if timeout <= 0 or all(_embedding_cached(r["key"], r["disk_cache"])
+                                           for r in batch):
+                        break
+                    try:
+                        request = self._queue.get(timeout=timeout)
+                    except queue.Empty:
+                        break
+                if request is None or "call" in request:
+                    pending = request  # handled after this batch
+                    break
+                batch.append(request)
+            self._serve(batch)
+
+    def _call(self, request: dict) -> None:
+        future = request["future"]
+        if not future.set_running_or_notify_cancel():
+            return
+        try:
+            result = request["call"](_get_predictor())
+        except Exception as exc:
+            future.set_exception(exc)
+        else:
+            future.set_result(result)
+
+    def _serve(self, batch: list[dict]) -> None:
+        """Resolve embeddings for a batch (one encoder pass for all misses),
+        then decode every request against its own embedding."""
+        batch = [r for r in batch if r["future"].set_running_or_notify_cancel()]
+        if not batch:
+            return
+        self.stats["requests"] += len(batch)
+        try:
+            predictor = _get_predictor()
+            features, misses = {}, {}
+            for r in batch:
+                key = r["key"]
+                if key in features or key in misses:
+                    continue
+                cached = _embedding_cache_get(key, predictor, r["disk_cache"])
+                if cached is None:
+                    misses[key] = r["image"]
+                else:
+                    features[key] = cached
+            hits = set(features)
+            if misses:
+                encoded = _encode_batch(predictor, [predictor.transform.apply_image(im)
+                                                    for im in misses.values()])
+                self.stats["encoder_passes"] += 1
+                self.stats["images_encoded"] += len(misses)
+                for key, f in zip(misses, encoded):
+                    features[key] = f
+                    disk = any(r["disk_cache"] for r in batch if r["key"] == key)
+                    _embedding_cache_put(key, f, disk)
+        except Exception as exc:
+            for r in batch:
+                r["future"].set_exception(exc)
+            return
+
+        for r in batch:
+            hit = r["key"] in hits
+            try:
+                if r["predict"] is None:
+                    result = hit
+                elif isinstance(r["predict"], list):
+                    _restore_embedding(predictor, features[r["key"]], r["image"].shape[:2])
+                    result = {
+                        "candidates": [
+                            {"masks": m, "scores": sc, "low_res_logits": lg}
+                            for m, sc, lg in _predict_batch(predictor, r["predict"])
+                        ],
+                        "embedding_cache_hit": hit,
+                    }
+                else:
+                    _restore_embedding(predictor, features[r["key"]], r["image"].shape[:2])
+                    masks, scores, logits = predictor.predict(**r["predict"])
+                    result = {"masks": masks, "scores": scores,
+                              "low_res_logits": logits, "embedding_cache_hit": hit}
+            except Exception as exc:
+                r["future"].set_exception(exc)
+            else:
+                r["future"].set_result(result)
+
+
+_SERVICE: SamService | None = None
+_SERVICE_LOCK = threading.Lock()
+
+
+def get_sam_service() -> SamService:
+    """Process-wide SamService, started on first use."""
+    global _SERVICE
+    with _SERVICE_LOCK:
+        if _SERVICE is None:
+            _SERVICE = SamService()
+        return _SERVICE
+
+
 # ---- geometry --------------------------------------------------------------
 EQUATOR_M_PER_PX_AT_ZOOM_0 = 156543.03392
 
@@ -116,7 +533,8 @@ def _pick_best_mask(
     scores: np.ndarray,
     prompt_point: tuple[int, int],
     image_size: tuple[int, int],
-) -> tuple[np.ndarray, float]:
+    return_index: bool = False,
+) -> tuple:
     """
     Pick the most plausible roof mask from SAM's 3 candidates.
 
@@ -124,6 +542,8 @@ def _pick_best_mask(
       - must contain the prompt point (foreground)
       - prefer masks within MIN..MAX fraction of frame
       - tiebreaker: highest SAM confidence in range
+
+    Returns (mask, score), or (mask, score, index) with return_index=True.
     """
     h, w = image_size
     px, py = prompt_point
@@ -139,7 +559,7 @@ def _pick_best_mask(
 
     if not candidates:
         i = int(np.argmax(scores))
-        return masks[i], float(scores[i])
+        return (masks[i], float(scores[i])) + ((i,) if return_index else ())
 
     # Prefer in-range masks; among those, pick the highest-confidence one.
     # SAM's score correlates with mask quality — for multi-level Indian
@@ -149,42 +569,44 @@ def _pick_best_mask(
     in_range = [c for c in candidates if c[4]]
     if in_range:
         in_range.sort(key=lambda c: c[2], reverse=True)  # highest score first
-        _, mask, score, _, _ = in_range[0]
-        return mask, score
+        i, mask, score, _, _ = in_range[0]
+        return (mask, score) + ((i,) if return_index else ())
 
     # Fall back: of the out-of-range candidates, prefer the smallest
     # (avoids "everything merged into one giant blob" failure mode).
     candidates.sort(key=lambda c: c[3])
-    _, mask, score, _, _ = candidates[0]
-    return mask, score
+    i, mask, score, _, _ = candidates[0]
+    return (mask, score) + ((i,) if return_index else ())
 
 
 # ---- automatic prompt-point selection --------------------------------------
-def auto_pick_prompt_point(
-    image_bytes: bytes,
+def auto_pick_prompt_candidates(
+    image_bytes: "bytes | ImageContext",
     bright_percentile: float = 60.0,
     min_size_frac: float = 0.005,
     morph_kernel: int = 15,
-) -> tuple[int, int]:
+    max_candidates: int | None = None,
+) -> list[dict]:
     """
-    Pick a sensible prompt pixel automatically by finding the largest bright
-    region nearest the image center.
+    Every plausible rooftop in the frame as a prompt candidate, best first.
 
     Indian residential rooftops are usually noticeably brighter than
     surrounding ground (concrete, beige paint, white tile). We threshold on
     HSV value, clean noise with morphological ops, find connected
-    components, and score each by `size / (1 + distance_to_center)`. The
-    centroid of the best component is the prompt point.
-
-    Falls back to the image center if no plausible bright region is found.
+    components, and score each by `size / (1 + distance_to_center)`.
+
+    Returns a list of dicts sorted by score (highest first):
+        point    (x, y) component centroid — the SAM prompt
+        score    size / (1 + distance_to_center / 100)
+        area_px  component size
+        bbox     (x, y, w, h) component bounding box
+    Accepts raw bytes or a utils.image_context.ImageContext.
     """
-    pil_img = Image.open(io.BytesIO(image_bytes)).convert("RGB")
-    image_rgb = np.array(pil_img)
-    h, w = image_rgb.shape[:2]
+    ctx = _image_context(image_bytes)
+    h, w = ctx.shape
     cx, cy = w // 2, h // 2
 
-    hsv = cv2.cvtColor(image_rgb, cv2.COLOR_RGB2HSV)
-    v = hsv[..., 2]
+    v = ctx.v
 
     threshold = float(np.percentile(v, bright_percentile))
     bright = (v >= threshold).astype(np.uint8)
@@ -196,28 +618,50 @@ def auto_pick_prompt_point(
     n_labels, _, stats, centroids = cv2.connectedComponentsWithStats(bright, connectivity=8)
 
     min_size_px = int(min_size_frac * h * w)
-    best_score = -1.0
-    best_xy: tuple[int, int] | None = None
-
+    candidates = []
     for i in range(1, n_labels):  # skip background label 0
         size = int(stats[i, cv2.CC_STAT_AREA])
         if size < min_size_px:
             continue
         comp_cx, comp_cy = float(centroids[i][0]), float(centroids[i][1])
         dist = math.hypot(comp_cx - cx, comp_cy - cy)
-        score = size / (1.0 + dist / 100.0)
-        if score > best_score:
-            best_score = score
-            best_xy = (int(round(comp_cx)), int(round(comp_cy)))
+        candidates.append({
+            "point": (int(round(comp_cx)), int(round(comp_cy))),
+            "score": size / (1.0 + dist / 100.0),
+            "area_px": size,
+            "bbox": tuple(int(x) for x in stats[i, :4]),
+        })
+
+    candidates.sort(key=lambda c: c["score"], reverse=True)  # stable: ties keep label order
+    return candidates[:max_candidates]
+
+
+def auto_pick_prompt_point(
+    image_bytes: "bytes | ImageContext",
+    bright_percentile: float = 60.0,
+    min_size_frac: float = 0.005,
+    morph_kernel: int = 15,
+) -> tuple[int, int]:
+    """
+    Pick a sensible prompt pixel automatically: the centroid of the best
+    auto_pick_prompt_candidates() component — the largest bright region
+    nearest the image center.
 
-    if best_xy is None:
-        return (cx, cy)
-    return best_xy
+    Falls back to the image center if no plausible bright region is found.
+    Accepts raw bytes or a utils.image_context.ImageContext.
+    """
+    candidates = auto_pick_prompt_candidates(
+        image_bytes, bright_percentile, min_size_frac, morph_kernel, max_candidates=1
+    )
+    if not candidates:
+        h, w = _image_context(image_bytes).shape
+        return (w // 2, h // 2)
+    return candidates[0]["point"]
 
 
 # ---- shadow removal --------------------------------------------------------
 def _remove_shadow(
-    image_rgb: np.ndarray,
+    image_rgb: "np.ndarray | ImageContext",
     mask: np.ndarray,
     prompt_point: tuple[int, int],
     brightness_ratio: float = 0.65,
@@ -241,11 +685,11 @@ def _remove_shadow(
       5. Keep only the connected component containing the prompt point.
     """
     px, py = prompt_point
-    h, w = image_rgb.shape[:2]
+    ctx = _image_context(image_rgb)
+    h, w = ctx.shape
 
-    # 1. convert to HSV
-    hsv = cv2.cvtColor(image_rgb, cv2.COLOR_RGB2HSV)
-    v = hsv[..., 2]
+    # 1. HSV value channel (memoized on the image context)
+    v = ctx.v
 
     y0 = max(0, py - sample_radius)
     y1 = min(h, py + sample_radius)
@@ -277,55 +721,16 @@ def _remove_shadow(
     return refined_u8.astype(bool)
 
 
-# main
-def segment_roof(
-    image_bytes: bytes,
-    lat: float,
-    zoom: int = 21,
-    scale: int = 1,
-    prompt_point: tuple[int, int] | None = None,
-    use_box_prompt: bool = True,
-    box_fraction: float = 0.50,
-    remove_shadows: bool = True,
-    shadow_brightness_ratio: float = 0.65,
-    debug: bool = False,
+# ---- prompt + post-processing (shared by single and batch paths) ------------
+def _prompt_kwargs(
+    prompt_point: tuple[int, int],
+    image_size: tuple[int, int],
+    use_box_prompt: bool,
+    box_fraction: float,
 ) -> dict:
-    """
-    Segment the roof in a satellite image and compute its ground area.
-
-    Parameters
-    ----------
-    image_bytes : raw PNG/JPEG bytes (e.g. from Google Static Maps).
-    lat : latitude of the image center (degrees, for Mercator scale).
-    zoom : Google Maps zoom level the image was fetched at.
-    prompt_point : (x, y) pixel for the SAM point prompt. Defaults to center.
-    use_box_prompt : if True, also pass a bounding box around the prompt
-        point. A box prompt biases SAM toward "the dominant object inside
-        this rectangle" — much more reliable than a point alone in dense
-        urban scenes.
-    box_size : side length of the box prompt (pixels). 240 fits a typical
-        residential roof in a 640x640 zoom-21 image.
-
-    Returns
-    -------
-    dict with keys: mask, area_sqft, area_m2, pixel_count, m_per_pixel, score
-    """
-    pil_img = Image.open(io.BytesIO(image_bytes)).convert("RGB")
-    image = np.array(pil_img)
-    h, w = image.shape[:2]
-
-    # default prompt poin to the center 
-    if prompt_point is None:
-        prompt_point = (w // 2, h // 2)
-    px, py = int(prompt_point[0]), int(prompt_point[1])
-    prompt_point = (px, py)
-
-    predictor = _get_predictor()
-    predictor.set_image(image)
-
-    point_coords = np.array([prompt_point], dtype=np.float32)
-    point_labels = np.array([1], dtype=np.int32)
-
+    """SamPredictor.predict kwargs for a point (+ optional box) prompt."""
+    h, w = image_size
+    px, py = prompt_point
     box = None
     if use_box_prompt:
         # Box is sized as a fraction of the smaller image dimension so it
@@ -342,22 +747,42 @@ def segment_roof(
             ]],
             dtype=np.float32,
         )
+    return {
+        "point_coords": np.array([prompt_point], dtype=np.float32),
+        "point_labels": np.array([1], dtype=np.int32),
+        "box": box,
+        "multimask_output": True,
+    }
 
-    masks, scores, _ = predictor.predict(
-        point_coords=point_coords,
-        point_labels=point_labels,
-        box=box,
-        multimask_output=True,
-    )
 
+def _finish_segmentation(
+    image: "np.ndarray | ImageContext",
+    masks: np.ndarray,
+    scores: np.ndarray,
+    prompt_point: tuple[int, int],
+    lat: float,
+    zoom: int,
+    scale: int,
+    use_box_prompt: bool,
+    remove_shadows: bool,
+    shadow_brightness_ratio: float,
+    debug: bool = False,
+    logits: np.ndarray | None = None,
+) -> dict:
+    """Pick the roof mask from SAM's candidates, strip shadows, measure it.
+    With the decoder's low-res `logits`, the chosen mask's (1, 256, 256)
+    logits are returned as low_res_logits for refine_roof."""
+    image = _image_context(image)
+    h, w = image.shape
     if debug:
         total = h * w
-        print("[roof_segmenter] SAM returned 3 candidate masks:")
+        print(f"[roof_segmenter] SAM returned {len(masks)} candidate masks:")
         for i, (m, s) in enumerate(zip(masks, scores)):
             frac = m.sum() / total
             print(f"  mask {i}: {m.sum():,} px ({frac*100:.1f}% of frame), score={s:.3f}")
 
-    mask, score = _pick_best_mask(masks, scores, prompt_point, (h, w))
+    mask, score, picked = _pick_best_mask(masks, scores, prompt_point, (h, w),
+                                          return_index=True)
 
     raw_pixel_count = int(mask.sum())
 
@@ -391,9 +816,491 @@ def segment_roof(
         "used_box_prompt": use_box_prompt,
         "shadow_removed": remove_shadows,
         "scale": scale,
+        "low_res_logits": (None if logits is None
+                           else np.asarray(logits[picked:picked + 1], dtype=np.float32)),
+    }
+
+
+# main
+def segment_roof(
+    image_bytes: "bytes | ImageContext",
+    lat: float,
+    zoom: int = 21,
+    scale: int = 1,
+    prompt_point: tuple[int, int] | None = None,
+    use_box_prompt: bool = True,
+    box_fraction: float = 0.50,
+    remove_shadows: bool = True,
+    shadow_brightness_ratio: float = 0.65,
+    embedding_disk_cache: bool = False,
+    debug: bool = False,
+) -> dict:
+    """
+    Segment the roof in a satellite image and compute its ground area.
+
+    Parameters
+    ----------
+    image_bytes : raw PNG/JPEG bytes (e.g. from Google Static Maps), or a
+        utils.image_context.ImageContext shared with the other stages.
+    lat : latitude of the image center (degrees, for Mercator scale).
+    zoom : Google Maps zoom level the image was fetched at.
+    prompt_point : (x, y) pixel for the SAM point prompt. Defaults to center.
+    use_box_prompt : if True, also pass a bounding box around the prompt
+        point. A box prompt biases SAM toward "the dominant object inside
+        this rectangle" — much more reliable than a point alone in dense
+        urban scenes.
+    box_size : side length of the box prompt (pixels). 240 fits a typical
+        residential roof in a 640x640 zoom-21 image.
+    embedding_disk_cache : also persist image embeddings under
+        .cache/sam_embeddings/ so they survive restarts. The in-memory
+        embedding cache is always on.
+
+    Returns
+    -------
+    dict with keys: mask, area_sqft, area_m2, pixel_count, m_per_pixel, score,
+    embedding_cache_hit, low_res_logits (feed to refine_roof), ...
+    """
+    ctx = _image_context(image_bytes)
+    image = ctx.rgb
+    h, w = ctx.shape
+
+    # default prompt poin to the center 
+    if prompt_point is None:
+        prompt_point = (w // 2, h // 2)
+    px, py = int(prompt_point[0]), int(prompt_point[1])
+    prompt_point = (px, py)
+
+    decoded = get_sam_service().submit(
+        image,
+        predict_kwargs=_prompt_kwargs(prompt_point, (h, w), use_box_prompt, box_fraction),
+        disk_cache=embedding_disk_cache,
+        content_hash=ctx.content_hash,
+    ).result()
+    embedding_hit = decoded["embedding_cache_hit"]
+    if debug:
+        print(f"[roof_segmenter] image embedding "
+              f"{'cache hit' if embedding_hit else 'computed'}")
+
+    result = _finish_segmentation(
+        ctx, decoded["masks"], decoded["scores"], prompt_point, lat, zoom, scale,
+        use_box_prompt, remove_shadows, shadow_brightness_ratio, debug,
+        logits=decoded["low_res_logits"],
+    )
+    result["embedding_cache_hit"] = embedding_hit
+    return result
+
+
+# ---- interactive refinement ------------------------------------------------
+# Users often need a few clicks to get the roof right. Refinement runs only
+# the mask decoder against the cached embedding: every click so far
+# (positive and negative) goes in as one point prompt, and the previous
+# result's low-res logits go in as mask_input, so each click edits the last
+# mask instead of starting over.
+def refine_roof(
+    image_bytes: "bytes | ImageContext",
+    lat: float,
+    positive_points: list[tuple[int, int]],
+    negative_points: list[tuple[int, int]] = (),
+    prev_logits: np.ndarray | None = None,
+    zoom: int = 21,
+    scale: int = 1,
+    box: tuple[int, int, int, int] | None = None,
+    remove_shadows: bool = True,
+    shadow_brightness_ratio: float = 0.65,
+    debug: bool = False,
+) -> dict:
+    """
+    Re-segment with several positive / negative clicks, continuing from the
+    previous mask.
+
+    Parameters
+    ----------
+    positive_points : (x, y) clicks on the roof (at least one). The first
+        one is the reference point for mask picking and shadow removal.
+    negative_points : (x, y) clicks on things that are not the roof.
+    prev_logits : low_res_logits from the previous segment_roof /
+        refine_roof result (1, 256, 256); None to start fresh.
+    box : optional (x0, y0, x1, y1) box prompt.
+    Other parameters as in segment_roof.
+
+    Returns segment_roof's dict plus positive_points / negative_points.
+    Its low_res_logits are the prev_logits for the next click.
+    """
+    if not positive_points:
+        raise ValueError("refine_roof needs at least one positive point")
+    ctx = _image_context(image_bytes)
+    points = [(int(x), int(y)) for x, y in positive_points]
+    negatives = [(int(x), int(y)) for x, y in negative_points]
+
+    # One ambiguous click -> let SAM offer 3 masks; once there are several
+    # clicks or a previous mask, the prompt is specific enough for one.
+    multimask = len(points) + len(negatives) == 1 and prev_logits is None
+    predict_kwargs = {
+        "point_coords": np.array(points + negatives, dtype=np.float32),
+        "point_labels": np.array([1] * len(points) + [0] * len(negatives), dtype=np.int32),
+        "box": None if box is None else np.array([box], dtype=np.float32),
+        "mask_input": (None if prev_logits is None
+                       else np.asarray(prev_logits, dtype=np.float32).reshape(1, 256, 256)),
+        "multimask_output": multimask,
+    }
+    t0 = time.perf_counter()
+    decoded = get_sam_service().submit(
+        ctx.rgb, predict_kwargs=predict_kwargs, content_hash=ctx.content_hash,
+    ).result()
+    if debug:
+        print(f"[roof_segmenter] refine: {len(points)}+ / {len(negatives)}- points, "
+              f"{'with' if prev_logits is not None else 'no'} previous mask, "
+              f"{(time.perf_counter() - t0) * 1000:.0f} ms "
+              f"(embedding {'cached' if decoded['embedding_cache_hit'] else 'computed'})")
+
+    result = _finish_segmentation(
+        ctx, decoded["masks"], decoded["scores"], points[0], lat, zoom, scale,
+        box is not None, remove_shadows, shadow_brightness_ratio, debug,
+        logits=decoded["low_res_logits"],
+    )
+    result.update({
+        "positive_points": points,
+        "negative_points": negatives,
+        "embedding_cache_hit": decoded["embedding_cache_hit"],
+    })
+    return result
+
+
+def segment_roof_candidates(
+    image_bytes: "bytes | ImageContext",
+    lat: float,
+    zoom: int = 21,
+    scale: int = 1,
+    prompt_points: list[tuple[int, int]] | None = None,
+    max_candidates: int = 5,
+    use_box_prompt: bool = True,
+    box_fraction: float = 0.50,
+    remove_shadows: bool = True,
+    shadow_brightness_ratio: float = 0.65,
+    debug: bool = False,
+) -> list[dict]:
+    """
+    Segment several candidate prompts in one mask-decoder batch against a
+    single image embedding — e.g. to offer the user the top auto-picked
+    buildings to choose from.
+
+    prompt_points : candidate (x, y) prompts; None takes the top
+        `max_candidates` from auto_pick_prompt_candidates().
+
+    Returns one segment_roof-style dict per prompt, in prompt order (plus
+    candidate_score for auto-picked prompts).
+    """
+    ctx = _image_context(image_bytes)
+    h, w = ctx.shape
+    scores_by_point = {}
+    if prompt_points is None:
+        auto = auto_pick_prompt_candidates(ctx, max_candidates=max_candidates)
+        prompt_points = [c["point"] for c in auto] or [(w // 2, h // 2)]
+        scores_by_point = {c["point"]: c["score"] for c in auto}
+    prompt_points = [(int(x), int(y)) for x, y in prompt_points]
+
+    t0 = time.perf_counter()
+    decoded = get_sam_service().submit(
+        ctx.rgb,
+        predict_kwargs=[_prompt_kwargs(pt, (h, w), use_box_prompt, box_fraction)
+                        for pt in prompt_points],
+        content_hash=ctx.content_hash,
+    ).result()
+    if debug:
+        print(f"[roof_segmenter] decoded {len(prompt_points)} candidate prompts in "
+              f"{(time.perf_counter() - t0) * 1000:.0f} ms (embedding "
+              f"{'cached' if decoded['embedding_cache_hit'] else 'computed'})")
+
+    results = []
+    for pt, cand in zip(prompt_points, decoded["candidates"]):
+        result = _finish_segmentation(
+            ctx, cand["masks"], cand["scores"], pt, lat, zoom, scale,
+            use_box_prompt, remove_shadows, shadow_brightness_ratio,
+            logits=cand["low_res_logits"],
+        )
+        result["embedding_cache_hit"] = decoded["embedding_cache_hit"]
+        if pt in scores_by_point:
+            result["candidate_score"] = round(scores_by_point[pt], 1)
+        results.append(result)
+    return results
+
+
+# ---- all roofs in a frame -------------------------------------------------
+# Neighbourhood surveys score every rooftop in a frame. Each bright
+# component from auto_pick_prompt_candidates becomes a point + padded-bbox
+# prompt; all of them go through one mask-decoder batch against a single
+# embedding, so the frame costs one encoder pass however many buildings it
+# has. Neighbouring components often grow into the same building mask, so
+# the results are deduplicated by non-maximum suppression on mask IoU.
+def _mask_bbox(mask: np.ndarray) -> tuple[int, int, int, int]:
+    """(x0, y0, x1, y1) half-open bounding box of a non-empty mask."""
+    x, y, bw, bh = cv2.boundingRect(mask.astype(np.uint8))
+    return x, y, x + bw, y + bh
+
+
+def _mask_iou(a: np.ndarray, a_box: tuple, b: np.ndarray, b_box: tuple) -> float:
+    """IoU of two masks, computed only inside their bounding boxes."""
+    x0, y0 = max(a_box[0], b_box[0]), max(a_box[1], b_box[1])
+    x1, y1 = min(a_box[2], b_box[2]), min(a_box[3], b_box[3])
+    if x0 >= x1 or y0 >= y1:
+        return 0.0
+    inter = int(np.count_nonzero(a[y0:y1, x0:x1] & b[y0:y1, x0:x1]))
+    union = int(np.count_nonzero(a)) + int(np.count_nonzero(b)) - inter
+    return inter / union if union else 0.0
+
+
+def segment_all_roofs(
+    image_bytes: "bytes | ImageContext",
+    lat: float,
+    zoom: int = 21,
+    scale: int = 1,
+    iou_threshold: float = 0.5,
+    bright_percentile: float = 60.0,
+    min_size_frac: float = 0.002,
+    max_candidates: int | None = None,
+    box_padding: float = 0.15,
+    max_area_frac: float = 0.25,
+    remove_shadows: bool = True,
+    shadow_brightness_ratio: float = 0.65,
+    debug: bool = False,
+) -> dict:
+    """
+    Segment every rooftop in the frame with one encoder pass.
+
+    Parameters
+    ----------
+    iou_threshold : masks overlapping a higher-scoring mask by more than
+        this IoU are dropped as duplicates.
+    bright_percentile, min_size_frac : prompt generation, as in
+        auto_pick_prompt_candidates (min_size_frac is lower than the
+        single-roof default so small neighbours are kept).
+    max_candidates : cap on prompts decoded (None = all).
+    box_padding : each component's bbox is grown by this fraction per side
+        before being used as the box prompt.
+    max_area_frac : masks covering more of the frame than this are ground /
+        road, not a building, and are dropped.
+
+    Returns
+    -------
+    dict with keys:
+        buildings      list of dicts, best score first: id, mask, area_sqft,
+                       area_m2, pixel_count, score, prompt_point,
+                       bbox (x0, y0, x1, y1), low_res_logits
+        label_mask     (H,W) int32 — 0 background, building id otherwise
+        count, total_area_sqft, total_area_m2, m_per_pixel, image_shape
+        n_prompts, n_suppressed, embedding_cache_hit
+    """
+    ctx = _image_context(image_bytes)
+    h, w = ctx.shape
+    candidates = auto_pick_prompt_candidates(
+        ctx, bright_percentile, min_size_frac, max_candidates=max_candidates,
+    )
+
+    prompts = []
+    for cand in candidates:
+        x, y, bw, bh = cand["bbox"]
+        pad_x, pad_y = int(bw * box_padding), int(bh * box_padding)
+        prompts.append({
+            "point_coords": np.array([cand["point"]], dtype=np.float32),
+            "point_labels": np.array([1], dtype=np.int32),
+            "box": np.array([[max(0, x - pad_x), max(0, y - pad_y),
+                              min(w, x + bw + pad_x), min(h, y + bh + pad_y)]],
+                            dtype=np.float32),
+            "multimask_output": True,
+        })
+
+    t0 = time.perf_counter()
+    embedding_hit = False
+    decoded = []
+    if prompts:
+        out = get_sam_service().submit(
+            ctx.rgb, predict_kwargs=prompts, content_hash=ctx.content_hash,
+        ).result()
+        decoded, embedding_hit = out["candidates"], out["embedding_cache_hit"]
+    t_decode = time.perf_counter() - t0
+
+    max_px = max_area_frac * h * w
+    results = []
+    for cand, dec in zip(candidates, decoded):
+        result = _finish_segmentation(
+            ctx, dec["masks"], dec["scores"], cand["point"], lat, zoom, scale,
+            True, remove_shadows, shadow_brightness_ratio,
+            logits=dec["low_res_logits"],
+        )
+        if 0 < result["pixel_count"] <= max_px:
+            result["bbox"] = _mask_bbox(result["mask"])
+            results.append(result)
+    results.sort(key=lambda r: r["score"], reverse=True)
+
+    kept = []
+    for result in results:
+        if all(_mask_iou(result["mask"], result["bbox"], k["mask"], k["bbox"]) <= iou_threshold
+               for k in kept):
+            kept.append(result)
+
+    label_mask = np.zeros((h, w), dtype=np.int32)
+    buildings = []
+    for i, result in enumerate(kept, start=1):
+        # Lower-scoring buildings don't overwrite pixels already claimed.
+        label_mask[result["mask"] & (label_mask == 0)] = i
+        buildings.append({
+            "id": i,
+            "mask": result["mask"],
+            "area_sqft": result["area_sqft"],
+            "area_m2": result["area_m2"],
+            "pixel_count": result["pixel_count"],
+            "score": result["score"],
+            "prompt_point": result["prompt_point"],
+            "bbox": result["bbox"],
+            "low_res_logits": result["low_res_logits"],
+        })
+
+    if debug:
+        print(f"[roof_segmenter] all roofs: {len(prompts)} prompts decoded in "
+              f"{t_decode * 1000:.0f} ms (embedding "
+              f"{'cached' if embedding_hit else 'computed'}), "
+              f"{len(results) - len(kept)} duplicates suppressed, "
+              f"{len(buildings)} buildings")
+
+    return {
+        "buildings": buildings,
+        "label_mask": label_mask,
+        "count": len(buildings),
+        "total_area_sqft": round(sum(b["area_sqft"] for b in buildings), 1),
+        "total_area_m2": round(sum(b["area_m2"] for b in buildings), 2),
+        "m_per_pixel": round(_meters_per_pixel(lat, zoom, scale), 4),
+        "image_shape": (h, w),
+        "n_prompts": len(prompts),
+        "n_suppressed": len(results) - len(kept),
+        "embedding_cache_hit": embedding_hit,
+    }
+
+
+# ---- batched portfolio segmentation ----------------------------------------
+# Neighbourhood / portfolio runs segment thousands of images. The encoder is
+# the bottleneck, so images are decoded and resized on a thread pool while
+# the previous batch is encoding, go through TinyViT in batches sized to
+# free RAM, and stream out one result at a time so memory stays flat.
+# Portfolio embeddings are single-use and bypass the embedding cache.
+SAM_ENCODER_MB_PER_IMAGE = 400  # fp32 TinyViT activations at 1024x1024, CPU
+SAM_MAX_ENCODER_BATCH = 16
+
+
+def _auto_batch_size(ram_fraction: float = 0.5) -> int:
+    """Encoder batch that fits in `ram_fraction` of currently free RAM."""
+    try:
+        free_mb = os.sysconf("SC_AVPHYS_PAGES") * os.sysconf("SC_PAGE_SIZE") / 2**20
+    except (AttributeError, ValueError, OSError):  # not available off Linux
+        return 4
+    return int(np.clip(free_mb * ram_fraction // SAM_ENCODER_MB_PER_IMAGE,
+                       1, SAM_MAX_ENCODER_BATCH))
+
+
+def _prepare_item(item: dict, transform) -> dict:
+    """Decode one portfolio item and resize it for the encoder (pool worker)."""
+    ctx = _image_context(item["image_bytes"])
+    h, w = ctx.shape
+    point = item.get("prompt_point") or (w // 2, h // 2)
+    return {
+        "item": item,
+        "image": ctx,
+        "resized": transform.apply_image(ctx.rgb),
+        "prompt_point": (int(point[0]), int(point[1])),
     }
 
 
+def _prefetch(pool: ThreadPoolExecutor, fn, items: Iterable, depth: int) -> Iterator:
+    """pool.map that keeps at most `depth` items in flight, in order."""
+    pending: deque = deque()
+    for item in items:
+        pending.append(pool.submit(fn, item))
+        if len(pending) >= depth:
+            yield pending.popleft().result()
+    while pending:
+        yield pending.popleft().result()
+
+
+def segment_roofs_batch(
+    items: Iterable[dict],
+    zoom: int = 21,
+    scale: int = 1,
+    batch_size: int | None = None,
+    n_workers: int = 4,
+    use_box_prompt: bool = True,
+    box_fraction: float = 0.50,
+    remove_shadows: bool = True,
+    shadow_brightness_ratio: float = 0.65,
+    debug: bool = False,
+) -> Iterator[dict]:
+    """
+    Segment many satellite images, streaming results as they finish.
+
+    Parameters
+    ----------
+    items : iterable of {"image_bytes": bytes | ImageContext, "lat": float}
+        dicts, with
+        optional "prompt_point" (defaults to the image center) and "id"
+        (echoed back). A generator works; it is consumed lazily.
+    batch_size : images per encoder forward pass; None sizes it to free RAM
+        (SAM_ENCODER_MB_PER_IMAGE each, at most SAM_MAX_ENCODER_BATCH).
+    n_workers : decode / resize and shadow-removal threads.
+    Other parameters as in segment_roof.
+
+    Yields
+    ------
+    segment_roof's result dict per item, in input order, plus id, index
+    and images_per_sec (running throughput since the first image).
+    """
+    if batch_size is None:
+        batch_size = _auto_batch_size()
+    predictor = _get_predictor()
+    service = get_sam_service()
+    transform = predictor.transform
+
+    def _decode_batch(pred, prepared: list[dict]) -> list[tuple]:
+        # Runs on the service thread, which owns the predictor.
+        features = _encode_batch(pred, [p["resized"] for p in prepared])
+        out = []
+        for p, f in zip(prepared, features):
+            h, w = p["image"].shape
+            _restore_embedding(pred, f, (h, w))
+            masks, scores, _ = pred.predict(**_prompt_kwargs(
+                p["prompt_point"], (h, w), use_box_prompt, box_fraction))
+            out.append((masks, scores))
+        pred.reset_image()
+        return out
+
+    def _finish(args: tuple) -> dict:
+        p, (masks, scores) = args
+        return _finish_segmentation(
+            p["image"], masks, scores, p["prompt_point"], p["item"]["lat"], zoom,
+            scale, use_box_prompt, remove_shadows, shadow_brightness_ratio,
+        )
+
+    t0 = time.perf_counter()
+    n_done = 0
+    with ThreadPoolExecutor(max_workers=n_workers) as pool:
+        prepared_iter = _prefetch(pool, lambda it: _prepare_item(it, transform),
+                                  items, depth=2 * batch_size)
+        while True:
+            prepared = list(itertools.islice(prepared_iter, batch_size))
+            if not prepared:
+                break
+            t_batch = time.perf_counter()
+            decoded = service.run(lambda pred: _decode_batch(pred, prepared)).result()
+            t_encode = time.perf_counter() - t_batch
+            for p, result in zip(prepared, pool.map(_finish, zip(prepared, decoded))):
+                n_done += 1
+                result["id"] = p["item"].get("id")
+                result["index"] = n_done - 1
+                result["images_per_sec"] = round(n_done / (time.perf_counter() - t0), 2)
+                yield result
+            if debug:
+                print(f"[roof_segmenter] batch of {len(prepared)}: encode+decode "
+                      f"{t_encode:.2f} s, {n_done} images at "
+                      f"{n_done / (time.perf_counter() - t0):.2f} img/s")
+
+
 # ---- smoke test ------------------------------------------------------------
 if __name__ == "__main__":
     # Allow running directly: python components/roof_segmenter.py
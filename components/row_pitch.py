@@ -0,0 +1,260 @@
+"""
+Row pitch optimizer — tilt x row spacing sweep for elevated, tilted racking.
+
+optimize_panel_layout places panels flat with a small aisle, and
+pvwatts_engine assumes a single tilt. On elevated racks the two trade off:
+steeper tilt and tighter rows gain per-panel yield or panel count, but rows
+shade each other in the low winter sun. This module evaluates a grid of
+(tilt, ground-coverage ratio, orientation) configurations:
+
+    - panel count: the integral-image grid packer, with each row's
+      footprint shortened to slope_length * cos(tilt) and the row stride set
+      by the pitch. Setback and integral images come from panel_layout's
+      mask feature cache, so they are built once for the whole sweep.
+      For an azimuth other than south the masks are first rotated by
+      (azimuth - 180) so rows always run perpendicular to the azimuth.
+    - inter-row shading: geometric shaded fraction of every row but the
+      first, per hour, from the sun's profile angle (sun positions computed
+      once), plus the sky-diffuse masking angle of the row in front.
+    - energy: pvwatts_engine.batch_specific_yield over all configurations
+      at once as (configs x hours) arrays.
+
+The result is a table plus its Pareto front of annual kWh vs panel count:
+the configs for which no other config makes at least as much energy with
+no more panels.
+
+Public API:
+    optimize_row_pitch(usable_mask, m_per_pixel, weather, lat, lng, ...) -> dict
+
+Returns dict with:
+    table         pd.DataFrame, one row per feasible configuration:
+                  tilt_deg, gcr, pitch_m, orientation, n_rows, panel_count,
+                  system_size_kw, row_shading_loss_pct, specific_yield,
+                  annual_kwh, pareto
+    pareto        the Pareto-optimal rows of `table` (min panels, max kWh),
+                  sorted by panel_count
+    best          dict — the highest-kWh configuration
+    best_panels   list of (x, y, w, h) panel footprints for `best`; for a
+                  non-south azimuth, the axis-aligned rects inscribed in
+                  each rotated panel
+    best_panel_polygons  (4, 2) float32 corner arrays in image coordinates,
+                  one per entry of `best_panels`
+"""
+
+import numpy as np
+import pandas as pd
+
+from components.panel_layout import (
+    _obstacle_integral, _pack_grid, _rect_polygon, _rotation_frame,
+    _unrotate_panels, _usable_integral, _warp_masks,
+)
+from components.pvwatts_engine import batch_specific_yield, solar_positions
+
+
+# ---- Pareto front ----------------------------------------------------------
+def _pareto_front(panel_count: np.ndarray, annual_kwh: np.ndarray) -> np.ndarray:
+    """
+    Boolean mask of the configs no other config dominates, where fewer
+    panels and more kWh are both better.
+
+    Walking by panel count ascending (ties: kWh descending), a config is on
+    the front only if it produces strictly more than every cheaper one.
+    """
+    order = np.lexsort((-annual_kwh, panel_count))
+    front = np.zeros(len(order), dtype=bool)
+    best_kwh = -np.inf
+    for i in order:
+        if annual_kwh[i] > best_kwh:
+            front[i] = True
+            best_kwh = annual_kwh[i]
+    return front
+
+
+# ---- inter-row shading geometry --------------------------------------------
+def _row_shading(
+    tilt_deg: np.ndarray,
+    pitch_m: np.ndarray,
+    slope_m: np.ndarray,
+    sun_az: np.ndarray,
+    sun_el: np.ndarray,
+    row_azimuth: float = 180.0,
+) -> np.ndarray:
+    """
+    Shaded fraction of a (non-front) row's slope, (n_configs, n_hours).
+
+    In the vertical plane across the rows the sun sits at the profile angle
+    tan(ap) = tan(el) / cos(az - row_az). The row in front casts a shadow
+    reaching up a fraction 1 - P / (L * (cos b + sin b / tan ap)) of the
+    slope, clipped to [0, 1]. Hours with the sun behind the row plane or
+    below the horizon carry no beam anyway and get 0.
+    """
+    beta = np.radians(tilt_deg)[:, None]
+    P = pitch_m[:, None]
+    L = slope_m[:, None]
+    cos_rel = np.cos(np.radians(sun_az - row_azimuth))[None, :]
+    tan_el = np.tan(np.radians(np.clip(sun_el, 0.01, 89.9)))[None, :]
+    front = (cos_rel > 1e-6) & (sun_el[None, :] > 0)
+    tan_ap = np.where(front, tan_el / np.maximum(cos_rel, 1e-6), np.inf)
+    reach = L * (np.cos(beta) + np.sin(beta) / tan_ap)
+    shaded = np.clip(1.0 - P / np.maximum(reach, 1e-9), 0.0, 1.0)
+    return np.where(front, shaded, 0.0)
+
+
+def _diffuse_masking(tilt_deg: np.ndarray, pitch_m: np.ndarray,
+                     slope_m: np.ndarray) -> np.ndarray:
+    """
+    Sky-diffuse factor of a non-front row, (n_configs,). The row in front
+    raises the horizon at the bottom edge to the masking angle
+    psi = atan(L sin b / (P - L cos b)); the top edge sees the open sky.
+    Isotropic view factor averaged over the two edges, relative to open sky.
+    """
+    beta = np.radians(tilt_deg)
+    gap = np.maximum(pitch_m - slope_m * np.cos(beta), 1e-6)
+    psi = np.arctan(slope_m * np.sin(beta) / gap)
+    open_sky = (1 + np.cos(beta)) / 2
+    bottom = (1 + np.cos(beta + psi)) / 2
+    return (bottom + open_sky) / 2 / open_sky
+
+
+# ---- main API --------------------------------------------------------------
+def optimize_row_pitch(
+    usable_mask: np.ndarray,
+    m_per_pixel: float,
+    weather: pd.DataFrame,
+    lat: float,
+    lng: float,
+    tilts_deg: tuple[float, ...] = (0, 5, 10, 15, 20, 25),
+    gcrs: tuple[float, ...] = (0.45, 0.55, 0.65, 0.75, 0.85, 0.95),
+    obstacle_mask: np.ndarray | None = None,
+    panel_height_m: float = 1.65,
+    panel_width_m: float = 1.00,
+    panel_wattage: int = 330,
+    setback_m: float = 0.5,
+    aisle_m: float = 0.10,
+    azimuth: float = 180.0,
+    debug: bool = False,
+) -> dict:
+    """
+    Sweep tilt x ground-coverage ratio x orientation for tilted rows facing
+    `azimuth` and return the energy / panel-count trade-off.
+
+    Parameters
+    ----------
+    usable_mask : (H, W) bool from shading_analyzer.
+    m_per_pixel : ground sampling distance.
+    weather : NASA POWER hourly frame (components.nasa_power).
+    tilts_deg : candidate rack tilts.
+    gcrs : candidate ground-coverage ratios (slope length / row pitch).
+        Configurations whose gap between rows is narrower than `aisle_m`
+        are skipped.
+    azimuth : array azimuth (180 = south, image north up); rows run
+        perpendicular to it. Any other azimuth packs in a frame rotated by
+        (azimuth - 180), the same way panel_layout packs rotated roofs.
+
+    Returns a dict (see module docstring for keys).
+    """
+    panel_h_px = max(1, int(round(panel_height_m / m_per_pixel)))
+    panel_w_px = max(1, int(round(panel_width_m / m_per_pixel)))
+    setback_px = int(round(setback_m / m_per_pixel))
+    aisle_px = int(round(aisle_m / m_per_pixel))
+
+    # Rows stack along image y in the packing frame; rotate the masks so
+    # that is the azimuth direction.
+    frame = None
+    angle = (azimuth - 180.0 + 180.0) % 360.0 - 180.0
+    if angle != 0 and usable_mask.any():
+        frame = _rotation_frame(usable_mask, angle)
+        usable_mask, obstacle_mask = _warp_masks(frame, usable_mask, obstacle_mask)
+
+    # Mask features, once for the whole sweep.
+    usable_ii = _usable_integral(usable_mask, setback_px)
+    obstacle_ii = _obstacle_integral(obstacle_mask)
+
+    # Portrait: long side up the slope; landscape: short side up the slope.
+    orientations = (("portrait", panel_height_m, panel_w_px),
+                    ("landscape", panel_width_m, panel_h_px))
+    configs = []
+    pack_cache: dict[tuple[int, int, int], tuple[list, int]] = {}
+    for tilt in tilts_deg:
+        for gcr in gcrs:
+            for name, slope_m, across_px in orientations:
+                pitch_m = slope_m / gcr
+                depth_m = slope_m * np.cos(np.radians(tilt))
+                if pitch_m - depth_m < aisle_m - 1e-9:
+                    continue
+                depth_px = max(1, int(round(depth_m / m_per_pixel)))
+                stride_px = max(depth_px, int(round(pitch_m / m_per_pixel)))
+                key = (across_px, depth_px, stride_px)
+                if key not in pack_cache:
+                    panels, _ = _pack_grid(
+                        usable_ii, obstacle_ii, across_px, depth_px, aisle_px,
+                        "exhaustive", row_gap_px=stride_px - depth_px,
+                    )
+                    pack_cache[key] = (panels, len({p[1] for p in panels}))
+                panels, n_rows = pack_cache[key]
+                configs.append({
+                    "tilt_deg": float(tilt), "gcr": float(gcr),
+                    "pitch_m": round(pitch_m, 3), "orientation": name,
+                    "slope_m": slope_m, "n_rows": n_rows,
+                    "panel_count": len(panels), "_key": key,
+                })
+    if not configs:
+        raise ValueError("no feasible (tilt, gcr) configuration for this aisle_m")
+
+    # Energy for every configuration in one batched PVWatts run.
+    solpos = solar_positions(weather, lat, lng)
+    tilt = np.array([c["tilt_deg"] for c in configs])
+    pitch = np.array([c["pitch_m"] for c in configs])
+    slope = np.array([c["slope_m"] for c in configs])
+    n_rows = np.array([c["n_rows"] for c in configs], dtype=np.float64)
+    # Every row but the front one sits behind another row.
+    behind = np.where(n_rows > 0, (n_rows - 1) / np.maximum(n_rows, 1), 0.0)[:, None]
+
+    shaded = _row_shading(tilt, pitch, slope, solpos["azimuth"].to_numpy(),
+                          solpos["apparent_elevation"].to_numpy(), azimuth)
+    beam_factor = 1.0 - shaded * behind
+    diffuse_factor = 1.0 - (1.0 - _diffuse_masking(tilt, pitch, slope))[:, None] * behind
+    yields = batch_specific_yield(
+        weather, lat, lng, tilt, azimuth=azimuth,
+        beam_factor=beam_factor, diffuse_factor=diffuse_factor, solpos=solpos,
+    )
+    unshaded = batch_specific_yield(weather, lat, lng, np.unique(tilt),
+                                    azimuth=azimuth, solpos=solpos)
+    unshaded = dict(zip(np.unique(tilt), unshaded))
+
+    for c, y in zip(configs, yields):
+        c["system_size_kw"] = round(c["panel_count"] * panel_wattage / 1000.0, 2)
+        c["row_shading_loss_pct"] = round((1 - y / unshaded[c["tilt_deg"]]) * 100, 2)
+        c["specific_yield"] = round(float(y), 1)
+        c["annual_kwh"] = round(c["system_size_kw"] * float(y), 1)
+
+    table = pd.DataFrame(configs)
+    best_key = table.loc[table["annual_kwh"].idxmax(), "_key"]
+    table = table.drop(columns=["slope_m", "_key"])
+
+    table["pareto"] = _pareto_front(table["panel_count"].to_numpy(),
+                                    table["annual_kwh"].to_numpy())
+    table = table.sort_values("annual_kwh", ascending=False).reset_index(drop=True)
+    best = table.iloc[0].to_dict()
+
+    if debug:
+        print(f"[row_pitch] {len(table)} configs, {len(pack_cache)} distinct packings")
+        print(f"[row_pitch] best: tilt {best['tilt_deg']:.0f} deg, gcr {best['gcr']:.2f} "
+              f"({best['orientation']}), {best['panel_count']} panels, "
+              f"{best['annual_kwh']:,.0f} kWh, row shading "
+              f"{best['row_shading_loss_pct']:.1f}%")
+        print(f"[row_pitch] pareto front: {int(table['pareto'].sum())} configs")
+
+    best_panels = pack_cache[best_key][0]
+    if frame is not None:
+        best_panels, best_polygons = _unrotate_panels(frame, best_panels)
+    else:
+        best_polygons = [_rect_polygon(*p) for p in best_panels]
+
+    return {
+        "table": table,
+        "pareto": table[table["pareto"]].sort_values("panel_count").reset_index(drop=True),
+        "best": best,
+        "best_panels": best_panels,
+        "best_panel_polygons": best_polygons,
+    }
@@ -0,0 +1,337 @@
+"""
+ONNX Runtime backend for MobileSAM — CPU-only servers.
+
+The default backend runs the PyTorch checkpoint in eager mode. This module
+exports the TinyViT image encoder and the prompt/mask decoder to ONNX once
+(optionally with dynamic int8 weight quantization) and serves them through
+ONNX Runtime with a configurable intra-op thread count. OnnxSamPredictor
+mirrors the parts of mobile_sam.SamPredictor that roof_segmenter uses
+(transform, set_image/predict state, reset_image), plus encode_batch for
+the batched encoder path, so it is a drop-in predictor. Torch is only
+needed for the one-time export, not at inference.
+
+Select it with SAM_BACKEND=onnx (utils.config: SAM_BACKEND,
+SAM_ONNX_QUANTIZE, SAM_ONNX_THREADS).
+
+Public API:
+    export_onnx(quantize=True, opset=17) -> dict
+    OnnxSamPredictor(quantized=True, n_threads=None)
+    compare_backends(image_paths=None, quantized=True, ...) -> pd.DataFrame
+
+compare_backends columns: image, torch_px, onnx_px, iou, area_ratio,
+torch_encoder_ms, onnx_encoder_ms, speedup.
+"""
+
+import glob
+import os
+import time
+
+import numpy as np
+import pandas as pd
+from PIL import Image
+
+from components.roof_segmenter import (
+    WEIGHTS_DIR,
+    _ensure_weights,
+    _load_torch_predictor,
+    _pick_best_mask,
+    _prompt_kwargs,
+)
+
+
+# ---- exported model files --------------------------------------------------
+ENCODER_PATH = os.path.join(WEIGHTS_DIR, "mobile_sam_encoder.onnx")
+DECODER_PATH = os.path.join(WEIGHTS_DIR, "mobile_sam_decoder.onnx")
+
+
+def _model_paths(quantized: bool) -> tuple[str, str]:
+    if not quantized:
+        return ENCODER_PATH, DECODER_PATH
+    return (ENCODER_PATH.replace(".onnx", ".int8.onnx"),
+            DECODER_PATH.replace(".onnx", ".int8.onnx"))
+
+
+def export_onnx(quantize: bool = True, opset: int = 17, debug: bool = False) -> dict:
+    """
+    Export the MobileSAM encoder (dynamic batch axis) and decoder (dynamic
+    number of prompt points) to ONNX under .cache/models/, and optionally
+    write dynamic-int8 quantized copies next to them.
+
+    Returns {"encoder": path, "decoder": path} of the files to serve.
+    """
+    import torch
+    from mobile_sam import sam_model_registry
+    from mobile_sam.utils.onnx import SamOnnxModel
+
+    model = sam_model_registry["vit_t"](checkpoint=_ensure_weights())
+    model.eval()
+    os.makedirs(WEIGHTS_DIR, exist_ok=True)
+
+    with torch.no_grad():
+        torch.onnx.export(
+            model.image_encoder,
+            torch.randn(1, 3, 1024, 1024),
+            ENCODER_PATH,
+            input_names=["images"],
+            output_names=["image_embeddings"],
+            dynamic_axes={"images": {0: "batch"}, "image_embeddings": {0: "batch"}},
+            opset_version=opset,
+        )
+        # All 4 mask tokens out; SamPredictor's multimask selection
+        # (masks 1..3, or mask 0 alone) is applied in predict().
+        decoder = SamOnnxModel(model, return_single_mask=False)
+        dummy = {
+            "image_embeddings": torch.randn(1, 256, 64, 64),
+            "point_coords": torch.randint(0, 1024, (1, 5, 2), dtype=torch.float),
+            "point_labels": torch.randint(0, 4, (1, 5), dtype=torch.float),
+            "mask_input": torch.randn(1, 1, 256, 256),
+            "has_mask_input": torch.tensor([1], dtype=torch.float),
+            "orig_im_size": torch.tensor([1280, 1280], dtype=torch.float),
+        }
+        torch.onnx.export(
+            decoder,
+            tuple(dummy.values()),
+            DECODER_PATH,
+            input_names=list(dummy),
+            output_names=["masks", "iou_predictions", "low_res_masks"],
+            dynamic_axes={"point_coords": {1: "num_points"},
+                          "point_labels": {1: "num_points"}},
+            opset_version=opset,
+        )
+
+    encoder_path, decoder_path = ENCODER_PATH, DECODER_PATH
+    if quantize:
+        from onnxruntime.quantization import QuantType, quantize_dynamic
+
+        encoder_path, decoder_path = _model_paths(quantized=True)
+        quantize_dynamic(ENCODER_PATH, encoder_path, weight_type=QuantType.QUInt8)
+        quantize_dynamic(DECODER_PATH, decoder_path, weight_type=QuantType.QUInt8)
+
+    if debug:
+        for path in (encoder_path, decoder_path):
+            print(f"[sam_onnx] exported {path} ({os.path.getsize(path) / 2**20:.1f} MB)")
+    return {"encoder": encoder_path, "decoder": decoder_path}
+
+
+# ---- preprocessing ---------------------------------------------------------
+# Same constants as mobile_sam's Sam.preprocess / ResizeLongestSide.
+IMG_SIZE = 1024
+PIXEL_MEAN = np.array([123.675, 116.28, 103.53], dtype=np.float32)
+PIXEL_STD = np.array([58.395, 57.12, 57.375], dtype=np.float32)
+MASK_THRESHOLD = 0.0
+
+
+class _ResizeLongestSide:
+    """numpy/PIL port of mobile_sam.utils.transforms.ResizeLongestSide
+    (torch-free)."""
+
+    def __init__(self, target_length: int = IMG_SIZE):
+        self.target_length = target_length
+
+    @staticmethod
+    def get_preprocess_shape(oldh: int, oldw: int, long_side_length: int) -> tuple[int, int]:
+        scale = long_side_length * 1.0 / max(oldh, oldw)
+        return int(oldh * scale + 0.5), int(oldw * scale + 0.5)
+
+    def apply_image(self, image: np.ndarray) -> np.ndarray:
+        h, w = self.get_preprocess_shape(image.shape[0], image.shape[1], self.target_length)
+        return np.array(Image.fromarray(image).resize((w, h), Image.BILINEAR))
+
+    def apply_coords(self, coords: np.ndarray, original_size: tuple[int, int]) -> np.ndarray:
+        old_h, old_w = original_size
+        new_h, new_w = self.get_preprocess_shape(old_h, old_w, self.target_length)
+        coords = np.array(coords, dtype=np.float32)
+        coords[..., 0] *= new_w / old_w
+        coords[..., 1] *= new_h / old_h
+        return coords
+
+
+def _encoder_input(resized_images: list[np.ndarray]) -> np.ndarray:
+    """Normalize and bottom-right pad to (B, 3, 1024, 1024) float32."""
+    batch = np.zeros((len(resized_images), 3, IMG_SIZE, IMG_SIZE), dtype=np.float32)
+    for i, resized in enumerate(resized_images):
+        h, w = resized.shape[:2]
+        batch[i, :, :h, :w] = ((resized.astype(np.float32) - PIXEL_MEAN) / PIXEL_STD).transpose(2, 0, 1)
+    return batch
+
+
+# ---- predictor -------------------------------------------------------------
+class OnnxSamPredictor:
+    """Drop-in for mobile_sam.SamPredictor backed by ONNX Runtime sessions."""
+
+    device = "cpu"
+
+    def __init__(self, quantized: bool = True, n_threads: int | None = None):
+        import onnxruntime as ort
+
+        encoder_path, decoder_path = _model_paths(quantized)
+        if not (os.path.exists(encoder_path) and os.path.exists(decoder_path)):
+            export_onnx(quantize=quantized)
+
+        options = ort.SessionOptions()
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        if n_threads:
+            options.intra_op_num_threads = n_threads
+        providers = ["CPUExecutionProvider"]
+        self.encoder = ort.InferenceSession(encoder_path, options, providers=providers)
+        self.decoder = ort.InferenceSession(decoder_path, options, providers=providers)
+        self.transform = _ResizeLongestSide(IMG_SIZE)
+        self.quantized = quantized
+        self.reset_image()
+
+    def reset_image(self) -> None:
+        self.features = None
+        self.original_size = None
+        self.input_size = None
+        self.is_image_set = False
+
+    def encode_batch(self, resized_images: list[np.ndarray]) -> list[np.ndarray]:
+        """One encoder run for several resized images; (1, 256, 64, 64) each."""
+        (embeddings,) = self.encoder.run(None, {"images": _encoder_input(resized_images)})
+        return [embeddings[i:i + 1] for i in range(len(resized_images))]
+
+    def set_image(self, image: np.ndarray) -> None:
+        resized = self.transform.apply_image(image)
+        self.reset_image()
+        self.features = self.encode_batch([resized])[0]
+        self.original_size = image.shape[:2]
+        self.input_size = resized.shape[:2]
+        self.is_image_set = True
+
+    def predict(
+        self,
+        point_coords: np.ndarray | None = None,
+        point_labels: np.ndarray | None = None,
+        box: np.ndarray | None = None,
+        mask_input: np.ndarray | None = None,
+        multimask_output: bool = True,
+        return_logits: bool = False,
+    ) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """Same contract as SamPredictor.predict (numpy in, numpy out)."""
+        if not self.is_image_set:
+            raise RuntimeError("An image must be set with .set_image(...) before mask prediction.")
+
+        coords = np.zeros((0, 2), dtype=np.float32)
+        labels = np.zeros(0, dtype=np.float32)
+        if point_coords is not None:
+            coords = self.transform.apply_coords(point_coords, self.original_size)
+            labels = np.asarray(point_labels, dtype=np.float32)
+        if box is not None:
+            corners = self.transform.apply_coords(
+                np.asarray(box, dtype=np.float32).reshape(-1, 2, 2)[0], self.original_size
+            )
+            coords = np.concatenate([coords, corners])
+            labels = np.concatenate([labels, [2.0, 3.0]]).astype(np.float32)
+        else:
+            # The exported decoder expects a padding point when there's no box.
+            coords = np.concatenate([coords, np.zeros((1, 2), dtype=np.float32)])
+            labels = np.concatenate([labels, [-1.0]]).astype(np.float32)
+
+        has_mask = mask_input is not None
+        masks, iou, low_res = self.decoder.run(None, {
+            "image_embeddings": self.features,
+            "point_coords": coords[None].astype(np.float32),
+            "point_labels": labels[None],
+            "mask_input": (np.asarray(mask_input, dtype=np.float32).reshape(1, 1, 256, 256)
+                           if has_mask else np.zeros((1, 1, 256, 256), dtype=np.float32)),
+            "has_mask_input": np.array([float(has_mask)], dtype=np.float32),
+            "orig_im_size": np.array(self.original_size, dtype=np.float32),
+        })
+        keep = slice(1, None) if multimask_output else slice(0, 1)
+        masks, iou, low_res = masks[0, keep], iou[0, keep], low_res[0, keep]
+        if not return_logits:
+            masks = masks > MASK_THRESHOLD
+        return masks, iou, low_res
+
+
+    def predict_batch(self, prompts: list[dict]) -> list[tuple]:
+        """Decode several prompt dicts against the current embedding. The
+        exported decoder takes one prompt set per run, so this loops; the
+        encoder pass is still shared."""
+        return [self.predict(**p) for p in prompts]
+
+
+# ---- accuracy / latency check ----------------------------------------------
+CACHE_DIR = os.path.dirname(WEIGHTS_DIR)
+
+
+def _default_test_images() -> list[str]:
+    """Raw satellite frames saved under .cache/ by the segmenter smoke
+    tests. The mask_*.png files there are overlays with a SAM mask painted
+    in, so comparing backends on them would leak the answer."""
+    return sorted(glob.glob(os.path.join(CACHE_DIR, "**", "*_original.png"), recursive=True))
+
+
+def _timed_encode(predictor, resized: np.ndarray, n_runs: int):
+    """Best-of-n encoder latency (ms) and the embedding of the last run."""
+    from components.roof_segmenter import _encode_batch
+
+    best = float("inf")
+    for _ in range(n_runs):
+        t0 = time.perf_counter()
+        features = _encode_batch(predictor, [resized])[0]
+        best = min(best, time.perf_counter() - t0)
+    return best * 1000, features
+
+
+def compare_backends(
+    image_paths: list[str] | None = None,
+    quantized: bool = True,
+    n_threads: int | None = None,
+    n_timing_runs: int = 3,
+    debug: bool = True,
+) -> pd.DataFrame:
+    """
+    Segment each test image with the torch and ONNX backends (same
+    center point + box prompt and mask picker as segment_roof) and compare
+    the chosen masks and encoder latency.
+
+    Returns one row per image (see module docstring for columns).
+    """
+    from components.roof_segmenter import _restore_embedding
+
+    if image_paths is None:
+        image_paths = _default_test_images()
+    backends = {"torch": _load_torch_predictor(),
+                "onnx": OnnxSamPredictor(quantized=quantized, n_threads=n_threads)}
+
+    rows = []
+    for path in image_paths:
+        image = np.array(Image.open(path).convert("RGB"))
+        h, w = image.shape[:2]
+        point = (w // 2, h // 2)
+        row = {"image": os.path.basename(path)}
+        masks = {}
+        for name, predictor in backends.items():
+            resized = predictor.transform.apply_image(image)
+            ms, features = _timed_encode(predictor, resized, n_timing_runs)
+            _restore_embedding(predictor, features, (h, w))
+            cand, scores, _ = predictor.predict(**_prompt_kwargs(point, (h, w), True, 0.50))
+            masks[name], _ = _pick_best_mask(np.asarray(cand), np.asarray(scores), point, (h, w))
+            row[f"{name}_px"] = int(masks[name].sum())
+            row[f"{name}_encoder_ms"] = round(ms, 1)
+        union = np.logical_or(masks["torch"], masks["onnx"]).sum()
+        row["iou"] = round(float(np.logical_and(masks["torch"], masks["onnx"]).sum() / max(union, 1)), 4)
+        row["area_ratio"] = round(row["onnx_px"] / max(row["torch_px"], 1), 4)
+        row["speedup"] = round(row["torch_encoder_ms"] / max(row["onnx_encoder_ms"], 1e-9), 2)
+        rows.append(row)
+
+    table = pd.DataFrame(rows, columns=[
+        "image", "torch_px", "onnx_px", "iou", "area_ratio",
+        "torch_encoder_ms", "onnx_encoder_ms", "speedup",
+    ])
+    if debug and len(table):
+        print(table.to_string(index=False))
+        print(f"[sam_onnx] {'int8' if quantized else 'fp32'}: mean IoU "
+              f"{table['iou'].mean():.4f}, min {table['iou'].min():.4f}; encoder "
+              f"{table['torch_encoder_ms'].mean():.0f} -> {table['onnx_encoder_ms'].mean():.0f} ms "
+              f"({(1 - table['onnx_encoder_ms'].mean() / table['torch_encoder_ms'].mean()) * 100:.0f}% less)")
+    return table
+
+
+# ---- smoke test ------------------------------------------------------------
+if __name__ == "__main__":
+    # Run from the repo root: python -m components.sam_onnx
+    export_onnx(quantize=True, debug=True)
+    for quantized in (False, True):
+        compare_backends(quantized=quantized)
@@ -15,50 +15,242 @@ Pipeline:
     5. Aggregate to per-pixel shade hours, shade fraction, and a "usable"
        mask (low-shade roof pixels suitable for panels).
 
+Two shadow engines are available for step 4:
+    raster  (default) — shift the obstacle mask pixel-by-pixel along the
+            shadow vector; cost scales with pixel count x shadow length.
+    vector  — vectorize obstacles into polygons, extrude each one along the
+            shadow vector analytically (Minkowski sum with a segment),
+            union and clip to the roof polygon, then rasterize. Cost scales
+            with obstacle vertex count — the better choice for big
+            commercial roofs at scale=2 with only a few obstacles.
+
+Diffuse shading (optional): parapet walls and obstacles also hide part of
+the sky dome from nearby roof pixels. analyze_shading(sky_view=True) adds a
+per-pixel sky-view factor computed from horizon angles in K directions;
+it is used directly as the diffuse-irradiance derate.
+
+Far-field shading (optional): in dense neighbourhoods the taller building
+next door is often the biggest shading source. analyze_shading(far_field=
+True) finds neighbouring buildings in the same frame, builds a horizon
+profile (max elevation angle per azimuth) for the roof once with a
+vectorized polar sweep, and then treats every sun hour below that horizon
+as beam-shaded for the whole roof. This is a per-hour lookup, not a ray cast.
+It is a heuristic and off by default: neighbours are bright components
+that pass shape / size / position filters, and their heights are guessed
+from footprint (capped at 6 m), so treat its losses as an estimate.
+
 Public API:
     analyze_shading(image_bytes, roof_mask, lat, lng, m_per_pixel, ...) -> dict
+    far_field_beam_mask(horizon_deg, sun_azimuth, sun_elevation) -> np.ndarray
+    shade_cube_for_panels(shade_cube, panels, panel_polygons=None) -> np.ndarray
+    clear_shade_cache() -> None
 
 Returns dict with:
     shade_hours_map       (H,W) float — annual shaded hours per pixel
     shade_fraction_map    (H,W) float — 0..1 per pixel
     obstacle_mask         (H,W) bool  — detected obstacles on the roof
+    obstacles             list        — per-obstacle table (id, bbox, area,
+                                        centroid, class, height_m)
+    obstacle_labels       (H,W) int32 — obstacle id raster (0 = none)
     usable_mask           (H,W) bool  — roof_mask AND shade_fraction < threshold
     avg_shade_pct         float       — mean shade across all roof pixels
     usable_area_sqft      float       — total panel-ready area
     n_daylight_hours      int         — hours used in the simulation
+    cache_hit             bool        — True if served from the shade-map cache
+    shade_cube            dict | None — (month x hour-of-day) shade data, only
+                                        when analyze_shading(shade_cube=True)
+    diffuse_derate_map    (H,W) float | None — sky-view factor 0..1 on the roof,
+                                        only when analyze_shading(sky_view=True)
+    avg_sky_view_factor   float | None — roof-mean of the above
+    horizon_profile_deg   (N,) float | None — far-field horizon elevation per
+                                        azimuth bin, only when far_field=True
+    far_field_blocked_hours int       — daylight hours the horizon blocks
 """
 
+import hashlib
 import io
 import math
 import os
+from collections import OrderedDict
 
 # Workaround for a known Windows DLL conflict: pvlib/scipy and torch both
 # carry their own OpenMP runtime; loading both in the same process trips
 # Windows' duplicate-library check. Enabling this flag is the documented
-# escape hatch from Intel's MKL team.
+# escape hatch from Intel's MKL team. (This module never uses torch itself;
+# utils.warmup loads it at app startup, before pvlib is first imported.)
 os.environ.setdefault("KMP_DUPLICATE_LIB_OK", "TRUE")
 
-# Pre-load torch BEFORE any scientific stack so its DLLs win the race.
-# Harmless when torch is unused; required when we chain segmenter -> shading.
-try:
-    import torch  # noqa: F401
-except Exception:
-    pass
+from typing import TYPE_CHECKING
 
 import cv2
 import numpy as np
 import pandas as pd
 from PIL import Image
-from pvlib import solarposition
+
+if TYPE_CHECKING:
+    from utils.image_context import ImageContext
+
+
+def _image_context(image):
+    """ImageContext.of(image); imported lazily so this file stays runnable
+    directly (python components/shading_analyzer.py)."""
+    from utils.image_context import ImageContext
+
+    return ImageContext.of(image)
+
+
+# ---- shade-map cache -------------------------------------------------------
+# Re-clicking inside the same roof in the app usually reproduces the same
+# roof mask, so the ray-cast loop is worth memoizing. Entries are keyed by a
+# content hash of everything the shade-hours map depends on, and store only
+# the roof's bounding-box crop as uint16 (a year never exceeds 8784 hours,
+# and the accumulator only ever adds whole hours).
+SHADE_CACHE_MAX_ENTRIES = 32
+SHADE_CACHE_DIR = os.path.join(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__))), ".cache", "shade_maps"
+)
+_SHADE_CACHE: "OrderedDict[str, dict]" = OrderedDict()
+
+
+def _shade_cache_key(
+    roof_mask: np.ndarray,
+    obstacles: np.ndarray,
+    m_per_pixel: float,
+    lat: float,
+    lng: float,
+    year: int,
+    params: dict,
+) -> str:
+    """Content hash of the packed masks + geometry + shading parameters."""
+    h = hashlib.sha1()
+    h.update(np.asarray(roof_mask.shape, dtype=np.int32).tobytes())
+    h.update(np.packbits(roof_mask).tobytes())
+    h.update(np.packbits(obstacles).tobytes())
+    h.update(f"{m_per_pixel:.6f}|{round(lat, 4)}|{round(lng, 4)}|{year}".encode())
+    h.update(repr(sorted(params.items())).encode())
+    return h.hexdigest()
+
+
+def _pack_shade_hours(shade_hours: np.ndarray, roof_mask: np.ndarray) -> dict:
+    """Crop the shade-hours map to the roof bbox and store it as uint16."""
+    ys, xs = np.where(roof_mask)
+    if ys.size == 0:
+        bbox = (0, 0, 0, 0)
+    else:
+        bbox = (int(ys.min()), int(ys.max()) + 1, int(xs.min()), int(xs.max()) + 1)
+    y0, y1, x0, x1 = bbox
+    hours = np.rint(shade_hours[y0:y1, x0:x1]).astype(np.uint16)
+    return {"bbox": bbox, "hours": hours}
+
+
+def _unpack_shade_hours(entry: dict, shape: tuple[int, int]) -> np.ndarray:
+    """Inverse of _pack_shade_hours: full-frame float32 shade-hours map."""
+    shade_hours = np.zeros(shape, dtype=np.float32)
+    y0, y1, x0, x1 = entry["bbox"]
+    shade_hours[y0:y1, x0:x1] = entry["hours"]
+    return shade_hours
+
+
+def _shade_cache_get(key: str, disk_cache: bool) -> dict | None:
+    """Look up a cached entry: memory first, then (optionally) disk."""
+    entry = _SHADE_CACHE.get(key)
+    if entry is not None:
+        _SHADE_CACHE.move_to_end(key)
+        return entry
+
+    if not disk_cache:
+        return None
+    path = os.path.join(SHADE_CACHE_DIR, f"{key}.npz")
+    if not os.path.exists(path):
+        return None
+    with np.load(path) as data:
+        entry = {
+            "bbox": tuple(int(v) for v in data["bbox"]),
+            "hours": data["hours"],
+            "n_daylight": int(data["meta"][0]),
+            "n_az_bins": int(data["meta"][1]),
+            "n_blocked": int(data["meta"][2]) if len(data["meta"]) > 2 else 0,
+        }
+        if "cube_weights" in data:
+            entry["cube"] = {
+                "shape": tuple(int(v) for v in data["cube_shape"]),
+                "weights": data["cube_weights"],
+                "daylight_hours": data["cube_daylight_hours"],
+                "bin_ptr": data["cube_bin_ptr"],
+                "bin_px": data["cube_bin_px"],
+            }
+    _shade_cache_put(key, entry, disk_cache=False)  # promote to memory tier
+    return entry
+
+
+def _shade_cache_put(key: str, entry: dict, disk_cache: bool) -> None:
+    """Insert into the LRU memory tier (and optionally write to disk)."""
+    _SHADE_CACHE[key] = entry
+    _SHADE_CACHE.move_to_end(key)
+    while len(_SHADE_CACHE) > SHADE_CACHE_MAX_ENTRIES:
+        _SHADE_CACHE.popitem(last=False)
+
+    if disk_cache:
+        arrays = {
+            "bbox": np.asarray(entry["bbox"], dtype=np.int32),
+            "hours": entry["hours"],
+            "meta": np.asarray(
+                [entry["n_daylight"], entry["n_az_bins"], entry.get("n_blocked", 0)],
+                dtype=np.int32,
+            ),
+        }
+        cube = entry.get("cube")
+        if cube is not None:
+            arrays["cube_shape"] = np.asarray(cube["shape"], dtype=np.int32)
+            arrays["cube_weights"] = cube["weights"]
+            arrays["cube_daylight_hours"] = cube["daylight_hours"]
+            arrays["cube_bin_ptr"] = cube["bin_ptr"]
+            arrays["cube_bin_px"] = cube["bin_px"]
+        os.makedirs(SHADE_CACHE_DIR, exist_ok=True)
+        np.savez_compressed(os.path.join(SHADE_CACHE_DIR, f"{key}.npz"), **arrays)
+
+
+def clear_shade_cache() -> None:
+    """Drop every in-memory shade-map entry (the disk tier is left alone)."""
+    _SHADE_CACHE.clear()
 
 
 # ---- obstacle detection ----------------------------------------------------
+# Footprint-based class guess for each obstacle component, checked in order.
+# Heights are typical for Indian residential rooftops and only used when
+# analyze_shading(estimate_obstacle_heights=True).
+#   (class, max_area_m2, height_m)
+OBSTACLE_CLASSES = [
+    ("vent", 0.5, 0.5),
+    ("ac_unit", 2.0, 1.0),
+    ("water_tank", 6.0, 1.5),
+    ("stair_room", float("inf"), 2.5),
+]
+# Long thin dark strips are almost always parapet shadows, not objects.
+PARAPET_SHADOW_ASPECT = 4.0
+PARAPET_SHADOW_MAX_WIDTH_M = 0.6
+PARAPET_SHADOW_HEIGHT_M = 1.0
+
+
+def _classify_obstacle(area_m2: float, w_m: float, h_m: float) -> tuple[str, float]:
+    """Guess (class, height_m) for one obstacle from its footprint."""
+    short, long_ = min(w_m, h_m), max(w_m, h_m)
+    if short <= PARAPET_SHADOW_MAX_WIDTH_M and long_ >= PARAPET_SHADOW_ASPECT * short:
+        return "parapet_shadow", PARAPET_SHADOW_HEIGHT_M
+    for name, max_area, height in OBSTACLE_CLASSES:
+        if area_m2 <= max_area:
+            return name, height
+    return OBSTACLE_CLASSES[-1][0], OBSTACLE_CLASSES[-1][2]
+
+
 def _detect_obstacles(
-    image_rgb: np.ndarray,
+    image_rgb: "np.ndarray | ImageContext",
     roof_mask: np.ndarray,
+    m_per_pixel: float,
     dark_percentile: float = 10.0,
     morph_kernel: int = 7,
-) -> np.ndarray:
+    min_area_m2: float = 0.1,
+) -> dict:
     """
     Find on-roof obstacles by spotting the darkest 15-20% of roof pixels.
 
@@ -71,14 +263,26 @@ def _detect_obstacles(
     shadows from parapets — anything that's noticeably darker than the
     surrounding roof surface.
 
-    Returns a bool mask of obstacle pixels (subset of roof_mask).
+    Connected components are labelled once here, and components smaller
+    than `min_area_m2` are dropped as noise before any shadow casting.
+    Downstream code iterates the returned table instead of rediscovering
+    obstacles from the mask.
+
+    Returns a dict:
+        mask       (H,W) bool  — obstacle pixels (subset of roof_mask)
+        labels     (H,W) int32 — 0 = none, 1..n = obstacle id
+        obstacles  list of dicts, one per id: id, bbox (x, y, w, h),
+                   area_px, area_m2, centroid (x, y), class, height_m
     """
-    hsv = cv2.cvtColor(image_rgb, cv2.COLOR_RGB2HSV)
-    v = hsv[..., 2]
+    v = _image_context(image_rgb).v
 
     roof_v = v[roof_mask]
     if roof_v.size == 0:
-        return np.zeros_like(roof_mask, dtype=bool)
+        return {
+            "mask": np.zeros_like(roof_mask, dtype=bool),
+            "labels": np.zeros(roof_mask.shape, dtype=np.int32),
+            "obstacles": [],
+        }
 
     threshold_v = float(np.percentile(roof_v, dark_percentile))
     dark = (v < threshold_v) & roof_mask
@@ -89,20 +293,57 @@ def _detect_obstacles(
     dark_u8 = cv2.morphologyEx(dark_u8, cv2.MORPH_OPEN, kernel)
     dark_u8 = cv2.morphologyEx(dark_u8, cv2.MORPH_CLOSE, kernel)
 
-    return dark_u8.astype(bool)
+    n_labels, labels, stats, centroids = cv2.connectedComponentsWithStats(
+        dark_u8, connectivity=8
+    )
+
+    # Drop noise components and relabel the survivors 1..n in one lookup.
+    px_area = m_per_pixel ** 2
+    min_area_px = max(1, int(math.ceil(min_area_m2 / px_area)))
+    keep = stats[:, cv2.CC_STAT_AREA] >= min_area_px
+    keep[0] = False  # background
+    remap = np.zeros(n_labels, dtype=np.int32)
+    remap[keep] = np.arange(1, int(keep.sum()) + 1, dtype=np.int32)
+    labels = remap[labels]
+
+    obstacles = []
+    for old_id in np.flatnonzero(keep):
+        x, y, bw, bh, area = (int(s) for s in stats[old_id, :5])
+        area_m2 = area * px_area
+        cls, height = _classify_obstacle(area_m2, bw * m_per_pixel, bh * m_per_pixel)
+        obstacles.append({
+            "id": int(remap[old_id]),
+            "bbox": (x, y, bw, bh),
+            "area_px": area,
+            "area_m2": round(area_m2, 2),
+            "centroid": (float(centroids[old_id][0]), float(centroids[old_id][1])),
+            "class": cls,
+            "height_m": height,
+        })
+
+    return {"mask": labels > 0, "labels": labels, "obstacles": obstacles}
 
 
 # ---- sun-path utilities ----------------------------------------------------
+# Month / hour-of-day tagging uses Indian Standard Time, matching how the
+# PVWatts engine groups its monthly output.
+LOCAL_TZ = "Asia/Kolkata"
+
+
 def _get_daylight_sun_positions(
     lat: float,
     lng: float,
     year: int,
     elevation_min_deg: float = 5.0,
-) -> tuple[np.ndarray, np.ndarray]:
+    with_local_time: bool = False,
+) -> tuple[np.ndarray, ...]:
     """
     Return (azimuth_array, elevation_array) for every daylight hour of the
     given year at this location. Elevations below 5 deg are dropped — sun
     that low is contributing negligible energy.
+
+    With `with_local_time=True`, also return the local (IST) month index
+    0..11 and hour-of-day 0..23 of each daylight hour.
     """
     times = pd.date_range(
         start=f"{year}-01-01",
@@ -110,12 +351,25 @@ def _get_daylight_sun_positions(
         freq="1h",
         tz="UTC",
     )
+    from pvlib import solarposition  # lazy: keeps pvlib off the import path
+
     solpos = solarposition.get_solarposition(times, lat, lng)
 
     daylight = solpos["apparent_elevation"] > elevation_min_deg
     az = solpos.loc[daylight, "azimuth"].to_numpy()
     el = solpos.loc[daylight, "apparent_elevation"].to_numpy()
-    return az, el
+    if not with_local_time:
+        return az, el
+
+    local = times[daylight.to_numpy()].tz_convert(LOCAL_TZ)
+    month = (local.month - 1).to_numpy(dtype=np.int16)
+    hour = local.hour.to_numpy(dtype=np.int16)
+    return az, el, month, hour
+
+
+def _azimuth_bin_index(sun_az: np.ndarray, az_bin_deg: int) -> np.ndarray:
+    """Azimuth bin id of every sun position (shared by all bin consumers)."""
+    return (sun_az / az_bin_deg).astype(int)
 
 
 def _bin_by_azimuth(
@@ -127,7 +381,7 @@ def _bin_by_azimuth(
     Group sun positions by azimuth bin. For each populated bin, return
     (mean_azimuth, mean_elevation, n_hours).
     """
-    bin_idx = (sun_az / az_bin_deg).astype(int)
+    bin_idx = _azimuth_bin_index(sun_az, az_bin_deg)
     bins: list[tuple[float, float, int]] = []
     for b in np.unique(bin_idx):
         in_bin = bin_idx == b
@@ -139,16 +393,113 @@ def _bin_by_azimuth(
     return bins
 
 
+def _bin_month_hour_weights(
+    bin_idx: np.ndarray,
+    month: np.ndarray,
+    hour: np.ndarray,
+    blocked: np.ndarray | None = None,
+) -> np.ndarray:
+    """
+    Tag each azimuth bin with the (month, hour-of-day) slots its hours came
+    from, as sparse COO rows (bin_pos, month, hour, n_hours, n_blocked).
+
+    bin_pos indexes into the bin list from _bin_by_azimuth (same np.unique
+    ordering). n_blocked counts hours whose beam the far-field horizon
+    blocks (0 without far-field shading). A bin typically touches only a
+    few dozen of the 288 slots, so this stays a few hundred rows for a
+    whole year.
+    """
+    _, bin_pos = np.unique(bin_idx, return_inverse=True)
+    key = (bin_pos.astype(np.int64) * 12 + month) * 24 + hour
+    uniq, inverse, counts = np.unique(key, return_inverse=True, return_counts=True)
+    if blocked is None:
+        n_blocked = np.zeros_like(counts)
+    else:
+        n_blocked = np.bincount(inverse, weights=blocked, minlength=len(uniq))
+    return np.stack([
+        uniq // (12 * 24),
+        (uniq // 24) % 12,
+        uniq % 24,
+        counts,
+        n_blocked,
+    ], axis=1).astype(np.int32)
+
+
+def _region_shade_cube(
+    shade_cube: dict,
+    shaded_px_per_bin: np.ndarray,
+    region_px: np.ndarray,
+) -> np.ndarray:
+    """
+    Fold per-bin shaded pixel counts into (..., 12, 24) shade fractions.
+
+    shaded_px_per_bin : (n_bins, n_regions) shaded pixel count per bin.
+    region_px : (n_regions,) total pixels in each region.
+    """
+    w = shade_cube["weights"]
+    bin_pos, month, hour, n = w[:, 0], w[:, 1], w[:, 2], w[:, 3]
+    n_blocked = w[:, 4] if w.shape[1] > 4 else np.zeros_like(n)
+    n_regions = shaded_px_per_bin.shape[1]
+
+    # Far-field-blocked hours shade the whole region; the rest are shaded
+    # only where an obstacle shadow falls.
+    frac_per_bin = shaded_px_per_bin / np.maximum(region_px, 1)[None, :]
+    shaded_hours = np.zeros((n_regions, 12, 24), dtype=np.float64)
+    np.add.at(
+        shaded_hours,
+        (slice(None), month, hour),
+        (frac_per_bin[bin_pos] * (n - n_blocked)[:, None] + n_blocked[:, None]).T,
+    )
+    daylight = shade_cube["daylight_hours"]
+    cube = np.where(daylight > 0, shaded_hours / np.maximum(daylight, 1), 0.0)
+    return cube.astype(np.float32)
+
+
+def shade_cube_for_panels(
+    shade_cube: dict,
+    panels: list[tuple[int, int, int, int]],
+    panel_polygons: list[np.ndarray] | None = None,
+) -> np.ndarray:
+    """
+    Per-panel (month x hour-of-day) shade fractions from a stored cube.
+
+    Re-uses the per-bin shadow pixels recorded by analyze_shading — no new
+    shadows are cast. Pass the layout's panel_polygons to sample each
+    panel's true (possibly rotated) footprint instead of its rectangle.
+    Returns an (n_panels, 12, 24) float32 array.
+    """
+    h, w = shade_cube["shape"]
+    panel_id = np.zeros(h * w, dtype=np.int32)  # 0 = no panel
+    id_map = panel_id.reshape(h, w)
+    if panel_polygons is not None:
+        for i, poly in enumerate(panel_polygons):
+            cv2.fillPoly(id_map, [np.round(poly).astype(np.int32)], i + 1)
+    else:
+        for i, (x, y, pw, ph) in enumerate(panels):
+            id_map[y:y + ph, x:x + pw] = i + 1
+    # Pixels actually owned by each panel (edge pixels shared by two
+    # polygons go to the later one), so the fractions stay consistent.
+    panel_px = np.bincount(panel_id, minlength=len(panels) + 1)[1:len(panels) + 1]
+
+    ptr, px = shade_cube["bin_ptr"], shade_cube["bin_px"]
+    n_bins = len(ptr) - 1
+    counts = np.zeros((n_bins, len(panels)), dtype=np.float64)
+    for b in range(n_bins):
+        hits = np.bincount(panel_id[px[ptr[b]:ptr[b + 1]]], minlength=len(panels) + 1)
+        counts[b] = hits[1:]
+    return _region_shade_cube(shade_cube, counts, panel_px)
+
+
 # ---- shadow casting --------------------------------------------------------
-def _cast_shadow_from_obstacles(
-    obstacles: np.ndarray,
+def _shadow_steps(
     sun_azimuth_deg: float,
     sun_elevation_deg: float,
     obstacle_height_m: float,
     m_per_pixel: float,
 ) -> np.ndarray:
     """
-    Project shadows from every obstacle pixel for the given sun position.
+    Pixel offsets (dy, dx) an obstacle's footprint is stamped at to form
+    its shadow for one sun position.
 
     Geometry:
         shadow_length_m  = obstacle_height / tan(elevation)
@@ -160,32 +511,523 @@ def _cast_shadow_from_obstacles(
         dx_step =  sin(shadow_az_rad)
         dy_step = -cos(shadow_az_rad)   # north points to negative y
 
-    Returns a bool mask of shadow pixels for this sun position.
+    Returns an (n, 2) int array; empty when the shadow is under 1 px.
     """
     el_rad = math.radians(max(sun_elevation_deg, 1e-3))  # guard div by 0
     shadow_len_m = obstacle_height_m / math.tan(el_rad)
     shadow_len_px = int(round(shadow_len_m / m_per_pixel))
     if shadow_len_px < 1:
-        return np.zeros_like(obstacles, dtype=bool)
+        return np.zeros((0, 2), dtype=np.int64)
+
+    shadow_az_rad = math.radians((sun_azimuth_deg + 180.0) % 360.0)
+    steps = np.arange(1, shadow_len_px + 1)
+    offsets = np.stack([
+        np.rint(steps * -math.cos(shadow_az_rad)),
+        np.rint(steps * math.sin(shadow_az_rad)),
+    ], axis=1).astype(np.int64)
+    # Consecutive steps often round to the same pixel offset.
+    return np.unique(offsets, axis=0)
+
+
+def _stamp_obstacle_shadow(
+    shadow: np.ndarray,
+    footprint: np.ndarray,
+    x: int,
+    y: int,
+    steps: np.ndarray,
+) -> None:
+    """OR `footprint` (placed at x, y) into `shadow` at every step offset,
+    touching only the small windows it lands on. Clipped at the frame edge."""
+    H, W = shadow.shape
+    fh, fw = footprint.shape
+    for dy, dx in steps:
+        ty, tx = y + int(dy), x + int(dx)
+        sy0, sx0 = max(0, -ty), max(0, -tx)
+        sy1, sx1 = min(fh, H - ty), min(fw, W - tx)
+        if sy0 >= sy1 or sx0 >= sx1:
+            continue
+        shadow[ty + sy0:ty + sy1, tx + sx0:tx + sx1] |= footprint[sy0:sy1, sx0:sx1]
 
-    shadow_az = (sun_azimuth_deg + 180.0) % 360.0
-    shadow_az_rad = math.radians(shadow_az)
-    dx_step = math.sin(shadow_az_rad)
-    dy_step = -math.cos(shadow_az_rad)
 
-    shadow = np.zeros_like(obstacles, dtype=bool)
-    for step in range(1, shadow_len_px + 1):
-        ox = int(round(step * dx_step))
-        oy = int(round(step * dy_step))
-        shifted = np.roll(obstacles, shift=(oy, ox), axis=(0, 1))
-        shadow |= shifted
+def _cast_shadow_from_obstacles(
+    inventory: dict,
+    sun_azimuth_deg: float,
+    sun_elevation_deg: float,
+    heights_m: list[float],
+    m_per_pixel: float,
+) -> np.ndarray:
+    """
+    Project shadows from every obstacle for the given sun position.
+
+    Iterates the obstacle table: each obstacle's footprint is cut from the
+    label raster by its bbox and stamped along its own shadow vector (see
+    _shadow_steps), so work is proportional to obstacle area x shadow
+    length rather than frame size x shadow length.
 
+    Returns a bool mask of shadow pixels for this sun position.
+    """
+    labels = inventory["labels"]
+    shadow = np.zeros(labels.shape, dtype=bool)
+    for ob, height in zip(inventory["obstacles"], heights_m):
+        steps = _shadow_steps(sun_azimuth_deg, sun_elevation_deg, height, m_per_pixel)
+        if len(steps) == 0:
+            continue
+        x, y, bw, bh = ob["bbox"]
+        footprint = labels[y:y + bh, x:x + bw] == ob["id"]
+        _stamp_obstacle_shadow(shadow, footprint, x, y, steps)
     return shadow
 
 
+# ---- vector shadow engine --------------------------------------------------
+def _mask_to_polygons(mask: np.ndarray, simplify_px: float = 0.5) -> list:
+    """
+    Vectorize a bool mask into shapely polygons (holes preserved).
+
+    Contours run through pixel centers, so rasterizing the polygons back
+    with cv2.fillPoly reproduces the original pixels.
+    """
+    from shapely.geometry import MultiPoint, Polygon
+
+    contours, hierarchy = cv2.findContours(
+        mask.astype(np.uint8), cv2.RETR_CCOMP, cv2.CHAIN_APPROX_SIMPLE
+    )
+    if hierarchy is None:
+        return []
+    hierarchy = hierarchy[0]
+
+    polys = []
+    for i, contour in enumerate(contours):
+        if hierarchy[i][3] != -1:
+            continue  # a hole — attached to its parent below
+        shell = contour[:, 0, :].astype(np.float64)
+        if len(shell) < 3:
+            # 1-2 px wide blobs collapse to points/lines; give them a body.
+            polys.append(MultiPoint(shell).convex_hull.buffer(0.5))
+            continue
+        holes = []
+        child = hierarchy[i][2]
+        while child != -1:
+            if len(contours[child]) >= 3:
+                holes.append(contours[child][:, 0, :].astype(np.float64))
+            child = hierarchy[child][0]
+        poly = Polygon(shell, holes).buffer(0)
+        if simplify_px > 0:
+            poly = poly.simplify(simplify_px, preserve_topology=True)
+        if poly.area == 0:
+            poly = MultiPoint(shell).convex_hull.buffer(0.5)
+        if not poly.is_empty:
+            polys.append(poly)
+    return polys
+
+
+def _sweep_polygon(poly, dx: float, dy: float):
+    """
+    Minkowski sum of `poly` with the segment (0,0)->(dx,dy): the area the
+    polygon covers while sliding along the shadow vector.
+
+    Exact for non-convex polygons with holes: any swept point outside both
+    end copies must have crossed a boundary edge, so it lies in that edge's
+    swept parallelogram.
+    """
+    import shapely
+    from shapely import affinity
+
+    parts = [poly, affinity.translate(poly, dx, dy)]
+    for part in getattr(poly, "geoms", [poly]):
+        for ring in [part.exterior, *part.interiors]:
+            c = np.asarray(ring.coords)
+            a, b = c[:-1], c[1:]
+            edge = b - a
+            # Edges parallel to the shadow vector sweep zero area.
+            keep = np.abs(edge[:, 0] * dy - edge[:, 1] * dx) > 1e-9
+            if not keep.any():
+                continue
+            a, b = a[keep], b[keep]
+            v = np.array([dx, dy])
+            quads = np.stack([a, b, b + v, a + v, a], axis=1)
+            parts.extend(shapely.polygons(quads))
+    return shapely.union_all(parts)
+
+
+def _rasterize_polygons(geom, shape: tuple[int, int]) -> np.ndarray:
+    """Fill the polygonal parts of a shapely geometry into a bool mask."""
+    polys = [g for g in getattr(geom, "geoms", [geom])
+             if g.geom_type == "Polygon" and not g.is_empty]
+    canvas = np.zeros(shape, dtype=np.uint8)
+    shells = [np.rint(np.asarray(p.exterior.coords)).astype(np.int32) for p in polys]
+    holes = [np.rint(np.asarray(r.coords)).astype(np.int32)
+             for p in polys for r in p.interiors]
+    if shells:
+        cv2.fillPoly(canvas, shells, 1)
+    if holes:
+        cv2.fillPoly(canvas, holes, 0)
+    return canvas.astype(bool)
+
+
+def _obstacle_polygons(inventory: dict) -> list[list]:
+    """Vectorize each obstacle from its bbox crop of the label raster."""
+    from shapely import affinity
+
+    labels = inventory["labels"]
+    out = []
+    for ob in inventory["obstacles"]:
+        x, y, bw, bh = ob["bbox"]
+        # 1 px zero border so contours on the crop edge stay closed.
+        crop = np.pad(labels[y:y + bh, x:x + bw] == ob["id"], 1)
+        out.append([affinity.translate(p, x - 1, y - 1) for p in _mask_to_polygons(crop)])
+    return out
+
+
+def _vector_shadow_masks(
+    inventory: dict,
+    heights_m: list[float],
+    roof_mask: np.ndarray,
+    bins: list[tuple[float, float, int]],
+    m_per_pixel: float,
+    debug: bool = False,
+):
+    """
+    Vector counterpart of _cast_shadow_from_obstacles over all bins.
+
+    Obstacles and the roof are vectorized once. Per bin, every obstacle
+    polygon is swept along its own shadow vector, the sweeps are unioned
+    and clipped to the roof polygon. The geometry for all bins is built
+    first and only then rasterized, one mask per bin, in the order of `bins`.
+    """
+    import shapely
+
+    obstacle_polys = _obstacle_polygons(inventory)
+    roof_poly = shapely.union_all(_mask_to_polygons(roof_mask, simplify_px=0))
+    shape = roof_mask.shape
+
+    bin_geoms = []
+    shaded_m2_hours = 0.0
+    for avg_az, avg_el, n_hours in bins:
+        tan_el = math.tan(math.radians(max(avg_el, 1e-3)))
+        shadow_az_rad = math.radians((avg_az + 180.0) % 360.0)
+        sweeps = []
+        for polys, height in zip(obstacle_polys, heights_m):
+            shadow_len_px = height / tan_el / m_per_pixel
+            if shadow_len_px < 0.5:
+                continue
+            dx = shadow_len_px * math.sin(shadow_az_rad)
+            dy = -shadow_len_px * math.cos(shadow_az_rad)
+            sweeps.extend(_sweep_polygon(p, dx, dy) for p in polys)
+        if not sweeps:
+            bin_geoms.append(None)
+            continue
+        shadow = shapely.union_all(sweeps).intersection(roof_poly)
+        shaded_m2_hours += shadow.area * (m_per_pixel ** 2) * n_hours
+        bin_geoms.append(shadow)
+
+    if debug:
+        flat = [p for polys in obstacle_polys for p in polys]
+        n_vertices = sum(len(p.exterior.coords) for p in flat)
+        print(f"[shading_analyzer] vector engine: {len(flat)} obstacle "
+              f"polygons, {n_vertices} vertices, {shaded_m2_hours:,.0f} "
+              f"shaded m^2-hours (analytic)")
+
+    for geom in bin_geoms:
+        if geom is None or geom.is_empty:
+            yield np.zeros(shape, dtype=bool)
+        else:
+            yield _rasterize_polygons(geom, shape)
+
+
+# ---- sky-view factor (diffuse shading) -------------------------------------
+def _opposed_sky_visibility(
+    height_map: np.ndarray,
+    azimuth_deg: float,
+    m_per_pixel: float,
+    border_height_m: float,
+) -> np.ndarray:
+    """
+    cos^2(horizon angle) seen from every pixel, summed over the two opposite
+    look directions `azimuth_deg` and `azimuth_deg + 180`. The horizon comes
+    from the nearest blocker along each ray; everything past the map edge
+    counts as a `border_height_m` blocker.
+
+    Vectorized directional distance transform: rotate the height map so the
+    look direction lies along the rows, find the column of the nearest
+    blocker on each side with a running max / min accumulate, turn distance
+    and blocker height into cos^2 = d^2 / (d^2 + h^2), and rotate back once.
+    There is no per-pixel ray marching.
+    """
+    h, w = height_map.shape
+    az = math.radians(azimuth_deg)
+    u = np.array([math.sin(az), -math.cos(az)])  # look direction, image coords
+    v = np.array([math.cos(az), math.sin(az)])   # perpendicular
+    side = int(math.ceil(math.hypot(h, w))) + 2
+    c_src = np.array([(w - 1) / 2.0, (h - 1) / 2.0])
+    c_dst = np.array([(side - 1) / 2.0, (side - 1) / 2.0])
+    # dst = A @ (src - c_src) + c_dst with x' = -u.p, y' = v.p, so looking
+    # toward `azimuth_deg` means looking toward smaller x'.
+    A = np.stack([-u, v])
+    M = np.hstack([A, (c_dst - A @ c_src)[:, None]]).astype(np.float64)
+
+    # Anything rotated in from outside the frame is beyond the roof edge,
+    # so it blocks like the parapet does (not like the tallest obstacle).
+    rot = cv2.warpAffine(
+        height_map, M, (side, side), flags=cv2.INTER_NEAREST,
+        borderMode=cv2.BORDER_CONSTANT, borderValue=float(border_height_m),
+    )
+    blocker = rot > 0
+    cols = np.arange(side, dtype=np.int32)[None, :]
+    rows = np.arange(side, dtype=np.int32)[:, None] * side
+    flat = rot.ravel()
+
+    def _cos2(idx: np.ndarray, valid: np.ndarray) -> np.ndarray:
+        d = (np.abs(cols - idx).astype(np.float32) * m_per_pixel) ** 2
+        bh = flat[rows + np.clip(idx, 0, side - 1)] ** 2
+        return np.where(valid, d / np.maximum(d + bh, 1e-12), 1.0)
+
+    prev = np.maximum.accumulate(np.where(blocker, cols, -1), axis=1)
+    nxt = np.minimum.accumulate(
+        np.where(blocker, cols, side)[:, ::-1], axis=1
+    )[:, ::-1]
+    vis = (_cos2(prev, prev >= 0) + _cos2(nxt, nxt < side)).astype(np.float32)
+
+    return cv2.warpAffine(
+        vis, M, (w, h), flags=cv2.INTER_NEAREST | cv2.WARP_INVERSE_MAP,
+    )
+
+
+def _sky_view_factor(
+    roof_mask: np.ndarray,
+    m_per_pixel: float,
+    inventory: dict,
+    heights_m: list[float],
+    parapet_height_m: float = 1.0,
+    n_directions: int = 16,
+    max_grid_px: int = 640,
+) -> np.ndarray:
+    """
+    Per-pixel sky-view factor of a horizontal roof surface.
+
+    Blockers are everything outside the roof (treated as a parapet wall of
+    `parapet_height_m` at the roof edge) plus each obstacle at its height.
+    For an isotropic sky, SVF = mean over directions of cos^2(horizon).
+    `n_directions` is rounded down to an even count. Work is confined to
+    the roof bbox. SVF varies smoothly, so roofs larger than `max_grid_px`
+    are evaluated on a max-pooled grid (thin blockers survive) and
+    bilinearly upsampled. Returns (H, W) float32, 0 off-roof.
+    """
+    svf = np.zeros(roof_mask.shape, dtype=np.float32)
+    ys, xs = np.where(roof_mask)
+    if ys.size == 0:
+        return svf
+    y0, y1 = max(0, ys.min() - 1), min(roof_mask.shape[0], ys.max() + 2)
+    x0, x1 = max(0, xs.min() - 1), min(roof_mask.shape[1], xs.max() + 2)
+
+    roof = roof_mask[y0:y1, x0:x1]
+    height_map = np.where(roof, 0.0, parapet_height_m).astype(np.float32)
+    labels = inventory["labels"][y0:y1, x0:x1]
+    if len(heights_m):
+        lut = np.concatenate([[0.0], heights_m]).astype(np.float32)
+        on_obstacle = labels > 0
+        height_map[on_obstacle] = lut[labels[on_obstacle]]
+
+    factor = max(1, int(math.ceil(max(roof.shape) / max_grid_px)))
+    grid = height_map
+    if factor > 1:
+        grid = cv2.dilate(height_map, np.ones((factor, factor), np.uint8))
+        grid = grid[factor // 2::factor, factor // 2::factor]
+
+    # Directions come in opposite pairs that share one rotation.
+    n_pairs = max(1, n_directions // 2)
+    acc = np.zeros(grid.shape, dtype=np.float32)
+    for az in np.arange(n_pairs) * (180.0 / n_pairs):
+        acc += _opposed_sky_visibility(grid, az, m_per_pixel * factor, parapet_height_m)
+    acc /= 2 * n_pairs
+    if factor > 1:
+        acc = cv2.resize(acc, (roof.shape[1], roof.shape[0]), interpolation=cv2.INTER_LINEAR)
+    svf[y0:y1, x0:x1] = np.where(roof, acc, 0.0)
+    return svf
+
+
+# ---- far-field (neighbour building) horizon --------------------------------
+# Rough height above our roof for a neighbouring building, by footprint.
+# One frame cannot tell true heights, so these are deliberately coarse,
+# capped at 6 m (two storeys), and overridable via
+# analyze_shading(neighbor_height_m=...).
+#   (max_footprint_m2, height_above_roof_m)
+NEIGHBOR_HEIGHT_CLASSES = [
+    (40.0, 0.0),            # sheds / stair-rooms seen from above — ignore
+    (150.0, 3.0),           # typical plot house, ~1 storey taller
+    (float("inf"), 6.0),    # larger plot / builder floor — the cap
+]
+
+# A bright component only counts as a building if it looks like one:
+# compact (solidity = area / convex hull area), roughly rectangular
+# (area / min-area-rect area), not a long strip (roads, lanes) and not
+# bigger than a large plot (merged ground, open courtyards).
+NEIGHBOR_MIN_SOLIDITY = 0.80
+NEIGHBOR_MIN_RECTANGULARITY = 0.65
+NEIGHBOR_MAX_ASPECT = 4.0
+NEIGHBOR_MAX_AREA_M2 = 1000.0
+
+
+def _detect_neighbor_buildings(
+    image_rgb: "np.ndarray | ImageContext",
+    roof_mask: np.ndarray,
+    m_per_pixel: float,
+    bright_percentile: float = 60.0,
+    morph_kernel: int = 15,
+    gap_m: float = 1.0,
+    neighbor_height_m: float | None = None,
+) -> dict:
+    """
+    Find neighbouring rooftops in the frame: bright connected components
+    (same cue as roof_segmenter.auto_pick_prompt_point) outside our roof.
+
+    Brightness alone also picks up roads, courtyards and merged ground, so
+    a component is dropped (label 0) when it
+        - touches the ring within `gap_m` of our roof (our own roof /
+          shadow spill, or ground merged with it),
+        - touches the frame border (footprint unknown; roads run off-frame),
+        - fails the NEIGHBOR_* shape / size limits.
+    Survivors get a footprint-class height (NEIGHBOR_HEIGHT_CLASSES, capped
+    at its last entry) unless `neighbor_height_m` is given.
+
+    Returns {"labels": (H,W) int32, "heights_m": (n+1,) float32} where
+    heights_m[id] is the estimated height above our roof (0 for id 0).
+    """
+    v = _image_context(image_rgb).v
+    bright = (v > float(np.percentile(v, bright_percentile))).astype(np.uint8)
+    kernel = cv2.getStructuringElement(cv2.MORPH_ELLIPSE, (morph_kernel, morph_kernel))
+    bright = cv2.morphologyEx(bright, cv2.MORPH_OPEN, kernel)
+    bright = cv2.morphologyEx(bright, cv2.MORPH_CLOSE, kernel)
+
+    roof = roof_mask.astype(np.uint8)
+    gap_px = max(1, int(round(gap_m / m_per_pixel)))
+    ring = cv2.dilate(
+        roof, cv2.getStructuringElement(cv2.MORPH_ELLIPSE, (2 * gap_px + 1, 2 * gap_px + 1)),
+    ) > roof
+    bright[roof > 0] = 0
+
+    n_labels, labels, stats, _ = cv2.connectedComponentsWithStats(bright, connectivity=8)
+    h, w = labels.shape
+    near_roof = np.zeros(n_labels, dtype=bool)
+    near_roof[np.unique(labels[ring])] = True
+
+    keep = np.zeros(n_labels, dtype=bool)
+    for i in range(1, n_labels):
+        x, y, bw, bh, area = stats[i]
+        area_m2 = area * m_per_pixel ** 2
+        if (near_roof[i] or x == 0 or y == 0 or x + bw == w or y + bh == h
+                or area_m2 > NEIGHBOR_MAX_AREA_M2):
+            continue
+        comp = (labels[y:y + bh, x:x + bw] == i).astype(np.uint8)
+        contours, _ = cv2.findContours(comp, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+        outline = max(contours, key=cv2.contourArea)
+        hull_area = cv2.contourArea(cv2.convexHull(outline))
+        (_, _), (rw, rh), _ = cv2.minAreaRect(outline)
+        keep[i] = (area / max(hull_area, 1.0) >= NEIGHBOR_MIN_SOLIDITY
+                   and area / max(rw * rh, 1.0) >= NEIGHBOR_MIN_RECTANGULARITY
+                   and max(rw, rh) / max(min(rw, rh), 1.0) <= NEIGHBOR_MAX_ASPECT)
+
+    # Relabel the survivors 1..n.
+    new_id = np.zeros(n_labels, dtype=np.int32)
+    new_id[keep] = np.arange(1, int(keep.sum()) + 1)
+    heights = np.zeros(int(keep.sum()) + 1, dtype=np.float32)
+    for i in np.flatnonzero(keep):
+        if neighbor_height_m is not None:
+            heights[new_id[i]] = neighbor_height_m
+            continue
+        area_m2 = stats[i, cv2.CC_STAT_AREA] * m_per_pixel ** 2
+        for max_area, rel_height in NEIGHBOR_HEIGHT_CLASSES:
+            if area_m2 <= max_area:
+                heights[new_id[i]] = rel_height
+                break
+    return {"labels": new_id[labels], "heights_m": heights}
+
+
+def _horizon_profile(
+    roof_mask: np.ndarray,
+    neighbors: dict,
+    m_per_pixel: float,
+    bin_deg: float = 2.0,
+) -> np.ndarray:
+    """
+    Far-field horizon of the roof: max elevation angle (deg) of neighbour
+    buildings per azimuth bin, seen from the roof centroid.
+
+    One vectorized polar sweep over all neighbour pixels: azimuth and
+    distance of every pixel at once, elevation = atan(height / distance),
+    reduced per azimuth bin with np.maximum.at.
+    """
+    n_bins = int(round(360.0 / bin_deg))
+    profile = np.zeros(n_bins, dtype=np.float32)
+    labels, heights = neighbors["labels"], neighbors["heights_m"]
+    ys, xs = np.nonzero(labels)
+    if ys.size == 0 or not roof_mask.any():
+        return profile
+    h_m = heights[labels[ys, xs]]
+    keep = h_m > 0
+    ys, xs, h_m = ys[keep], xs[keep], h_m[keep]
+
+    ry, rx = np.nonzero(roof_mask)
+    cy, cx = ry.mean(), rx.mean()
+    dx = xs - cx                 # +x = east
+    dy = cy - ys                 # image y points south, so flip for north
+    az = np.degrees(np.arctan2(dx, dy)) % 360.0
+    dist_m = np.maximum(np.hypot(dx, dy), 1.0) * m_per_pixel
+    elev = np.degrees(np.arctan2(h_m, dist_m)).astype(np.float32)
+
+    idx = (az / bin_deg).astype(int) % n_bins
+    np.maximum.at(profile, idx, elev)
+    return profile
+
+
+def far_field_beam_mask(
+    horizon_deg: np.ndarray,
+    sun_azimuth: np.ndarray,
+    sun_elevation: np.ndarray,
+) -> np.ndarray:
+    """
+    True for every sun position that sits below the far-field horizon
+    (beam blocked). A plain table lookup per hour, usable by both the
+    shading analysis and the energy model.
+    """
+    horizon_deg = np.asarray(horizon_deg)
+    bin_deg = 360.0 / len(horizon_deg)
+    idx = (np.asarray(sun_azimuth) % 360.0 / bin_deg).astype(int) % len(horizon_deg)
+    return np.asarray(sun_elevation) < horizon_deg[idx]
+
+
+# ---- aggregation -----------------------------------------------------------
+def _aggregate_shade_hours(
+    shade_hours: np.ndarray,
+    roof_mask: np.ndarray,
+    n_daylight: int,
+    m_per_pixel: float,
+    usable_shade_threshold: float,
+) -> dict:
+    """Shade-hours map -> shade fraction, usable mask and roof summary stats."""
+    shade_fraction = shade_hours / max(n_daylight, 1)
+    shade_fraction = shade_fraction * roof_mask.astype(np.float32)
+
+    usable_mask = roof_mask & (shade_fraction < usable_shade_threshold)
+
+    roof_pixels_only = shade_fraction[roof_mask]
+    avg_shade_pct = float(roof_pixels_only.mean()) * 100 if roof_pixels_only.size else 0.0
+
+    usable_area_m2 = int(usable_mask.sum()) * (m_per_pixel ** 2)
+    usable_area_sqft = usable_area_m2 * 10.7639
+
+    return {
+        "shade_hours_map": shade_hours,
+        "shade_fraction_map": shade_fraction,
+        "usable_mask": usable_mask,
+        "avg_shade_pct": round(avg_shade_pct, 2),
+        "usable_area_sqft": round(usable_area_sqft, 1),
+        "usable_area_m2": round(usable_area_m2, 2),
+    }
+
+
 # ---- main API --------------------------------------------------------------
 def analyze_shading(
-    image_bytes: bytes,
+    image_bytes: "bytes | ImageContext",
     roof_mask: np.ndarray,
     lat: float,
     lng: float,
@@ -195,6 +1037,17 @@ def analyze_shading(
     az_bin_deg: int = 10,
     obstacle_dark_percentile: float = 10.0,
     usable_shade_threshold: float = 0.10,
+    cache: bool = True,
+    disk_cache: bool = False,
+    shade_cube: bool = False,
+    engine: str = "raster",
+    estimate_obstacle_heights: bool = False,
+    min_obstacle_area_m2: float = 0.1,
+    sky_view: bool = False,
+    parapet_height_m: float = 1.0,
+    sky_view_directions: int = 16,
+    far_field: bool = False,
+    neighbor_height_m: float | None = None,
     debug: bool = False,
 ) -> dict:
     """
@@ -202,7 +1055,8 @@ def analyze_shading(
 
     Parameters
     ----------
-    image_bytes : raw PNG/JPEG bytes (same image used for segmentation).
+    image_bytes : raw PNG/JPEG bytes (same image used for segmentation), or
+        the utils.image_context.ImageContext the segmenter already decoded.
     roof_mask : (H, W) bool — output of components.roof_segmenter.
     lat, lng : site coordinates (degrees).
     m_per_pixel : ground meters per image pixel (from segmenter result).
@@ -213,72 +1067,235 @@ def analyze_shading(
     obstacle_dark_threshold : how dark vs the roof median counts as obstacle.
     usable_shade_threshold : pixels with shade fraction below this are
         considered usable for panels (industry norm: 10%).
+    cache : reuse a previous shade-hours map when the roof mask, obstacle
+        mask, geometry and shading parameters hash to the same key.
+    disk_cache : also persist cache entries under .cache/shade_maps/ so
+        they survive process restarts.
+    shade_cube : also return a time-resolved (month x hour-of-day) shade
+        cube. Each azimuth bin is tagged with the IST month/hour slots its
+        hours came from and its shaded roof pixels are kept as a CSR list
+        (bin_ptr / bin_px), so per-panel cubes can be derived later via
+        shade_cube_for_panels() without casting more shadows.
+    engine : "raster" (pixel shifting) or "vector" (shapely polygon
+        extrusion; see module docstring).
+    estimate_obstacle_heights : use each obstacle's footprint-based height
+        guess (see OBSTACLE_CLASSES) instead of the uniform
+        obstacle_height_m.
+    min_obstacle_area_m2 : dark components smaller than this are treated
+        as noise and dropped before any shadow casting.
+    sky_view : also compute the diffuse derate map (sky-view factor) from
+        parapet walls and obstacles, sampled in `sky_view_directions`
+        directions. Feed its roof/panel mean to
+        pvwatts_engine.simulate_annual_generation(diffuse_derate=...).
+    parapet_height_m : parapet wall height assumed along the roof edge.
+    far_field : also shade the roof from neighbouring buildings in the
+        frame via a horizon profile (see module docstring). Off by
+        default: detection and heights are heuristic guesses from one
+        frame, so check the result before relying on it. Pass the
+        returned horizon_profile_deg to
+        pvwatts_engine.simulate_annual_generation(horizon_deg=...).
+    neighbor_height_m : height of every neighbour above our roof. None =
+        footprint-based estimate (NEIGHBOR_HEIGHT_CLASSES).
 
     Returns
     -------
     dict with keys: shade_hours_map, shade_fraction_map, obstacle_mask,
-    usable_mask, avg_shade_pct, usable_area_sqft, n_daylight_hours.
+    usable_mask, avg_shade_pct, usable_area_sqft, n_daylight_hours,
+    cache_hit, shade_cube, obstacles (table), obstacle_labels,
+    diffuse_derate_map, avg_sky_view_factor, horizon_profile_deg,
+    far_field_blocked_hours.
     """
-    image = np.array(Image.open(io.BytesIO(image_bytes)).convert("RGB"))
-    h, w = image.shape[:2]
+    if engine not in ("raster", "vector"):
+        raise ValueError(f"unknown shading engine: {engine!r}")
+
+    image = _image_context(image_bytes)
+    h, w = image.shape
 
     # 1. Detect obstacles inside the roof mask.
-    obstacles = _detect_obstacles(
-        image, roof_mask, dark_percentile=obstacle_dark_percentile
+    inventory = _detect_obstacles(
+        image, roof_mask, m_per_pixel,
+        dark_percentile=obstacle_dark_percentile,
+        min_area_m2=min_obstacle_area_m2,
     )
+    obstacles = inventory["mask"]
+    if estimate_obstacle_heights:
+        heights = [ob["height_m"] for ob in inventory["obstacles"]]
+    else:
+        heights = [obstacle_height_m] * len(inventory["obstacles"])
     if debug:
         n_obstacle_px = int(obstacles.sum())
         n_roof_px = int(roof_mask.sum())
         pct = n_obstacle_px / max(n_roof_px, 1) * 100
-        print(f"[shading_analyzer] detected {n_obstacle_px:,} obstacle px "
-              f"({pct:.1f}% of roof)")
-
-    # 2. Get sun positions for daylight hours of the year.
-    sun_az, sun_el = _get_daylight_sun_positions(lat, lng, year)
-    n_daylight = int(len(sun_az))
-
-    # 3. Bin sun positions by azimuth.
-    bins = _bin_by_azimuth(sun_az, sun_el, az_bin_deg)
-    if debug:
-        print(f"[shading_analyzer] {n_daylight} daylight hours -> "
-              f"{len(bins)} populated azimuth bins")
+        print(f"[shading_analyzer] detected {len(inventory['obstacles'])} obstacles, "
+              f"{n_obstacle_px:,} px ({pct:.1f}% of roof)")
 
-    # 4. For each bin, cast shadows from obstacles and accumulate hours.
-    shade_hours = np.zeros((h, w), dtype=np.float32)
-    for avg_az, avg_el, n_hours in bins:
-        shadow = _cast_shadow_from_obstacles(
-            obstacles, avg_az, avg_el, obstacle_height_m, m_per_pixel
+    horizon = None
+    if far_field:
+        neighbors = _detect_neighbor_buildings(
+            image, roof_mask, m_per_pixel, neighbor_height_m=neighbor_height_m
+        )
+        horizon = _horizon_profile(roof_mask, neighbors, m_per_pixel)
+        if debug:
+            print(f"[shading_analyzer] far field: {int(neighbors['labels'].max())} "
+                  f"neighbour buildings, max horizon {horizon.max():.1f} deg")
+
+    cache_key = None
+    entry = None
+    cache_hit = False
+    if cache:
+        cache_key = _shade_cache_key(
+            roof_mask, obstacles, m_per_pixel, lat, lng, year,
+            {"obstacle_height_m": obstacle_height_m, "az_bin_deg": az_bin_deg,
+             "engine": engine, "estimate_obstacle_heights": estimate_obstacle_heights,
+             "horizon": None if horizon is None
+             else hashlib.sha1(horizon.tobytes()).hexdigest()},
         )
-        shade_hours += (shadow & roof_mask).astype(np.float32) * n_hours
+        entry = _shade_cache_get(cache_key, disk_cache)
+
+    if entry is not None and shade_cube and "cube" not in entry:
+        entry = None  # cached without the cube — recompute once, then store it
+
+    if entry is not None:
+        cache_hit = True
+        shade_hours = _unpack_shade_hours(entry, (h, w))
+        n_daylight = entry["n_daylight"]
+        n_az_bins = entry["n_az_bins"]
+        n_blocked_total = entry.get("n_blocked", 0)
+        cube = entry.get("cube") if shade_cube else None
+        if debug:
+            print(f"[shading_analyzer] cache hit {cache_key[:10]} — "
+                  f"skipped {n_az_bins} shadow casts")
+    else:
+        # 2. Get sun positions for daylight hours of the year.
+        if shade_cube:
+            sun_az, sun_el, sun_month, sun_hour = _get_daylight_sun_positions(
+                lat, lng, year, with_local_time=True
+            )
+        else:
+            sun_az, sun_el = _get_daylight_sun_positions(lat, lng, year)
+        n_daylight = int(len(sun_az))
+
+        # 3. Bin sun positions by azimuth.
+        bins = _bin_by_azimuth(sun_az, sun_el, az_bin_deg)
+        n_az_bins = len(bins)
+        if debug:
+            print(f"[shading_analyzer] {n_daylight} daylight hours -> "
+                  f"{n_az_bins} populated azimuth bins")
+
+        # Far-field: per-hour horizon lookup, folded into per-bin counts.
+        bin_idx = _azimuth_bin_index(sun_az, az_bin_deg)
+        if horizon is not None:
+            blocked = far_field_beam_mask(horizon, sun_az, sun_el)
+            _, bin_pos = np.unique(bin_idx, return_inverse=True)
+            blocked_per_bin = np.bincount(bin_pos, weights=blocked, minlength=n_az_bins)
+        else:
+            blocked = None
+            blocked_per_bin = np.zeros(n_az_bins)
+        n_blocked_total = int(blocked_per_bin.sum())
+
+        # 4. For each bin, cast shadows from obstacles and accumulate hours.
+        shade_hours = np.zeros((h, w), dtype=np.float32)
+        if engine == "vector":
+            shadows = _vector_shadow_masks(
+                inventory, heights, roof_mask, bins, m_per_pixel, debug=debug,
+            )
+        else:
+            shadows = (
+                _cast_shadow_from_obstacles(
+                    inventory, avg_az, avg_el, heights, m_per_pixel
+                )
+                for avg_az, avg_el, _ in bins
+            )
+
+        roof_f32 = roof_mask.astype(np.float32)
+        bin_px: list[np.ndarray] = []
+        for (_, _, n_hours), n_blocked, shadow in zip(bins, blocked_per_bin, shadows):
+            shadow &= roof_mask
+            # Horizon-blocked hours shade every roof pixel; the remaining
+            # hours only where an obstacle shadow falls.
+            shade_hours += shadow.astype(np.float32) * (n_hours - n_blocked)
+            if n_blocked:
+                shade_hours += roof_f32 * float(n_blocked)
+            if shade_cube:
+                bin_px.append(np.flatnonzero(shadow).astype(np.int32))
+
+        cube = None
+        if shade_cube:
+            daylight_hours = np.zeros((12, 24), dtype=np.int32)
+            np.add.at(daylight_hours, (sun_month, sun_hour), 1)
+            cube = {
+                "shape": (h, w),
+                "weights": _bin_month_hour_weights(
+                    bin_idx, sun_month, sun_hour, blocked
+                ),
+                "daylight_hours": daylight_hours,
+                "bin_ptr": np.concatenate(
+                    [[0], np.cumsum([len(p) for p in bin_px])]
+                ).astype(np.int64),
+                "bin_px": (np.concatenate(bin_px) if bin_px
+                           else np.zeros(0, dtype=np.int32)),
+            }
+
+        if cache:
+            entry = _pack_shade_hours(shade_hours, roof_mask)
+            entry["n_daylight"] = n_daylight
+            entry["n_az_bins"] = n_az_bins
+            entry["n_blocked"] = n_blocked_total
+            if cube is not None:
+                entry["cube"] = cube
+            _shade_cache_put(cache_key, entry, disk_cache)
+
+    if cube is not None:
+        roof_px = int(roof_mask.sum())
+        ptr = cube["bin_ptr"]
+        per_bin = np.diff(ptr).astype(np.float64)[:, None]
+        cube = dict(cube)
+        cube["roof_fraction"] = _region_shade_cube(
+            cube, per_bin, np.array([roof_px])
+        )[0]
+        if debug:
+            print(f"[shading_analyzer] shade cube: {len(cube['weights'])} "
+                  f"(bin, month, hour) weights, {len(cube['bin_px']):,} "
+                  f"stored shadow px")
 
     # 5. Aggregate.
-    shade_fraction = shade_hours / max(n_daylight, 1)
-    shade_fraction = shade_fraction * roof_mask.astype(np.float32)
-
-    usable_mask = roof_mask & (shade_fraction < usable_shade_threshold)
-
-    roof_pixels_only = shade_fraction[roof_mask]
-    avg_shade_pct = float(roof_pixels_only.mean()) * 100 if roof_pixels_only.size else 0.0
+    summary = _aggregate_shade_hours(
+        shade_hours, roof_mask, n_daylight, m_per_pixel, usable_shade_threshold
+    )
 
-    usable_area_m2 = int(usable_mask.sum()) * (m_per_pixel ** 2)
-    usable_area_sqft = usable_area_m2 * 10.7639
+    diffuse_derate = None
+    avg_svf = None
+    if sky_view:
+        diffuse_derate = _sky_view_factor(
+            roof_mask, m_per_pixel, inventory, heights,
+            parapet_height_m=parapet_height_m,
+            n_directions=sky_view_directions,
+        )
+        avg_svf = round(float(diffuse_derate[roof_mask].mean()), 3) if roof_mask.any() else 0.0
+        if debug:
+            print(f"[shading_analyzer] avg sky-view factor: {avg_svf:.3f} "
+                  f"({sky_view_directions} directions, parapet {parapet_height_m} m)")
 
     if debug:
-        print(f"[shading_analyzer] avg shade across roof: {avg_shade_pct:.1f}%")
+        print(f"[shading_analyzer] avg shade across roof: {summary['avg_shade_pct']:.1f}%")
         print(f"[shading_analyzer] usable area (< {usable_shade_threshold*100:.0f}% shade): "
-              f"{usable_area_sqft:,.0f} sq ft")
+              f"{summary['usable_area_sqft']:,.0f} sq ft")
 
     return {
-        "shade_hours_map": shade_hours,
-        "shade_fraction_map": shade_fraction,
+        **summary,
         "obstacle_mask": obstacles,
-        "usable_mask": usable_mask,
-        "avg_shade_pct": round(avg_shade_pct, 2),
-        "usable_area_sqft": round(usable_area_sqft, 1),
-        "usable_area_m2": round(usable_area_m2, 2),
+        "obstacles": inventory["obstacles"],
+        "obstacle_labels": inventory["labels"],
         "n_daylight_hours": n_daylight,
         "obstacle_height_m": obstacle_height_m,
-        "n_az_bins": len(bins),
+        "n_az_bins": n_az_bins,
+        "engine": engine,
+        "cache_hit": cache_hit,
+        "shade_cube": cube,
+        "diffuse_derate_map": diffuse_derate,
+        "avg_sky_view_factor": avg_svf,
+        "horizon_profile_deg": horizon,
+        "far_field_blocked_hours": n_blocked_total,
     }
 
 
@@ -0,0 +1,202 @@
+"""
+Incremental shading session — interactive re-shading while tuning obstacle
+detection for one customer roof.
+
+analyze_shading() recomputes everything on each call. When an analyst drags
+the obstacle-darkness or obstacle-height slider, most obstacle components
+stay exactly the same, and so does the sun path. This session keeps:
+
+    - the decoded image (an ImageContext, so its HSV plane is converted
+      once across updates), sun-position bins and roof bbox
+    - each obstacle component's per-bin shadow pixels (sparse flat indices)
+    - a per-bin shadow coverage count over the roof bbox, so a pixel
+      shaded by two obstacles in the same bin still counts once
+    - the running shade-hours accumulator
+
+On update(), obstacles are re-detected (cheap). Components are matched by
+a hash of their footprint. Only components that appeared, disappeared or
+changed height get their contributions added to or subtracted from the
+accumulator. The result matches analyze_shading(engine="raster") exactly.
+
+Public API:
+    ShadingSession(image_bytes, roof_mask, lat, lng, m_per_pixel, ...)
+    ShadingSession.update(obstacle_dark_percentile=..., obstacle_height_m=...) -> dict
+
+update() returns the same keys as analyze_shading (shade maps, usable
+mask, obstacle table, summary stats) plus n_added / n_removed / n_kept.
+"""
+
+import hashlib
+
+import numpy as np
+
+from components.shading_analyzer import (
+    _aggregate_shade_hours,
+    _bin_by_azimuth,
+    _detect_obstacles,
+    _get_daylight_sun_positions,
+    _shadow_steps,
+    _stamp_obstacle_shadow,
+)
+from utils.image_context import ImageContext
+
+
+class ShadingSession:
+    """Keeps per-obstacle shadow contributions so threshold/height changes
+    only touch the obstacles that actually changed."""
+
+    def __init__(
+        self,
+        image_bytes: "bytes | ImageContext",
+        roof_mask: np.ndarray,
+        lat: float,
+        lng: float,
+        m_per_pixel: float,
+        year: int = 2025,
+        az_bin_deg: int = 10,
+        usable_shade_threshold: float = 0.10,
+        min_obstacle_area_m2: float = 0.1,
+        debug: bool = False,
+    ):
+        self.image = ImageContext.of(image_bytes)
+        self.roof_mask = roof_mask.astype(bool)
+        self.m_per_pixel = m_per_pixel
+        self.usable_shade_threshold = usable_shade_threshold
+        self.min_obstacle_area_m2 = min_obstacle_area_m2
+        self.debug = debug
+
+        sun_az, sun_el = _get_daylight_sun_positions(lat, lng, year)
+        self.n_daylight = int(len(sun_az))
+        self.bins = _bin_by_azimuth(sun_az, sun_el, az_bin_deg)
+        self._bin_hours = np.array([n for _, _, n in self.bins], dtype=np.float32)
+
+        # Everything below lives in roof-bbox coordinates: shadows are
+        # ANDed with the roof, so nothing outside the bbox ever matters.
+        ys, xs = np.where(self.roof_mask)
+        if ys.size == 0:
+            self._bbox = (0, 0, 0, 0)
+        else:
+            self._bbox = (int(ys.min()), int(ys.max()) + 1,
+                          int(xs.min()), int(xs.max()) + 1)
+        y0, y1, x0, x1 = self._bbox
+        self._roof_crop = self.roof_mask[y0:y1, x0:x1]
+        self._cover = np.zeros((len(self.bins), y1 - y0, x1 - x0), dtype=np.uint8)
+        self._hours = np.zeros((y1 - y0, x1 - x0), dtype=np.float32)
+
+        # component key -> {"height_m": float, "bins": [flat idx per bin]}
+        self._components: dict[str, dict] = {}
+        self._inventory: dict | None = None
+
+    # ---- per-component contributions ---------------------------------------
+    def _component_key(self, footprint: np.ndarray, x: int, y: int) -> str:
+        """Identity of an obstacle component: its exact pixel footprint."""
+        h = hashlib.sha1()
+        h.update(np.asarray([x, y, *footprint.shape], dtype=np.int32).tobytes())
+        h.update(np.packbits(footprint).tobytes())
+        return h.hexdigest()
+
+    def _cast_component(self, footprint: np.ndarray, x: int, y: int,
+                        height_m: float) -> list[np.ndarray]:
+        """Per-bin shadow of one component as flat indices into the roof
+        bbox, cast only inside the window its shadow can reach."""
+        by0, by1, bx0, bx1 = self._bbox
+        bw = bx1 - bx0
+        fh, fw = footprint.shape
+        out = []
+        for az, el, _ in self.bins:
+            steps = _shadow_steps(az, el, height_m, self.m_per_pixel)
+            if len(steps) == 0:
+                out.append(np.zeros(0, dtype=np.int32))
+                continue
+            wy0 = max(y + min(0, int(steps[:, 0].min())), by0)
+            wy1 = min(y + fh + max(0, int(steps[:, 0].max())), by1)
+            wx0 = max(x + min(0, int(steps[:, 1].min())), bx0)
+            wx1 = min(x + fw + max(0, int(steps[:, 1].max())), bx1)
+            if wy0 >= wy1 or wx0 >= wx1:
+                out.append(np.zeros(0, dtype=np.int32))
+                continue
+            window = np.zeros((wy1 - wy0, wx1 - wx0), dtype=bool)
+            _stamp_obstacle_shadow(window, footprint, x - wx0, y - wy0, steps)
+            window &= self._roof_crop[wy0 - by0:wy1 - by0, wx0 - bx0:wx1 - bx0]
+            ly, lx = np.nonzero(window)
+            out.append(((ly + wy0 - by0) * bw + (lx + wx0 - bx0)).astype(np.int32))
+        return out
+
+    def _apply(self, bins_idx: list[np.ndarray], sign: int) -> None:
+        """Add (+1) or subtract (-1) one component's contribution."""
+        hours = self._hours.ravel()
+        for b, idx in enumerate(bins_idx):
+            if idx.size == 0:
+                continue
+            cover = self._cover[b].ravel()
+            if sign > 0:
+                cover[idx] += 1
+                flipped = idx[cover[idx] == 1]
+                hours[flipped] += self._bin_hours[b]
+            else:
+                cover[idx] -= 1
+                flipped = idx[cover[idx] == 0]
+                hours[flipped] -= self._bin_hours[b]
+
+    # ---- main API ----------------------------------------------------------
+    def update(
+        self,
+        obstacle_dark_percentile: float = 10.0,
+        obstacle_height_m: float = 1.5,
+        estimate_obstacle_heights: bool = False,
+    ) -> dict:
+        """
+        Re-detect obstacles with the given settings and bring the shade map
+        up to date, recasting only the components that changed.
+        """
+        inventory = _detect_obstacles(
+            self.image, self.roof_mask, self.m_per_pixel,
+            dark_percentile=obstacle_dark_percentile,
+            min_area_m2=self.min_obstacle_area_m2,
+        )
+        labels = inventory["labels"]
+
+        wanted: dict[str, tuple] = {}
+        for ob in inventory["obstacles"]:
+            x, y, bw, bh = ob["bbox"]
+            footprint = labels[y:y + bh, x:x + bw] == ob["id"]
+            height = ob["height_m"] if estimate_obstacle_heights else obstacle_height_m
+            wanted[self._component_key(footprint, x, y)] = (footprint, x, y, height)
+
+        removed = [k for k, c in self._components.items()
+                   if k not in wanted or wanted[k][3] != c["height_m"]]
+        for k in removed:
+            self._apply(self._components.pop(k)["bins"], -1)
+
+        added = [k for k in wanted if k not in self._components]
+        for k in added:
+            footprint, x, y, height = wanted[k]
+            bins_idx = self._cast_component(footprint, x, y, height)
+            self._apply(bins_idx, +1)
+            self._components[k] = {"height_m": height, "bins": bins_idx}
+
+        self._inventory = inventory
+        n_kept = len(wanted) - len(added)
+        if self.debug:
+            print(f"[shading_session] {len(wanted)} obstacles: +{len(added)} "
+                  f"-{len(removed)} ={n_kept} (recast {len(added)})")
+
+        y0, y1, x0, x1 = self._bbox
+        shade_hours = np.zeros(self.roof_mask.shape, dtype=np.float32)
+        shade_hours[y0:y1, x0:x1] = self._hours
+        summary = _aggregate_shade_hours(
+            shade_hours, self.roof_mask, self.n_daylight, self.m_per_pixel,
+            self.usable_shade_threshold,
+        )
+        return {
+            **summary,
+            "obstacle_mask": inventory["mask"],
+            "obstacles": inventory["obstacles"],
+            "obstacle_labels": labels,
+            "n_daylight_hours": self.n_daylight,
+            "obstacle_height_m": obstacle_height_m,
+            "n_az_bins": len(self.bins),
+            "n_added": len(added),
+            "n_removed": len(removed),
+            "n_kept": n_kept,
+        }
@@ -0,0 +1,274 @@
+"""
+String / inverter grouping with a shade-aware, bypass-diode mismatch model.
+
+pvwatts_engine treats the array as one perfectly matched DC block with flat
+mismatch and shading derates. On partially shaded roofs a series string is
+only as good as the operating point its weakest modules allow. This module:
+
+    1. groups the laid-out panels into series strings (and strings onto
+       MPPT inputs) so that panels with similar shade profiles share a
+       string: panels are ordered along the first principal component of
+       their (month x hour) shade profile plus a spatial term, then chunked.
+    2. models every module as `substrings_per_module` bypass-diode
+       substrings. A panel shaded by fraction f in a (month, hour) slot
+       has f * substrings substrings' worth of shade: floor(f * substrings)
+       substrings fully shaded (beam lost, diffuse kept) and one more
+       losing the remainder of its beam.
+    3. computes MPPT output for every (MPPT, hour) at once. With a
+       string's substring irradiances sorted descending g(1) >= ... >=
+       g(m), at current level g(k) its k brightest substrings conduct and
+       the rest are bypassed, so its voltage is ~k substrings' worth.
+       Strings paralleled on one MPPT share that voltage: the input runs
+       at max_k k * sum_strings g(k), and each string delivers k * g(k) at
+       the chosen k. Consecutive strings in the shade order share an MPPT.
+
+Inputs come from the rest of the pipeline: `panels` from panel_layout, the
+per-panel shade cube from shading_analyzer.shade_cube_for_panels, and the
+NASA POWER weather frame.
+
+Public API:
+    plan_strings(panels, panel_shade_cube, weather, lat, lng, ...) -> dict
+
+Returns dict with:
+    strings               list of lists of panel indices (series order)
+    grouping              "shade" | "layout" — layout order is kept when
+                          the shade grouping doesn't beat it
+    string_mppt           (n_strings,) MPPT input index per string
+    string_annual_kwh     (n_strings,) AC kWh per string
+    annual_kwh            float — shade- and mismatch-aware AC energy
+    module_level_kwh      float — same shading, every module at its own MPP
+                          (upper bound, e.g. with optimizers)
+    unshaded_kwh          float — same array with no near-field shading
+    mismatch_loss_pct     float — string vs module-level
+    shading_loss_pct      float — annual_kwh vs unshaded
+    naive_annual_kwh      float — same model, panels strung in layout order
+    grouping_gain_pct     float — annual_kwh vs naive_annual_kwh (>= 0)
+"""
+
+import numpy as np
+import pandas as pd
+
+from components.pvwatts_engine import (
+    DEFAULT_GAMMA_PDC,
+    DEFAULT_LOSSES_PCT,
+    poa_components,
+)
+from components.shading_analyzer import LOCAL_TZ
+
+
+# ---- grouping --------------------------------------------------------------
+def _group_panels(
+    panels: list[tuple[int, int, int, int]],
+    profiles: np.ndarray,
+    modules_per_string: int,
+    shade_tolerance: float,
+) -> list[list[int]]:
+    """
+    Order panels by shade similarity (first principal component of the
+    mean-centred shade profile) and cut the order into strings of
+    `modules_per_string`. Position only breaks ties: keys are binned to
+    `shade_tolerance` (the key spans [-1, 1]) and panels within a bin
+    follow serpentine reading order.
+    """
+    n = len(panels)
+    if n == 0:
+        return []
+    xy = np.array([(x + w / 2.0, y + h / 2.0) for x, y, w, h in panels])
+    feat = profiles.reshape(n, -1).astype(np.float64)
+    feat = feat - feat.mean(axis=0)
+    if np.abs(feat).max() > 0:
+        _, _, vt = np.linalg.svd(feat, full_matrices=False)
+        shade_key = feat @ vt[0]
+        shade_key /= max(np.abs(shade_key).max(), 1e-9)
+    else:
+        shade_key = np.zeros(n)
+    # Serpentine reading order as the tie-breaker, so equally shaded panels
+    # that end up together are also close on the roof.
+    row = np.round(xy[:, 1] / max(np.median([h for *_, h in panels]), 1)).astype(int)
+    col = np.where(row % 2 == 0, xy[:, 0], -xy[:, 0])
+    spatial = np.lexsort((col, row)).argsort()
+    shade_bin = np.round(shade_key / max(shade_tolerance, 1e-9)).astype(np.int64)
+    order = np.lexsort((spatial, shade_bin))
+    return [order[i:i + modules_per_string].tolist()
+            for i in range(0, n, modules_per_string)]
+
+
+# ---- electrical model ------------------------------------------------------
+def _mppt_string_power(substring_irr: np.ndarray, string_mppt: np.ndarray) -> np.ndarray:
+    """
+    Per-string power at each MPPT's best shared operating point, for series
+    strings with bypass diodes.
+
+    substring_irr : (n_strings, n_hours, n_substrings) effective irradiance
+        per substring, W/m^2 (pad unused slots with 0).
+    string_mppt : (n_strings,) non-decreasing MPPT index per string.
+    Returns (n_strings, n_hours) power in "substring-STC" units: 1.0 = one
+    substring at 1000 W/m^2.
+    """
+    g = -np.sort(-substring_irr, axis=-1)  # descending
+    k = np.arange(1, g.shape[-1] + 1, dtype=np.float32)
+    power = g * k                          # each string's power at voltage level k
+    _, starts, mppt_of = np.unique(string_mppt, return_index=True, return_inverse=True)
+    mppt_power = np.add.reduceat(power, starts, axis=0)
+    best_k = mppt_power.argmax(axis=-1)    # (n_mppt, n_hours)
+    at_best = np.take_along_axis(power, best_k[mppt_of][..., None], axis=-1)
+    return at_best[..., 0] / 1000.0
+
+
+def _substring_irradiance(
+    members: np.ndarray,
+    shade_units: np.ndarray,
+    slot: np.ndarray,
+    direct: np.ndarray,
+    diffuse: np.ndarray,
+    substrings_per_module: int,
+) -> np.ndarray:
+    """(n_hours, len(members) * substrings) irradiance for one string.
+    shade_units is shade fraction x substrings: substring j loses
+    clip(units - j, 0, 1) of its beam."""
+    units = shade_units[members][:, slot]                   # (modules, hours)
+    sub = np.arange(substrings_per_module, dtype=np.float32)
+    shade = np.clip(units[:, :, None] - sub[None, None, :], 0, 1)  # (modules, hours, subs)
+    irr = diffuse[None, :, None] + direct[None, :, None] * (1 - shade)
+    return irr.transpose(1, 0, 2).reshape(len(slot), -1)
+
+
+def _ac_kwh(dc_w: np.ndarray, pdc0_w: np.ndarray, inverter_efficiency: float) -> np.ndarray:
+    """PVWatts inverter on (n, hours) DC watts with per-row nameplate
+    pdc0_w (n,); returns (n,) kWh summed over hours."""
+    from pvlib import inverter
+
+    ac = inverter.pvwatts(pdc=dc_w, pdc0=np.maximum(pdc0_w, 1e-9)[:, None],
+                          eta_inv_nom=inverter_efficiency)
+    return np.clip(np.nan_to_num(ac), 0, None).sum(axis=-1) / 1000.0
+
+
+# ---- main API --------------------------------------------------------------
+def plan_strings(
+    panels: list[tuple[int, int, int, int]],
+    panel_shade_cube: np.ndarray,
+    weather: pd.DataFrame,
+    lat: float,
+    lng: float,
+    modules_per_string: int = 10,
+    strings_per_mppt: int = 2,
+    substrings_per_module: int = 3,
+    panel_wattage: int = 330,
+    tilt: float | None = None,
+    azimuth: float = 180.0,
+    gamma_pdc: float = DEFAULT_GAMMA_PDC,
+    inverter_efficiency: float = 0.96,
+    shade_tolerance: float = 0.02,
+    debug: bool = False,
+) -> dict:
+    """
+    Group panels into strings / MPPTs and simulate string-level output with
+    bypass-diode-aware mismatch.
+
+    Parameters
+    ----------
+    panels : panel rectangles from optimize_panel_layout.
+    panel_shade_cube : (n_panels, 12, 24) shade fractions, from
+        shading_analyzer.shade_cube_for_panels(result["shade_cube"],
+        layout["panels"], layout["panel_polygons"]).
+    modules_per_string : series length (set by inverter MPPT voltage window).
+    strings_per_mppt : strings paralleled on one MPPT input; they share
+        its operating voltage.
+    shade_tolerance : shade-key difference (key range [-1, 1]) below which
+        panels count as equally shaded and are ordered by position.
+
+    The shade-ordered strings are kept only if they beat stringing in
+    layout order; otherwise the layout order is used (grouping = "layout").
+
+    Returns a dict (see module docstring for keys).
+    """
+    from pvlib import pvsystem
+
+    n = len(panels)
+    if panel_shade_cube.shape[0] != n:
+        raise ValueError(f"panel_shade_cube has {panel_shade_cube.shape[0]} panels, "
+                         f"layout has {n}")
+
+    poa = poa_components(weather, lat, lng, tilt=tilt, azimuth=azimuth)
+    direct = poa["poa_direct"].to_numpy()
+    diffuse = poa["poa_diffuse"].to_numpy()
+    local = poa.index.tz_convert(LOCAL_TZ)
+    slot = ((local.month.to_numpy() - 1) * 24 + local.hour.to_numpy())
+
+    # Substrings' worth of shade per (panel, month-hour slot).
+    shade_units = (np.clip(panel_shade_cube.reshape(n, 12 * 24), 0, 1)
+                   * substrings_per_module).astype(np.float32)
+
+    # Temperature derate and the loss stack minus the terms modelled here.
+    temp_factor = 1.0 + gamma_pdc * (poa["temp_cell"].to_numpy() - 25.0)
+    losses = dict(DEFAULT_LOSSES_PCT, shading=0.0, mismatch=0.0)
+    retention = 1 - pvsystem.pvwatts_losses(**losses) / 100.0
+    w_per_sub = panel_wattage / substrings_per_module * retention
+
+    def _simulate(strings: list[list[int]], shaded: np.ndarray,
+                  per_mppt: int = strings_per_mppt) -> np.ndarray:
+        """(n_strings,) AC kWh, all strings x hours in one pass; strings are
+        put on MPPTs `per_mppt` at a time in list order."""
+        width = max(len(s) for s in strings) * substrings_per_module
+        irr = np.zeros((len(strings), len(slot), width), dtype=np.float32)
+        for i, members in enumerate(strings):
+            block = _substring_irradiance(np.asarray(members), shaded, slot,
+                                          direct, diffuse, substrings_per_module)
+            irr[i, :, :block.shape[1]] = block
+        mppt = np.arange(len(strings)) // per_mppt
+        dc_w = _mppt_string_power(irr, mppt) * w_per_sub * temp_factor[None, :]
+        # Inverter capacity pro-rated to each string's nameplate.
+        pdc0 = np.array([len(s) * panel_wattage for s in strings], dtype=np.float64)
+        return _ac_kwh(dc_w, pdc0, inverter_efficiency)
+
+    strings = _group_panels(panels, panel_shade_cube, modules_per_string, shade_tolerance)
+    naive = [list(range(i, min(i + modules_per_string, n)))
+             for i in range(0, n, modules_per_string)]
+    if n == 0:
+        string_kwh = naive_kwh = np.zeros(0)
+        module_kwh = unshaded_kwh = 0.0
+    else:
+        string_kwh = _simulate(strings, shade_units)
+        naive_kwh = _simulate(naive, shade_units)
+        # Module-level MPP: every panel is its own one-module "string" on
+        # its own tracker.
+        module_kwh = float(_simulate([[i] for i in range(n)], shade_units, per_mppt=1).sum())
+
+    # A 1-D shade ordering can't separate every pattern (e.g. morning and
+    # afternoon shade on different edges); never ship a grouping that loses
+    # to plain layout order.
+    grouping = "shade"
+    if naive_kwh.sum() >= string_kwh.sum():
+        strings, string_kwh, grouping = naive, naive_kwh, "layout"
+    if n:
+        unshaded_kwh = float(_simulate(strings, np.zeros_like(shade_units)).sum())
+
+    annual_kwh = float(string_kwh.sum())
+    naive_annual = float(naive_kwh.sum())
+    mismatch_loss_pct = (1 - annual_kwh / max(module_kwh, 1e-9)) * 100
+    shading_loss_pct = (1 - annual_kwh / max(unshaded_kwh, 1e-9)) * 100
+    grouping_gain_pct = (annual_kwh / max(naive_annual, 1e-9) - 1) * 100
+
+    if debug:
+        print(f"[stringing] {n} panels -> {len(strings)} strings of <= "
+              f"{modules_per_string}, {-(-len(strings) // strings_per_mppt)} MPPTs "
+              f"({grouping} order)")
+        print(f"[stringing] annual {annual_kwh:,.0f} kWh | module-level "
+              f"{module_kwh:,.0f} | unshaded {unshaded_kwh:,.0f}")
+        print(f"[stringing] mismatch loss {mismatch_loss_pct:.2f}%, shading loss "
+              f"{shading_loss_pct:.2f}%, grouping gain vs layout order "
+              f"{grouping_gain_pct:+.2f}%")
+
+    return {
+        "strings": strings,
+        "grouping": grouping,
+        "string_mppt": np.arange(len(strings)) // strings_per_mppt,
+        "string_annual_kwh": np.round(string_kwh, 1),
+        "annual_kwh": round(annual_kwh, 1),
+        "module_level_kwh": round(module_kwh, 1),
+        "unshaded_kwh": round(unshaded_kwh, 1),
+        "mismatch_loss_pct": round(mismatch_loss_pct, 2),
+        "shading_loss_pct": round(shading_loss_pct, 2),
+        "naive_annual_kwh": round(naive_annual, 1),
+        "grouping_gain_pct": round(grouping_gain_pct, 2),
+    }
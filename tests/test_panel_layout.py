@@ -0,0 +1,63 @@
+import numpy as np
+import pytest
+
+from components.panel_layout import draw_panel_layout
+
+COLOR = (0, 100, 255)
+
+
+def _border_pixels(out: np.ndarray) -> np.ndarray:
+    return np.all(out == COLOR, axis=-1)
+
+
+@pytest.mark.parametrize("border, expected", [(1, 20 * 10 - 18 * 8), (2, 20 * 10 - 16 * 6)])
+def test_single_panel_border_width(border, expected):
+    image = np.zeros((40, 40, 3), dtype=np.uint8)
+    out = draw_panel_layout(image, [(5, 5, 20, 10)], color=COLOR, border=border)
+    edge = _border_pixels(out)
+    assert edge.sum() == expected
+    # The outline sits on the panel, and its interior is left blended.
+    assert not edge[:5].any() and not edge[15:].any()
+    assert not edge[5 + border:15 - border, 5 + border:25 - border].any()
+
+
+@pytest.mark.parametrize("border", [1, 2])
+def test_adjacent_panels_each_get_an_outline(border):
+    image = np.zeros((30, 60, 3), dtype=np.uint8)
+    out = draw_panel_layout(image, [(5, 5, 20, 10), (25, 5, 20, 10)],
+                            color=COLOR, border=border)
+    edge = _border_pixels(out)
+    per_panel = 20 * 10 - (20 - 2 * border) * (10 - 2 * border)
+    assert edge.sum() == 2 * per_panel
+    # Both sides of the shared edge are outlined.
+    assert edge[10, 25 - border:25 + border].all()
+
+
+def test_panel_on_frame_edge_is_outlined():
+    image = np.zeros((20, 20, 3), dtype=np.uint8)
+    out = draw_panel_layout(image, [(0, 0, 10, 10)], color=COLOR, border=1)
+    assert _border_pixels(out).sum() == 10 * 10 - 8 * 8
+
+
+def test_no_border():
+    image = np.zeros((20, 20, 3), dtype=np.uint8)
+    out = draw_panel_layout(image, [(2, 2, 10, 10)], color=COLOR, border=0)
+    assert not _border_pixels(out).any()
+
+
+@pytest.mark.parametrize("angle", [8, 25, 44])
+def test_rotated_panels_do_not_overlap_and_sit_inside_their_quads(angle):
+    import cv2
+
+    from components.panel_layout import _panel_label_mask, optimize_panel_layout
+
+    roof = np.zeros((500, 600), dtype=np.uint8)
+    cv2.fillPoly(roof, [cv2.boxPoints(((300, 250), (420, 320), angle)).astype(np.int32)], 1)
+    layout = optimize_panel_layout(roof.astype(bool), m_per_pixel=0.05, rotation=float(angle))
+    assert layout["panel_count"] > 0
+    labels = _panel_label_mask(roof.shape, layout["panels"])
+    assert (labels > 0).sum() == sum(w * h for *_, w, h in layout["panels"])
+    for poly, (x, y, w, h) in zip(layout["panel_polygons"], layout["panels"]):
+        quad = np.zeros(roof.shape, dtype=np.uint8)
+        cv2.fillPoly(quad, [np.round(poly).astype(np.int32)], 1)
+        assert quad[y:y + h, x:x + w].all()
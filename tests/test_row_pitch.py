@@ -0,0 +1,69 @@
+import numpy as np
+import pandas as pd
+import pvlib
+
+from components.row_pitch import _pareto_front, optimize_row_pitch
+
+
+def _clear_sky_weather(lat: float, lng: float) -> pd.DataFrame:
+    times = pd.date_range("2023-01-01", "2023-12-31 23:00", freq="h", tz="UTC")
+    cs = pvlib.location.Location(lat, lng).get_clearsky(times)
+    return pd.DataFrame({"ghi": cs["ghi"], "dni": cs["dni"], "dhi": cs["dhi"],
+                         "temp_air": 25.0, "wind_speed": 1.0}, index=times)
+
+
+def _assert_non_dominated(count: np.ndarray, kwh: np.ndarray, front: np.ndarray) -> None:
+    for i in np.flatnonzero(front):
+        dominated = ((count <= count[i]) & (kwh >= kwh[i])
+                     & ((count < count[i]) | (kwh > kwh[i])))
+        assert not dominated.any(), f"front member {i} is dominated"
+
+
+def test_pareto_front_prefers_fewer_panels_and_more_kwh():
+    count = np.array([10, 10, 12, 14, 14, 16, 9])
+    kwh = np.array([100.0, 90.0, 95.0, 120.0, 120.0, 110.0, 80.0])
+    front = _pareto_front(count, kwh)
+    # 12 panels / 95 kWh and 16 / 110 are beaten by 10 / 100 and 14 / 120.
+    assert front.tolist() == [True, False, False, True, False, False, True]
+    _assert_non_dominated(count, kwh, front)
+
+
+def test_pareto_front_random_is_non_dominated_and_complete():
+    rng = np.random.default_rng(0)
+    count = rng.integers(50, 60, 200)
+    kwh = rng.integers(1000, 1100, 200).astype(float)
+    front = _pareto_front(count, kwh)
+    _assert_non_dominated(count, kwh, front)
+    # Every non-member is dominated by some member.
+    for i in np.flatnonzero(~front):
+        m = front & (count <= count[i]) & (kwh >= kwh[i])
+        assert m.any()
+
+
+def test_optimize_row_pitch_front_is_non_dominated():
+    lat, lng = 28.5, 77.2
+    mask = np.zeros((300, 400), dtype=bool)
+    mask[20:280, 20:380] = True
+    out = optimize_row_pitch(mask, 0.05, _clear_sky_weather(lat, lng), lat, lng)
+    table = out["table"]
+    _assert_non_dominated(table["panel_count"].to_numpy(), table["annual_kwh"].to_numpy(),
+                          table["pareto"].to_numpy())
+    assert out["pareto"]["annual_kwh"].is_monotonic_increasing
+    assert out["pareto"]["annual_kwh"].iloc[-1] == table["annual_kwh"].max()
+
+
+def test_optimize_row_pitch_rows_run_perpendicular_to_azimuth():
+    lat, lng = 28.5, 77.2
+    weather = _clear_sky_weather(lat, lng)
+    mask = np.zeros((400, 400), dtype=bool)
+    mask[20:380, 20:380] = True
+    kw = dict(tilts_deg=(15,), gcrs=(0.55,))
+    south = optimize_row_pitch(mask, 0.05, weather, lat, lng, **kw)
+    west = optimize_row_pitch(mask, 0.05, weather, lat, lng, azimuth=270.0, **kw)
+    # A square roof turned a quarter: same packing, rows along image y.
+    assert west["best"]["panel_count"] == south["best"]["panel_count"]
+    for (x, y, w, h), poly in zip(west["best_panels"], west["best_panel_polygons"]):
+        across = poly[1] - poly[0]
+        assert abs(across[0]) < 1e-3 and abs(across[1]) > 0
+        assert w > h  # slope depth now runs along x, toward the west
+        assert mask[y:y + h, x:x + w].all()
@@ -0,0 +1,57 @@
+import numpy as np
+import pandas as pd
+import pvlib
+import pytest
+
+from components.stringing import _mppt_string_power, _substring_irradiance, plan_strings
+
+PANELS = [(x * 22, y * 35, 20, 33) for y in range(4) for x in range(10)]
+
+
+def _clear_sky_weather(lat: float, lng: float) -> pd.DataFrame:
+    times = pd.date_range("2023-01-01", "2023-12-31 23:00", freq="h", tz="UTC")
+    cs = pvlib.location.Location(lat, lng).get_clearsky(times)
+    return pd.DataFrame({"ghi": cs["ghi"], "dni": cs["dni"], "dhi": cs["dhi"],
+                         "temp_air": 25.0, "wind_speed": 1.0}, index=times)
+
+
+def _shade_cube(pattern: str, seed: int = 0) -> np.ndarray:
+    cube = np.zeros((len(PANELS), 12, 24))
+    x = np.array([p[0] for p in PANELS]) / 200.0
+    y = np.array([p[1] for p in PANELS]) / 105.0
+    if pattern == "block":
+        cube[(x < 0.5) & (y < 0.5), :, 7:11] = 0.7
+    elif pattern == "gradient":
+        cube[:, :, 6:10] = (0.8 * x)[:, None, None]
+        cube[:, :, 15:18] = (0.5 * (1 - y))[:, None, None]
+    else:
+        cube[:] = np.random.default_rng(seed).random(cube.shape) ** 3
+    return cube
+
+
+def test_strings_on_one_mppt_share_an_operating_point():
+    # String B has one substring at 200 W/m^2. On its own tracker it
+    # bypasses it (2.0); sharing A's voltage, both run at k = 2.
+    irr = np.array([[[1000, 1000, 1000]], [[1000, 1000, 200]]], dtype=np.float32)
+    separate = _mppt_string_power(irr, np.array([0, 1]))
+    shared = _mppt_string_power(irr, np.array([0, 0]))
+    np.testing.assert_allclose(separate[:, 0], [3.0, 2.0])
+    np.testing.assert_allclose(shared[:, 0], [2.0, 2.0])
+    assert shared.sum() <= separate.sum()
+
+
+def test_light_shade_costs_a_fraction_of_one_substring():
+    units = np.array([[0.03, 1.5]], dtype=np.float32)  # shade fraction x 3 substrings
+    irr = _substring_irradiance(np.array([0]), units, np.array([0, 1]),
+                                np.array([800.0, 800.0]), np.array([100.0, 100.0]), 3)
+    np.testing.assert_allclose(irr[0], [900 - 0.03 * 800, 900, 900], rtol=1e-6)
+    np.testing.assert_allclose(irr[1], [100, 500, 900], rtol=1e-6)
+
+
+@pytest.mark.parametrize("pattern", ["block", "gradient", "random"])
+def test_grouping_never_loses_to_layout_order(pattern):
+    out = plan_strings(PANELS, _shade_cube(pattern), _clear_sky_weather(28.5, 77.2),
+                       28.5, 77.2, modules_per_string=8)
+    assert out["annual_kwh"] >= out["naive_annual_kwh"]
+    assert out["grouping_gain_pct"] >= 0
+    assert sorted(i for s in out["strings"] for i in s) == list(range(len(PANELS)))
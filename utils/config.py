@@ -22,7 +22,33 @@ class SolarConfig:
     STANDARD_PANEL_WATTAGE = 330  # Watts in India)
     STANDARD_PANEL_SIZE_SQFT = 20  #sqft
     PANEL_EFFICIENCY = 0.20  # 20% efficiency
+
+    # Module SKUs we quote (Indian market, typical datasheet values).
+    # Used by components.module_catalog to rank modules per roof.
+    #   height_m / width_m: module dimensions; gamma_pdc: power temp coeff
+    #   (per deg C); cost_per_watt: installed ₹/W for a system built on it
+    PANEL_CATALOG = [
+        {"sku": "POLY-330", "name": "330 W polycrystalline", "height_m": 1.65,
+         "width_m": 0.99, "wattage": 330, "gamma_pdc": -0.0040, "cost_per_watt": 45.0},
+        {"sku": "MONO-400", "name": "400 W mono PERC", "height_m": 1.76,
+         "width_m": 1.05, "wattage": 400, "gamma_pdc": -0.0037, "cost_per_watt": 46.0},
+        {"sku": "MONO-445", "name": "445 W mono PERC half-cut", "height_m": 2.09,
+         "width_m": 1.04, "wattage": 445, "gamma_pdc": -0.0035, "cost_per_watt": 44.0},
+        {"sku": "MONO-540", "name": "540 W mono PERC half-cut", "height_m": 2.28,
+         "width_m": 1.13, "wattage": 540, "gamma_pdc": -0.0035, "cost_per_watt": 42.0},
+        {"sku": "TOPCON-580", "name": "580 W n-type TOPCon", "height_m": 2.28,
+         "width_m": 1.13, "wattage": 580, "gamma_pdc": -0.0030, "cost_per_watt": 47.0},
+        {"sku": "HJT-430", "name": "430 W heterojunction", "height_m": 1.72,
+         "width_m": 1.13, "wattage": 430, "gamma_pdc": -0.0026, "cost_per_watt": 52.0},
+    ]
     
+    # Roof segmentation backend: "torch" (MobileSAM checkpoint, eager mode)
+    # or "onnx" (ONNX Runtime, see components.sam_onnx; faster on CPU-only
+    # servers). SAM_ONNX_THREADS=0 lets ONNX Runtime pick.
+    SAM_BACKEND = os.getenv('SAM_BACKEND', 'torch').lower()
+    SAM_ONNX_QUANTIZE = os.getenv('SAM_ONNX_QUANTIZE', '1') not in ('0', 'false', 'False')
+    SAM_ONNX_THREADS = int(os.getenv('SAM_ONNX_THREADS', '0'))
+
     # System Performance (Indian conditions)
     SYSTEM_EFFICIENCY = 0.80  # 80% overall system efficiency (dust/heat factor)
     INVERTER_EFFICIENCY = 0.95  # 95% inverter efficiency
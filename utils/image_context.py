@@ -0,0 +1,99 @@
+"""
+Decode-once image context shared across pipeline stages.
+
+The same satellite PNG used to be decoded (PIL -> RGB) separately by the
+prompt picker, the segmenter, the shading analyzer and both app overlays,
+and converted to HSV separately by the prompt picker, shadow removal and
+obstacle detection — several 1280x1280 decodes and colour conversions per
+run. An ImageContext decodes once and memoizes every derived plane on
+first access:
+
+    rgb        (H,W,3) uint8
+    hsv        (H,W,3) uint8, OpenCV ranges
+    v          (H,W)   uint8 HSV value channel
+    gray       (H,W)   uint8
+    pyramid(k) (H/2^k, W/2^k, 3) uint8 via cv2.pyrDown
+    content_hash  sha1 of shape + pixels (stable across PNG re-encodes)
+
+Planes are shared between stages, so they are returned read-only; copy
+before drawing on one.
+
+Public API:
+    ImageContext(image_bytes=None, rgb=None)
+    ImageContext.of(image) -> ImageContext   (bytes | ndarray | ImageContext)
+"""
+
+import hashlib
+import io
+from functools import cached_property
+
+import cv2
+import numpy as np
+from PIL import Image
+
+
+def _read_only(arr: np.ndarray) -> np.ndarray:
+    arr.setflags(write=False)
+    return arr
+
+
+class ImageContext:
+    """One decoded satellite image plus lazily memoized derived planes."""
+
+    def __init__(self, image_bytes: bytes | None = None, rgb: np.ndarray | None = None):
+        if image_bytes is None and rgb is None:
+            raise ValueError("ImageContext needs image_bytes or rgb")
+        self.image_bytes = image_bytes
+        if rgb is not None:
+            self.__dict__["rgb"] = _read_only(np.array(rgb, dtype=np.uint8))
+        self._pyramid: dict[int, np.ndarray] = {}
+
+    @classmethod
+    def of(cls, image) -> "ImageContext":
+        """Wrap raw bytes or an RGB array; pass an ImageContext through."""
+        if isinstance(image, cls):
+            return image
+        if isinstance(image, (bytes, bytearray, memoryview)):
+            return cls(image_bytes=bytes(image))
+        return cls(rgb=image)
+
+    # ---- planes ------------------------------------------------------------
+    @cached_property
+    def rgb(self) -> np.ndarray:
+        return _read_only(np.array(Image.open(io.BytesIO(self.image_bytes)).convert("RGB")))
+
+    @cached_property
+    def hsv(self) -> np.ndarray:
+        return _read_only(cv2.cvtColor(self.rgb, cv2.COLOR_RGB2HSV))
+
+    @cached_property
+    def v(self) -> np.ndarray:
+        return _read_only(np.ascontiguousarray(self.hsv[..., 2]))
+
+    @cached_property
+    def gray(self) -> np.ndarray:
+        return _read_only(cv2.cvtColor(self.rgb, cv2.COLOR_RGB2GRAY))
+
+    def pyramid(self, level: int) -> np.ndarray:
+        """RGB downsampled by 2**level (Gaussian pyramid), memoized per level."""
+        if level == 0:
+            return self.rgb
+        if level not in self._pyramid:
+            self._pyramid[level] = _read_only(cv2.pyrDown(self.pyramid(level - 1)))
+        return self._pyramid[level]
+
+    # ---- metadata ----------------------------------------------------------
+    @property
+    def shape(self) -> tuple[int, int]:
+        return self.rgb.shape[:2]
+
+    @cached_property
+    def content_hash(self) -> str:
+        h = hashlib.sha1()
+        h.update(np.asarray(self.rgb.shape, dtype=np.int32).tobytes())
+        h.update(self.rgb.tobytes())
+        return h.hexdigest()
+
+    def pil(self) -> Image.Image:
+        """A fresh PIL copy of the RGB plane (safe to draw on)."""
+        return Image.fromarray(self.rgb.copy())
@@ -0,0 +1,154 @@
+"""
+Background warm-up for app startup.
+
+MobileSAM takes ~2 s to load and its first encoder pass is slower still
+(allocator + kernel warm-up), and torch / pvlib / matplotlib add their own
+import time. Without warm-up the first user pays all of it. start_warmup()
+runs these on a daemon thread as soon as the server boots, so the page
+renders immediately and the heavy work is usually done before the first
+analysis is submitted:
+
+    1. import torch (first, so its OpenMP runtime loads before scipy's —
+       the Windows DLL-order issue noted in shading_analyzer)
+    2. load the SAM predictor (roof_segmenter._get_predictor)
+    3. one dummy encoder pass through the SAM service
+    4. import pvlib, the matplotlib chart stack and the pipeline modules
+
+A segmentation requested mid-warm-up simply waits on the predictor's load
+lock; nothing is loaded twice.
+
+Public API:
+    start_warmup(sam=True, dummy_pass=True) -> None   (idempotent)
+    warmup_status() -> dict
+    wait_until_ready(timeout=None) -> bool
+
+warmup_status() returns dict with:
+    state       "idle" | "running" | "ready" | "failed"
+    steps       {step name: seconds taken} for finished steps
+    current     step in progress (None when not running)
+    error       str | None — first failure (later steps still run)
+    elapsed_s   float — since start_warmup() (total once finished)
+"""
+
+import importlib
+import os
+import threading
+import time
+
+import numpy as np
+
+
+# Modules imported on the warm-up thread after the model is ready — the
+# ones app.py defers until an analysis runs.
+WARMUP_IMPORTS = (
+    "pvlib.solarposition",
+    "pvlib.irradiance",
+    "matplotlib.pyplot",
+    "components.pipeline",
+    "components.charts",
+)
+
+_STATE = {"state": "idle", "steps": {}, "current": None, "error": None,
+          "started": None, "finished": None}
+_LOCK = threading.Lock()
+_READY = threading.Event()
+
+
+def _set(**kwargs) -> None:
+    with _LOCK:
+        _STATE.update(kwargs)
+
+
+def _step(name: str, fn) -> None:
+    """Run one warm-up step, recording its duration or first error."""
+    _set(current=name)
+    t0 = time.perf_counter()
+    try:
+        fn()
+    except Exception as exc:
+        print(f"[warmup] {name} failed: {exc}")
+        with _LOCK:
+            if _STATE["error"] is None:
+                _STATE["error"] = f"{name}: {exc}"
+        return
+    with _LOCK:
+        _STATE["steps"][name] = round(time.perf_counter() - t0, 2)
+
+
+def _import_torch() -> None:
+    os.environ.setdefault("KMP_DUPLICATE_LIB_OK", "TRUE")
+    import torch
+
+    # Streamlit's module-reloader walks `torch.classes.__path__._path`,
+    # which torch's custom __getattr__ doesn't support — it spams a noisy
+    # RuntimeError on every rerun. Override with an empty list to silence.
+    torch.classes.__path__ = []
+
+
+def _dummy_encoder_pass() -> None:
+    from components.roof_segmenter import _encode_batch, get_sam_service
+
+    blank = np.zeros((640, 640, 3), dtype=np.uint8)
+    get_sam_service().run(
+        lambda predictor: _encode_batch(predictor, [predictor.transform.apply_image(blank)])
+    ).result()
+
+
+def _run(sam: bool, dummy_pass: bool) -> None:
+    from utils.config import config
+
+    if sam:
+        if config.SAM_BACKEND != "onnx":
+            _step("import torch", _import_torch)
+        from components.roof_segmenter import _get_predictor
+
+        _step("load SAM", _get_predictor)
+        if dummy_pass:
+            _step("encoder pass", _dummy_encoder_pass)
+    for module in WARMUP_IMPORTS:
+        if module.startswith("matplotlib"):
+            os.environ.setdefault("MPLBACKEND", "Agg")
+        _step(f"import {module}", lambda m=module: importlib.import_module(m))
+
+    with _LOCK:
+        _STATE.update(state="failed" if _STATE["error"] else "ready", current=None,
+                      finished=time.perf_counter())
+        steps = ", ".join(f"{k} {v:.2f}s" for k, v in _STATE["steps"].items())
+        summary = f"{_STATE['state']} in {_STATE['finished'] - _STATE['started']:.1f} s"
+    _READY.set()
+    print(f"[warmup] {summary} ({steps})")
+
+
+def start_warmup(sam: bool = True, dummy_pass: bool = True) -> None:
+    """
+    Start the warm-up thread. Safe to call on every Streamlit rerun: only
+    the first call in the process starts anything.
+    """
+    with _LOCK:
+        if _STATE["state"] != "idle":
+            return
+        _STATE.update(state="running", started=time.perf_counter())
+    threading.Thread(target=_run, args=(sam, dummy_pass),
+                     name="warmup", daemon=True).start()
+
+
+def warmup_status() -> dict:
+    """Snapshot of the warm-up state (see module docstring for keys)."""
+    with _LOCK:
+        started = _STATE["started"]
+        end = _STATE["finished"] or time.perf_counter()
+        return {
+            "state": _STATE["state"],
+            "steps": dict(_STATE["steps"]),
+            "current": _STATE["current"],
+            "error": _STATE["error"],
+            "elapsed_s": 0.0 if started is None else round(end - started, 2),
+        }
+
+
+def wait_until_ready(timeout: float | None = None) -> bool:
+    """Block until warm-up finishes (ready or failed); False on timeout or
+    if it was never started."""
+    if _STATE["state"] == "idle":
+        return False
+    return _READY.wait(timeout)